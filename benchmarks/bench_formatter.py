@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times the formatting of every GitLab payload of the fixture corpus
+
+    python benchmarks/bench_formatter.py [--number N]
+
+With --synthetic N, N generated payloads (see mattermost_gitlab.synthetic) are timed instead,
+e.g. at production sizes:
+
+    python benchmarks/bench_formatter.py --synthetic 50 --max-commits 5000 --description-size 1000000 --number 5
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import codecs
+import glob
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mattermost_gitlab import event_formatter, synthetic  # noqa: E402
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data', 'gitlab')
+
+
+def load_corpus():
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*', '*.json'))):
+        with codecs.open(path, encoding='utf-8') as fp:
+            data = json.load(fp)
+        try:
+            event_formatter.as_event(data).format()
+        except Exception:
+            continue
+        corpus.append((os.path.relpath(path, FIXTURES), data))
+    return corpus
+
+
+def synthetic_corpus(count, **options):
+    generator = synthetic.PayloadGenerator(**options)
+    corpus = []
+    for index, data in enumerate(generator.stream(count)):
+        try:
+            event_formatter.as_event(data).format()
+        except NotImplementedError:
+            continue
+        corpus.append(('%s/%d' % (data['object_kind'], index), data))
+    return corpus
+
+
+def time_event(data, number):
+    return min(timeit.repeat(lambda: event_formatter.as_event(data).format(), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N', help='Time N synthetic payloads instead of the fixtures')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-commits', type=int, default=20)
+    parser.add_argument('--description-size', type=int, default=500)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        corpus = synthetic_corpus(args.synthetic, seed=args.seed, max_commits=args.max_commits, description_size=args.description_size)
+    else:
+        corpus = load_corpus()
+
+    print('%-45s %10s' % ('payload', 'time'))
+    total = 0
+    for name, data in corpus:
+        elapsed = time_event(data, args.number)
+        total += elapsed
+        print('%-45s %8.2fus' % (name, elapsed * 1e6))
+
+    print('%-45s %8.2fus' % ('mean per event', total * 1e6 / len(corpus)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times the evaluation of a large rule set on the fixture corpus
+
+    python benchmarks/bench_rules.py [--rules N] [--number N]
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mattermost_gitlab import rules  # noqa: E402
+from bench_formatter import load_corpus  # noqa: E402
+
+
+def make_rules(count):
+    kinds = ['push', 'tag_push', 'issue', 'note', 'merge_request', 'build']
+    specs = []
+    for index in range(count):
+        kind = kinds[index % len(kinds)]
+        specs.append({
+            'kind': kind,
+            'branch': ['release/%d.*' % index, 'hotfix-%d' % index],
+            'author': ['bot-%d' % index],
+            'decision': 'drop' if index % 2 else 'keep',
+        })
+    return specs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', type=int, default=3000)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    specs = make_rules(args.rules)
+    compile_time = min(timeit.repeat(lambda: rules.RuleSet(specs), number=1, repeat=3))
+    rule_set = rules.RuleSet(specs)
+    corpus = [data for __, data in load_corpus()]
+
+    def evaluate():
+        for data in corpus:
+            rule_set.allows(data)
+
+    elapsed = min(timeit.repeat(evaluate, number=args.number, repeat=5)) / args.number / len(corpus)
+    print('%d rules compiled in %.1fms, %.1fus per event (no rule matching, worst case)' % (args.rules, compile_time * 1000, elapsed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Soak test: drives the server with mixed webhook traffic and checks that it stays stable
+
+    python benchmarks/soak.py --duration 3600 [-- SERVER OPTIONS]
+
+The server runs in a subprocess, posting to a mock Mattermost server in this process, so that
+everything stays local. Its resident memory and object counts are sampled every --interval
+seconds, along with the latency percentiles of the webhooks of the interval. The test fails
+when, past the warm-up, memory or objects grow beyond the allowed margins, when the p99
+latency drifts past --max-p99-drift times its first value, or when more than --max-error-rate
+of the webhooks fail. Options after -- are passed to the server, e.g. -- --delivery-workers 4
+--dead-letters dead.db --push --tag. The output of the server goes to --server-log, or its last lines to the report.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import codecs
+import collections
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Third-party imports
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mattermost_gitlab  # noqa: E402
+from mattermost_gitlab import delivery, synthetic  # noqa: E402
+from mattermost_gitlab.mock_http import TestServer, get_available_port  # noqa: E402
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data', 'gitlab')
+ADMIN_TOKEN = 'soak'
+# Lines of the output of the server kept in the report
+LOG_LINES = 50
+CI_KINDS = ('build', 'pipeline', None)
+
+
+def parse_args(args=None):
+    args = sys.argv[1:] if args is None else list(args)
+    server_args = []
+    if '--' in args:
+        args, server_args = args[:args.index('--')], args[args.index('--') + 1:]
+
+    parser = argparse.ArgumentParser(prog='python benchmarks/soak.py', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=600, help='Seconds of traffic')
+    parser.add_argument('--interval', type=float, default=10, help='Seconds between samples')
+    parser.add_argument('--warmup', type=float, default=None, help='Seconds before the baseline sample, an interval by default')
+    parser.add_argument('--concurrency', type=int, default=4, help='Clients posting webhooks at the same time')
+    parser.add_argument('--rate', type=float, default=0, help='Webhooks posted per second, as fast as possible if 0')
+    parser.add_argument('--fixtures', default=FIXTURES, metavar='DIR', help='Directory of JSON payloads, in sub-directories, posted in random order')
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N', help='Post N generated payloads instead of the fixtures')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-rss-growth', type=float, default=50, metavar='MB', help='Fail when memory grows by more than MB after the warm-up')
+    parser.add_argument('--max-object-growth', type=float, default=0.2, metavar='RATIO',
+                        help='Fail when the objects of the server grow by more than that ratio after the warm-up')
+    parser.add_argument('--max-p99-drift', type=float, default=2.0, metavar='RATIO',
+                        help='Fail when the p99 latency of an interval exceeds that ratio of the baseline p99')
+    parser.add_argument('--p99-floor', type=float, default=20, metavar='MS', help='p99 latencies below MS never count as drifting')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, metavar='RATIO',
+                        help='Fail when more than that ratio of the webhooks are not answered with 200 OK')
+    parser.add_argument('--report', default=None, metavar='FILE', help='Write the samples, failures and last lines of the server output as JSON')
+    parser.add_argument('--server-log', default=None, metavar='FILE', help='Write the output of the server to FILE')
+    options = parser.parse_args(args)
+    options.server_args = server_args
+    if options.warmup is None:
+        options.warmup = options.interval
+    return options
+
+
+def endpoint(data):
+    return '/new_ci_event' if data.get('object_kind') in CI_KINDS else '/new_event'
+
+
+def load_payloads(options):
+    """
+    Endpoints and bodies of the payloads to post
+    """
+
+    if options.synthetic:
+        generator = synthetic.PayloadGenerator(seed=options.seed)
+        payloads = list(generator.stream(options.synthetic))
+    else:
+        payloads = []
+        for path in sorted(glob.glob(os.path.join(options.fixtures, '*', '*.json'))):
+            with codecs.open(path, encoding='utf-8') as fp:
+                payloads.append(json.load(fp))
+    if not payloads:
+        raise SystemExit('No payloads to post')
+    return [(endpoint(data), json.dumps(data).encode('utf-8')) for data in payloads]
+
+
+def percentile(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(ratio * (len(values) - 1)))]
+
+
+def server_environment():
+    """
+    Environment of the server, importing the same mattermost_gitlab package as this script
+    whatever the working directory, so that relative paths of its options are those of the caller
+    """
+
+    env = dict(os.environ)
+    paths = [os.path.dirname(os.path.dirname(os.path.abspath(mattermost_gitlab.__file__)))]
+    if env.get('PYTHONPATH'):
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+    return env
+
+
+class ServerProcess(object):
+    """
+    The server under test, in a subprocess posting to `webhook_url`, its output going to `log`,
+    or to a temporary file removed when it stops
+    """
+
+    def __init__(self, webhook_url, server_args, log=None):
+        self.port = get_available_port()
+        self.url = 'http://127.0.0.1:%d' % self.port
+        if log:
+            self.output = open(log, 'w+b')
+            self.log = log
+        else:
+            self.output = tempfile.NamedTemporaryFile(prefix='soak-server-', suffix='.log')
+            self.log = None
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'mattermost_gitlab.server', webhook_url, '--host', '127.0.0.1', '--port', str(self.port),
+             '--admin-token', ADMIN_TOKEN] + list(server_args),
+            env=server_environment(),
+            stdout=self.output,
+            stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit('The server exited with status %d' % self.process.returncode)
+            try:
+                if requests.get(self.url + '/ready', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise SystemExit('The server did not start within %d seconds' % timeout)
+
+    def memory(self):
+        return requests.get(self.url + '/admin/memory', headers={'X-Admin-Token': ADMIN_TOKEN}, timeout=30).json()
+
+    def stop(self):
+        """
+        Stops the server, returns the last lines of its output
+        """
+
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait()
+            except KeyboardInterrupt:
+                self.process.kill()
+        self.output.seek(0)
+        lines = [line.decode('utf-8', 'replace').rstrip('\n') for line in collections.deque(self.output, LOG_LINES)]
+        self.output.close()
+        return lines
+
+
+class Traffic(object):
+    """
+    Clients posting payloads in random order, recording the latency of each webhook
+    """
+
+    def __init__(self, url, payloads, concurrency, rate, seed):
+        self.url = url
+        self.payloads = payloads
+        self.concurrency = concurrency
+        self.rate_limiter = delivery.RateLimiter(rate)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.latencies = []
+        self.requests = 0
+        self.errors = 0
+        self.threads = []
+
+    def start(self):
+        for index in range(self.concurrency):
+            thread = threading.Thread(target=self.run, args=(random.Random(self.random.random()),), name='soak-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self, rng):
+        session = requests.Session()
+        headers = {'Content-Type': 'application/json'}
+        while not self.stopped.is_set():
+            self.rate_limiter.wait()
+            path, body = rng.choice(self.payloads)
+            start = time.time()
+            try:
+                ok = session.post(self.url + path, data=body, headers=headers, timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            latency = (time.time() - start) * 1000
+            with self.lock:
+                self.requests += 1
+                if ok:
+                    self.latencies.append(latency)
+                else:
+                    self.errors += 1
+
+    def take_latencies(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            return latencies
+
+
+def sample(elapsed, server, traffic):
+    latencies = traffic.take_latencies()
+    stats = server.memory()
+    return {
+        'elapsed': round(elapsed, 1),
+        'requests': traffic.requests,
+        'errors': traffic.errors,
+        'rss': stats['rss'],
+        'objects': stats['objects'],
+        'threads': stats['threads'],
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def format_sample(sample):
+    def ms(value):
+        return '%8.1f' % value if value is not None else '       -'
+
+    return '%8.1f %9d %7d %9s %9d %7d %s %s %s' % (
+        sample['elapsed'], sample['requests'], sample['errors'],
+        '%.1f' % (sample['rss'] / 1048576.0) if sample['rss'] is not None else '-',
+        sample['objects'], sample['threads'], ms(sample['p50']), ms(sample['p95']), ms(sample['p99']),
+    )
+
+
+HEADER = ' elapsed  requests  errors    rss_mb   objects threads  p50_ms   p95_ms   p99_ms'
+
+
+def check(samples, warmup, max_rss_growth, max_object_growth, max_p99_drift, p99_floor, max_error_rate):
+    """
+    Failures of the soak test: growth of memory or objects, or drift of the p99 latency, from
+    the first sample past the warm-up to the later ones, or errors of the whole run
+    """
+
+    failures = []
+    if samples and samples[-1]['requests'] and samples[-1]['errors'] > samples[-1]['requests'] * max_error_rate:
+        failures.append('%d of %d webhooks failed' % (samples[-1]['errors'], samples[-1]['requests']))
+
+    samples = [sample for sample in samples if sample['elapsed'] >= warmup]
+    if len(samples) < 2:
+        return failures + ['Not enough samples past the warm-up, run longer or sample more often']
+
+    baseline, last = samples[0], samples[-1]
+    if baseline['rss'] is not None and last['rss'] is not None:
+        growth = (last['rss'] - baseline['rss']) / 1048576.0
+        if growth > max_rss_growth:
+            failures.append('Memory grew by %.1f MB (%.1f MB/hour)' % (growth, growth * 3600 / max(last['elapsed'] - baseline['elapsed'], 1)))
+    if last['objects'] > baseline['objects'] * (1 + max_object_growth):
+        failures.append('Objects grew from %d to %d' % (baseline['objects'], last['objects']))
+
+    threshold = max((baseline['p99'] or 0) * max_p99_drift, p99_floor)
+    for sample in samples[1:]:
+        if sample['p99'] is not None and sample['p99'] > threshold:
+            failures.append('p99 latency reached %.1f ms at %.0f s, above %.1f ms' % (sample['p99'], sample['elapsed'], threshold))
+            break
+    return failures
+
+
+def main(args=None):
+    options = parse_args(args)
+    payloads = load_payloads(options)
+
+    mattermost = TestServer()
+    mattermost.start()
+    server = ServerProcess(mattermost.url, options.server_args, options.server_log)
+    traffic = Traffic(server.url, payloads, options.concurrency, options.rate, options.seed)
+    samples = []
+    output = []
+    try:
+        server.wait_ready()
+        print(HEADER)
+        start = time.time()
+        traffic.start()
+        while True:
+            elapsed = time.time() - start
+            next_sample = min((len(samples) + 1) * options.interval, options.duration)
+            time.sleep(max(next_sample - elapsed, 0))
+            samples.append(sample(time.time() - start, server, traffic))
+            print(format_sample(samples[-1]))
+            sys.stdout.flush()
+            if next_sample >= options.duration:
+                break
+    finally:
+        traffic.stop()
+        output = server.stop()
+        mattermost.stop_server()
+
+    failures = check(samples, options.warmup, options.max_rss_growth, options.max_object_growth, options.max_p99_drift, options.p99_floor,
+                     options.max_error_rate)
+    if options.report:
+        with codecs.open(options.report, 'w', encoding='utf-8') as fp:
+            json.dump({'requests': traffic.requests, 'errors': traffic.errors, 'samples': samples, 'failures': failures, 'server_output': output}, fp, indent=2)
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    if failures and not options.server_log:
+        print('Last lines of the server output:')
+        for line in output:
+            print('    %s' % line)
+    if not failures:
+        print('OK: %d webhooks, %d errors' % (traffic.requests, traffic.errors))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import contextlib
+import threading
+
+from . import constants
+
+
+# Values of the X-Gitlab-Event header, which lets us know the kind of event before reading the body
+HOOK_EVENT_KINDS = {
+    'Push Hook': constants.PUSH_EVENT,
+    'Tag Push Hook': constants.TAG_EVENT,
+    'Issue Hook': constants.ISSUE_EVENT,
+    'Note Hook': constants.COMMENT_EVENT,
+    'Merge Request Hook': constants.MERGE_EVENT,
+    'Build Hook': constants.BUILD_EVENT,
+    'Job Hook': constants.BUILD_EVENT,
+    'Pipeline Hook': constants.CI_EVENT,
+}
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is rejected, GitLab should retry it after `retry_after` seconds
+    """
+
+    def __init__(self, status, retry_after, message):
+        super(Overloaded, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Limits(object):
+    """
+    Load thresholds above which events are rejected
+
+    `max_load` applies to every event and is answered with a 503, the per-kind
+    thresholds in `kind_limits` are answered with a 429 so that low-value events
+    can be shed before the important ones. 0 means no limit.
+    """
+
+    def __init__(self, max_load=0, kind_limits=None, retry_after=10):
+        self.max_load = max_load
+        self.kind_limits = kind_limits or {}
+        self.retry_after = retry_after
+
+    def check(self, object_kind, load):
+        if self.max_load and load >= self.max_load:
+            raise Overloaded(503, self.retry_after, 'Server overloaded (%d requests pending)' % load)
+
+        limit = self.kind_limits.get(object_kind)
+        if limit and load >= limit:
+            raise Overloaded(429, self.retry_after, 'Too many pending requests for %s events (%d)' % (object_kind, load))
+
+
+def parse_kind_limit(value):
+    """
+    argparse type for `<object_kind>=<limit>` values
+    """
+
+    kind, sep, limit = value.partition('=')
+    if not sep or not limit.isdigit():
+        raise argparse.ArgumentTypeError('expected <event kind>=<limit>, got %r' % value)
+    return kind.strip(), int(limit)
+
+
+class AdmissionController(object):
+    """
+    Counts the requests being handled, and rejects new ones when the load is over the limits
+
+    The load is the number of requests in flight plus the number of deliveries waiting
+    in the `backlog` (a callable returning a size).
+    """
+
+    def __init__(self, backlog=None):
+        self.in_flight = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.backlog = backlog or (lambda: 0)
+
+    @property
+    def load(self):
+        return self.in_flight + self.backlog()
+
+    @contextlib.contextmanager
+    def admit(self, object_kind, limits):
+        with self.lock:
+            try:
+                limits.check(object_kind, self.load)
+            except Overloaded:
+                self.rejected += 1
+                raise
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Dead letters: payloads which could not be formatted, and messages which could not be delivered
+
+    mattermost_gitlab dead-letters --db FILE {list,show,redrive,purge} [options]
+
+Instead of being printed and dropped, they are kept in an SQLite database with the class of the
+error, the number of attempts and the last HTTP status, indexed by reason, project and time, so
+that they can be listed and delivered again once the cause is fixed, e.g. after an outage of
+Mattermost or once a new action is supported. Payloads and messages are stored as compressed
+JSON. Redrives post from several threads at a limited rate, so that a backlog is cleared without
+overloading Mattermost; delivered entries are removed, the others keep their latest error.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from . import delivery, event_formatter, lag
+
+
+# Reasons of dead letters
+FORMAT = 'format'
+DELIVERY = 'delivery'
+REASONS = (FORMAT, DELIVERY)
+
+DURATION_PATTERN = re.compile(r'^(\d+)([smhd])$')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_time(value):
+    """
+    argparse type for times: seconds since the epoch, a UTC timestamp, or a duration ago (30m, 2h, 7d)
+    """
+
+    match = DURATION_PATTERN.match(value)
+    if match:
+        return time.time() - int(match.group(1)) * DURATION_UNITS[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    timestamp = lag.parse_timestamp(value)
+    if timestamp is None:
+        raise argparse.ArgumentTypeError('expected seconds since the epoch, a timestamp or a duration such as 2h, got %r' % value)
+    return timestamp
+
+
+def payload_project(data):
+    """
+    Project id of a payload which may not even be a valid event, like `BaseEvent.project_id`
+    """
+
+    if not isinstance(data, dict):
+        return None
+    for container in (data, data.get('object_attributes') or {}):
+        for key in ('project_id', 'target_project_id'):
+            if container.get(key) is not None:
+                return container[key]
+    return (data.get('project') or {}).get('id')
+
+
+class DeadLetter(object):
+    """
+    A payload or message which failed, `payload` being None when listed
+    """
+
+    __slots__ = ('id', 'time', 'reason', 'endpoint', 'object_kind', 'project', 'error_class', 'error', 'attempts', 'last_status', 'payload')
+
+    COLUMNS = __slots__
+
+    def __init__(self, *values):
+        for name, value in zip(self.COLUMNS, values):
+            setattr(self, name, value)
+
+    def data(self):
+        """
+        The payload sent by GitLab, or the message as a dict
+        """
+
+        return json.loads(zlib.decompress(self.payload).decode('utf-8'))
+
+    def message(self, channel=None):
+        """
+        Message to deliver again: the message which failed, or the payload formatted anew
+        """
+
+        if self.reason == DELIVERY:
+            return delivery.Message.from_dict(self.data())
+
+        event_class = event_formatter.as_ci_event if self.endpoint == '/new_ci_event' else event_formatter.as_event
+        event = event_class(self.data())
+        return delivery.Message.from_event(event, event.format(), channel=channel or None)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.COLUMNS if name != 'payload')
+
+
+def where(reason=None, project=None, error_class=None, since=None, until=None):
+    """
+    WHERE clause and parameters selecting dead letters
+    """
+
+    conditions, params = [], []
+    for condition, value in (('reason = ?', reason), ('project = ?', project), ('error_class = ?', error_class), ('time >= ?', since), ('time < ?', until)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(str(value) if condition == 'project = ?' else value)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+
+class DeadLetterStore(object):
+    """
+    Dead letters in an SQLite database in WAL mode, keeping the last `max_entries` of them
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, time REAL NOT NULL, reason TEXT NOT NULL, endpoint TEXT, object_kind TEXT, '
+        'project TEXT, error_class TEXT NOT NULL, error TEXT, attempts INTEGER NOT NULL, last_status INTEGER, payload BLOB NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS dead_letters_time ON dead_letters (time)',
+        'CREATE INDEX IF NOT EXISTS dead_letters_reason ON dead_letters (reason, time)',
+        'CREATE INDEX IF NOT EXISTS dead_letters_project ON dead_letters (project, time)',
+    )
+    LISTED = ', '.join(DeadLetter.COLUMNS[:-1]) + ', NULL'
+
+    def __init__(self, path, max_entries=10000, timeout=5.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def add(self, reason, data, exc, attempts=1, endpoint=None, object_kind=None, project=None):
+        payload = zlib.compress(json.dumps(data).encode('utf-8'), 6)
+        conn = self.connection()
+        cursor = conn.execute(
+            'INSERT INTO dead_letters (time, reason, endpoint, object_kind, project, error_class, error, attempts, last_status, payload) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (time.time(), reason, endpoint, object_kind, str(project) if project is not None else None,
+             exc.__class__.__name__, str(exc), attempts, getattr(exc, 'status', None), sqlite3.Binary(payload)),
+        )
+        if self.max_entries and cursor.lastrowid > self.max_entries:
+            conn.execute('DELETE FROM dead_letters WHERE id <= ?', (cursor.lastrowid - self.max_entries,))
+        return cursor.lastrowid
+
+    def add_payload(self, endpoint, data, exc):
+        """
+        Keeps a payload which could not be formatted
+        """
+
+        object_kind = data.get('object_kind') if isinstance(data, dict) else None
+        return self.add(FORMAT, data, exc, endpoint=endpoint, object_kind=object_kind, project=payload_project(data))
+
+    def add_message(self, message, exc):
+        """
+        Keeps a message which could not be delivered, or each message of a batch
+        """
+
+        for part in getattr(message, 'parts', [message]):
+            self.add(DELIVERY, part.to_dict(), exc, attempts=message.attempts, object_kind=part.object_kind, project=part.project)
+
+    def get(self, id):
+        row = self.connection().execute('SELECT * FROM dead_letters WHERE id = ?', (id,)).fetchone()
+        return DeadLetter(*row) if row is not None else None
+
+    def list(self, limit=100, **filters):
+        """
+        Dead letters, newest first, without their payload
+        """
+
+        clause, params = where(**filters)
+        rows = self.connection().execute('SELECT %s FROM dead_letters%s ORDER BY time DESC LIMIT ?' % (self.LISTED, clause), params + [limit])
+        return [DeadLetter(*row) for row in rows]
+
+    def ids(self, **filters):
+        clause, params = where(**filters)
+        return [row[0] for row in self.connection().execute('SELECT id FROM dead_letters%s ORDER BY time' % clause, params)]
+
+    def summary(self, **filters):
+        """
+        Numbers of dead letters by reason and error class
+        """
+
+        clause, params = where(**filters)
+        counts = {}
+        for reason, error_class, count in self.connection().execute(
+            'SELECT reason, error_class, COUNT(*) FROM dead_letters%s GROUP BY reason, error_class' % clause, params
+        ):
+            counts.setdefault(reason, {})[error_class] = count
+        return counts
+
+    def update(self, id, exc):
+        """
+        Records another failed attempt
+        """
+
+        self.connection().execute(
+            'UPDATE dead_letters SET attempts = attempts + 1, error_class = ?, error = ?, last_status = ? WHERE id = ?',
+            (exc.__class__.__name__, str(exc), getattr(exc, 'status', None), id),
+        )
+
+    def delete(self, ids):
+        self.connection().executemany('DELETE FROM dead_letters WHERE id = ?', [(id,) for id in ids])
+
+    def purge(self, **filters):
+        clause, params = where(**filters)
+        return self.connection().execute('DELETE FROM dead_letters%s' % clause, params).rowcount
+
+
+class Redrive(object):
+    """
+    Delivers dead letters again with `deliver(dead_letter)`, from `workers` threads and at most
+    `rate` per second (0: no limit)
+    """
+
+    def __init__(self, store, ids, deliver, rate=1, workers=4):
+        self.store = store
+        self.ids = list(ids)
+        self.deliver = deliver
+        self.rate_limiter = delivery.RateLimiter(rate)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.delivered = 0
+        self.failed = 0
+        self.started_at = None
+        self.threads = []
+
+    def start(self):
+        self.started_at = time.time()
+        for index in range(min(self.workers, len(self.ids))):
+            thread = threading.Thread(target=self.work, name='redrive-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+        return self.done
+
+    @property
+    def done(self):
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def take(self):
+        with self.lock:
+            if self.next_index >= len(self.ids):
+                return None
+            self.next_index += 1
+            return self.ids[self.next_index - 1]
+
+    def work(self):
+        while True:
+            id = self.take()
+            if id is None:
+                self.store.close()
+                return
+            dead_letter = self.store.get(id)
+            if dead_letter is None:
+                continue
+            self.rate_limiter.wait()
+            try:
+                self.deliver(dead_letter)
+            except Exception as exc:
+                self.store.update(id, exc)
+                with self.lock:
+                    self.failed += 1
+            else:
+                self.store.delete([id])
+                with self.lock:
+                    self.delivered += 1
+
+    def to_dict(self):
+        return {
+            'total': len(self.ids),
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'done': self.done,
+            'started_at': self.started_at,
+        }
+
+
+def add_filter_arguments(parser):
+    parser.add_argument('--reason', choices=REASONS, default=None)
+    parser.add_argument('--project', default=None, help='Project id')
+    parser.add_argument('--error', dest='error_class', default=None, metavar='CLASS', help='Class of the error, e.g. DeliveryError or NotImplementedError')
+    parser.add_argument('--since', type=parse_time, default=None, metavar='TIME', help='Seconds since the epoch, UTC timestamp, or duration ago such as 2h')
+    parser.add_argument('--until', type=parse_time, default=None, metavar='TIME')
+
+
+FILTERS = ('reason', 'project', 'error_class', 'since', 'until')
+
+
+def parse_args(args=None):
+    from . import server
+
+    parser = server.ArgumentParser(prog='mattermost_gitlab dead-letters', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', required=True, metavar='FILE', help='Database of the dead letters, the --dead-letters of the server')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    list_parser = commands.add_parser('list', help='List dead letters, newest first, and count them by reason and error')
+    add_filter_arguments(list_parser)
+    list_parser.add_argument('--limit', type=int, default=100)
+
+    show_parser = commands.add_parser('show', help='Show a dead letter with its payload or message')
+    show_parser.add_argument('id', type=int)
+
+    redrive_parser = commands.add_parser('redrive', help='Deliver dead letters again, removing those delivered')
+    add_filter_arguments(redrive_parser)
+    redrive_parser.add_argument('--deliver', dest='MATTERMOST_WEBHOOK_URL', required=True, metavar='URL', help='Mattermost webhook to post to')
+    redrive_parser.add_argument('--rate', type=float, default=5, help='Messages posted per second')
+    redrive_parser.add_argument('--workers', type=int, default=4, help='Messages posted at the same time')
+    server.add_message_arguments(redrive_parser)
+
+    purge_parser = commands.add_parser('purge', help='Remove dead letters')
+    add_filter_arguments(purge_parser)
+
+    return vars(parser.parse_args(args=args))
+
+
+def main(args=None):
+    from . import server
+
+    options = parse_args(sys.argv[1:] if args is None else args)
+    store = DeadLetterStore(options['db'], max_entries=None)
+    filters = dict((name, options.get(name)) for name in FILTERS)
+    command = options['command']
+
+    if command == 'list':
+        for dead_letter in store.list(options['limit'], **filters):
+            print(json.dumps(dead_letter.to_dict(), sort_keys=True))
+        for reason, counts in sorted(store.summary(**filters).items()):
+            print('%s: %s' % (reason, ', '.join('%d %s' % (count, error_class) for error_class, count in sorted(counts.items()))), file=sys.stderr)
+    elif command == 'show':
+        dead_letter = store.get(options['id'])
+        if dead_letter is None:
+            print('No dead letter %d' % options['id'], file=sys.stderr)
+            return 1
+        data = dead_letter.to_dict()
+        data['payload'] = dead_letter.data()
+        print(json.dumps(data, indent=2, sort_keys=True))
+    elif command == 'redrive':
+        options['MATTERMOST_API'] = None
+
+        def deliver(dead_letter):
+            message = dead_letter.message(options['CHANNEL'])
+            message.event_time = None
+            server.post_message(message, options)
+
+        redrive = Redrive(store, store.ids(**filters), deliver, options['rate'], options['workers']).start()
+        redrive.join()
+        print('%(delivered)d delivered, %(failed)d failed' % redrive.to_dict(), file=sys.stderr)
+        return 1 if redrive.failed else 0
+    elif command == 'purge':
+        print('%d dead letters removed' % store.purge(**filters), file=sys.stderr)
+    return 0
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import codecs
+import collections
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+from . import constants, lag
+
+
+# Lower is delivered sooner. Keys are `<object_kind>:<action>` or `<object_kind>`.
+DEFAULT_PRIORITIES = {
+    constants.BUILD_EVENT + ':failed': 0,
+    constants.CI_EVENT + ':failed': 0,
+    constants.MERGE_EVENT + ':open': 0,
+    constants.MERGE_EVENT: 1,
+    constants.ISSUE_EVENT: 1,
+    constants.COMMENT_EVENT: 1,
+    constants.BUILD_EVENT: 2,
+    constants.CI_EVENT: 2,
+    constants.TAG_EVENT: 3,
+    constants.PUSH_EVENT: 3,
+}
+
+
+class DeliveryError(Exception):
+    """
+    Raised when Mattermost did not accept a message, `retry_after` is the delay it asked for, if
+    any, and `status` the HTTP status of its answer, if any
+    """
+
+    def __init__(self, message, retry_after=None, status=None):
+        super(DeliveryError, self).__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+def parse_retry_after(value):
+    if value and value.isdigit():
+        return int(value)
+    return None
+
+
+class PriorityClasses(object):
+    """
+    Priority of messages according to the kind and action of their event
+    """
+
+    def __init__(self, priorities=None, default=2):
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        self.priorities.update(priorities or {})
+        self.default = default
+
+    def lookup(self, object_kind, action=None):
+        if action is not None:
+            priority = self.priorities.get('%s:%s' % (object_kind, action))
+            if priority is not None:
+                return priority
+        return self.priorities.get(object_kind, self.default)
+
+
+def parse_priority(value):
+    """
+    argparse type for `<object_kind>[:<action>]=<priority>` values
+    """
+
+    key, sep, priority = value.partition('=')
+    try:
+        return key.strip(), int(priority)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected <event kind>[:<action>]=<priority>, got %r' % value)
+
+
+class Message(object):
+    """
+    Text to post to Mattermost, along with what is needed to schedule it
+    """
+
+    def __init__(self, text, object_kind=None, action=None, project=None, ref=None, channel=None, priority=0, post_key=None, event_time=None, thread_key=None):
+        self.text = text
+        self.object_kind = object_kind
+        self.action = action
+        self.project = project
+        self.ref = ref
+        self.channel = channel
+        self.priority = priority
+        # messages with a post key update the same Mattermost post, in API mode
+        self.post_key = post_key
+        # messages with a thread key are posted as replies to the first of them, in API mode
+        self.thread_key = thread_key
+        # time of the event in GitLab, to measure the lag of the message
+        self.event_time = event_time
+        self.enqueued_at = time.time()
+        self.attempts = 0
+
+    @classmethod
+    def from_event(cls, event, text, priorities=None, channel=None, post_key=None, thread_key=None):
+        action = event.action
+        return cls(
+            text,
+            object_kind=event.object_kind,
+            action=action,
+            project=event.project_id,
+            ref=event.ref,
+            channel=channel,
+            priority=priorities.lookup(event.object_kind, action) if priorities else 0,
+            post_key=post_key,
+            thread_key=thread_key,
+            event_time=lag.parse_timestamp(event.timestamp),
+        )
+
+    FIELDS = ('text', 'object_kind', 'action', 'project', 'ref', 'channel', 'priority', 'post_key', 'thread_key', 'event_time', 'enqueued_at', 'attempts')
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        message = cls(data['text'])
+        for name in cls.FIELDS:
+            if name in data:
+                setattr(message, name, data[name])
+        return message
+
+    @property
+    def ordering_key(self):
+        """
+        Messages sharing this key are delivered one at a time, in order
+        """
+
+        return (self.project, self.ref)
+
+
+BATCH_SEPARATOR = '\n\n---\n\n'
+
+
+def batch_messages(messages):
+    """
+    Message posting the text of several messages for the same channel, in order
+
+    Its `parts` are the original messages.
+    """
+
+    first = messages[0]
+    message = Message(
+        BATCH_SEPARATOR.join(part.text.strip() for part in messages),
+        object_kind='batch',
+        channel=first.channel,
+        priority=min(part.priority for part in messages),
+    )
+    message.enqueued_at = first.enqueued_at
+    message.parts = messages
+    return message
+
+
+class DeliveryQueue(object):
+    """
+    Delivers messages from worker threads, by priority
+
+    A message of priority P is scheduled as if it had been queued P * `aging` seconds later
+    than it was, so that waiting long enough lets low priority messages overtake newer urgent
+    ones. Messages with the same ordering key (project and ref) keep their relative order:
+    only the oldest of them is eligible, and the next one once it has been delivered. Messages
+    still failing after `max_attempts` are handed to `on_failure(message, exc)`, if given.
+
+    When more than `batch_threshold` messages are waiting for the same channel, e.g. after an
+    outage, the next ones are posted together, in scheduling order, up to `batch_max_chars`
+    characters, so that a backlog takes fewer posts. Messages updating a post or replying in a
+    thread are never batched.
+    """
+
+    def __init__(self, deliver, workers=1, aging=30, max_attempts=3, retry_delay=1, batch_threshold=10, batch_max_chars=16000, on_failure=None):
+        self.deliver = deliver
+        self.on_failure = on_failure
+        self.workers = workers
+        self.aging = aging
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.batch_threshold = batch_threshold
+        self.batch_max_chars = batch_max_chars
+        self.cond = threading.Condition()
+        self.heap = []
+        self.pending = {}
+        self.busy = set()
+        self.size = 0
+        self.counter = itertools.count()
+        self.threads = []
+        self.stopped = False
+        # messages handed to a worker, and those a stop interrupted, given back by take_pending
+        self.in_flight = set()
+        self.interrupted = []
+        self.delivered = 0
+        self.failed = 0
+        self.batched = 0
+        # messages waiting by channel, to detect a backlog
+        self.waiting = collections.Counter()
+
+    def __len__(self):
+        return self.size
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.work, name='delivery-%d' % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stops the workers once their current attempt is done, waiting at most `timeout` seconds
+        for them; queued messages and those in flight are left for `take_pending`
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(deadline - time.time(), 0))
+        self.threads = []
+
+    def take_pending(self):
+        """
+        Removes and returns the messages not delivered yet: those interrupted by a stop or still
+        in flight, then the queued ones in scheduling order
+        """
+
+        with self.cond:
+            messages = list(self.interrupted)
+            for message in self.in_flight:
+                messages.extend(getattr(message, 'parts', [message]))
+            self.interrupted = []
+            self.in_flight.clear()
+            for __, __, key in sorted(self.heap):
+                messages.extend(self.pending.pop(key))
+            # messages waiting behind one being delivered
+            for key in list(self.pending):
+                messages.extend(self.pending.pop(key))
+            self.heap = []
+            self.waiting.clear()
+            self.size -= len(messages)
+            self.cond.notify_all()
+            return messages
+
+    def schedule(self, key):
+        message = self.pending[key][0]
+        heapq.heappush(self.heap, (message.enqueued_at + message.priority * self.aging, next(self.counter), key))
+
+    def put(self, message):
+        with self.cond:
+            key = message.ordering_key
+            if key in self.pending:
+                self.pending[key].append(message)
+            else:
+                self.pending[key] = collections.deque([message])
+                if key not in self.busy:
+                    self.schedule(key)
+            self.size += 1
+            self.waiting[message.channel] += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Takes the next message to deliver, which must be handed back to `task_done`
+        """
+
+        with self.cond:
+            while not self.heap and not self.stopped:
+                self.cond.wait(timeout)
+                if timeout is not None:
+                    break
+            if self.stopped or not self.heap:
+                return None
+
+            __, __, key = heapq.heappop(self.heap)
+            message = self.take(key)
+            if self.batch_threshold and message.post_key is None and message.thread_key is None and self.waiting[message.channel] >= self.batch_threshold:
+                message = self.take_batch(message)
+            self.in_flight.add(message)
+            return message
+
+    def take(self, key):
+        messages = self.pending[key]
+        message = messages.popleft()
+        if not messages:
+            del self.pending[key]
+        self.busy.add(key)
+        self.waiting[message.channel] -= 1
+        return message
+
+    def take_batch(self, first):
+        """
+        Batches the messages following `first` for the same channel, while they fit
+        """
+
+        parts = [first]
+        size = len(first.text)
+        skipped = []
+        # messages following the first one with the same ordering key, then the next eligible ones
+        key, entry = first.ordering_key, None
+        while True:
+            while key in self.pending:
+                message = self.pending[key][0]
+                fits = size + len(BATCH_SEPARATOR) + len(message.text) <= self.batch_max_chars
+                if message.channel != first.channel or message.post_key is not None or message.thread_key is not None or not fits:
+                    break
+                parts.append(self.take(key))
+                size += len(BATCH_SEPARATOR) + len(message.text)
+            if entry is not None and key in self.pending and key not in self.busy:
+                skipped.append(entry)
+            # stop when full, or when too many messages for other channels are in the way
+            if not self.heap or self.batch_max_chars - size <= len(BATCH_SEPARATOR) or len(skipped) > 2 * self.batch_threshold:
+                break
+            entry = heapq.heappop(self.heap)
+            key = entry[2]
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+
+        if len(parts) == 1:
+            return first
+        self.batched += len(parts)
+        return batch_messages(parts)
+
+    def task_done(self, message, delivered=True):
+        """
+        Hands back a message taken with `get`: `delivered` is None when a stop interrupted it,
+        and it is then kept for `take_pending`
+        """
+
+        with self.cond:
+            if message not in self.in_flight:
+                # already given back by take_pending
+                return
+            self.in_flight.discard(message)
+            for part in getattr(message, 'parts', [message]):
+                if delivered is None:
+                    self.interrupted.append(part)
+                    continue
+                if delivered:
+                    self.delivered += 1
+                else:
+                    self.failed += 1
+                key = part.ordering_key
+                if key in self.busy:
+                    self.busy.discard(key)
+                    if key in self.pending:
+                        self.schedule(key)
+                self.size -= 1
+            self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Waits until every queued message has been handled, returns whether the queue is empty
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return not self.size
+
+    def work(self):
+        while True:
+            message = self.get()
+            if message is None:
+                return
+            delivered = False
+            try:
+                delivered = self.send(message)
+            finally:
+                self.task_done(message, delivered)
+
+    def send(self, message):
+        return send(self.deliver, message, self.max_attempts, self.retry_delay, lambda: self.stopped, self.on_failure, self.wait)
+
+    def wait(self, delay):
+        """
+        Sleeps before a retry, waking up early when the queue is stopped
+        """
+
+        deadline = time.time() + delay
+        with self.cond:
+            while not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+
+def send(deliver, message, max_attempts=3, retry_delay=1, stopped=lambda: False, on_failure=None, wait=time.sleep):
+    """
+    Delivers a message, retrying after the delay asked by Mattermost or an exponential backoff,
+    returns whether it was delivered, after handing the last error to `on_failure` if not, or
+    None when stopped before its last attempt
+    """
+
+    while True:
+        message.attempts += 1
+        try:
+            deliver(message)
+            return True
+        except Exception as exc:
+            if message.attempts >= max_attempts:
+                print('Giving up delivering %s message after %d attempts: %s' % (message.object_kind, message.attempts, exc))
+                if on_failure is not None:
+                    on_failure(message, exc)
+                return False
+            if stopped():
+                return None
+            retry_after = getattr(exc, 'retry_after', None)
+            wait(retry_after if retry_after is not None else retry_delay * 2 ** (message.attempts - 1))
+            if stopped():
+                return None
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to `wait` by at least 1 / `rate` seconds, across threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def save_messages(path, messages):
+    """
+    Appends messages to a spool file, one JSON object per line
+    """
+
+    with codecs.open(path, 'a', encoding='utf-8') as fp:
+        for message in messages:
+            fp.write(json.dumps(message.to_dict()) + '\n')
+
+
+def load_messages(path):
+    """
+    Reads and removes a spool file, returns its messages
+    """
+
+    if not os.path.exists(path):
+        return []
+
+    messages = []
+    with codecs.open(path, encoding='utf-8') as fp:
+        for line in fp:
+            try:
+                messages.append(Message.from_dict(json.loads(line)))
+            except (ValueError, KeyError):
+                if line.strip():
+                    print('Skipping unreadable spooled message: %r' % line[:100])
+    os.remove(path)
+    return messages
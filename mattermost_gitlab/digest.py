@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import collections
+import io
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+from . import constants, delivery, rules
+
+
+MAX_USERS = 5
+MAX_TAGS = 10
+
+
+class DigestRules(object):
+    """
+    Selects the events summarised in the digest instead of being posted: their kind must be
+    one of `kinds`, and their branch and project must match one of the patterns, if any
+    """
+
+    def __init__(self, kinds, branches=None, projects=None):
+        self.kinds = frozenset(kinds)
+        self.branches = rules.PatternSet(branches) if branches else None
+        self.projects = rules.PatternSet(projects) if projects else None
+
+    def accepts(self, event):
+        if event.object_kind not in self.kinds:
+            return False
+        if self.branches is not None and not self.branches.match(event.ref):
+            return False
+        if self.projects is not None and not self.projects.match_any((event.project_path, str(event.project_id))):
+            return False
+        return True
+
+
+class Digest(object):
+    """
+    Accumulates a compact summary of events per channel, and delivers it every `interval` seconds
+
+    Each channel keeps at most `max_entries` lines (one per project, kind and branch), further
+    events are only counted. The pending summaries are saved to the `snapshot` file, if any, at
+    most every `save_interval` seconds and when stopping, and are reloaded when starting.
+    """
+
+    def __init__(self, deliver, interval=900, max_entries=500, snapshot=None, save_interval=5):
+        self.deliver = deliver
+        self.interval = interval
+        self.max_entries = max_entries
+        self.snapshot = snapshot
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.dirty = False
+        self.stopping = threading.Event()
+        self.thread = None
+        self.load()
+
+    @staticmethod
+    def summarize(event):
+        """
+        What the digest keeps of an event
+        """
+
+        tag = event.object_kind == constants.TAG_EVENT
+        return {
+            'key': '%s|%s' % (event.object_kind, event.project_path) if tag else '%s|%s|%s' % (event.object_kind, event.project_path, event.ref),
+            'kind': event.object_kind,
+            'project': event.project_link,
+            'ref': event.ref,
+            'tag': tag,
+            'commits': event.data.get('total_commits_count') or 0,
+            'author': event.author,
+        }
+
+    def new_bucket(self, since=None):
+        return {'since': since or time.time(), 'entries': collections.OrderedDict(), 'overflow': 0}
+
+    def merge(self, bucket, summary):
+        """
+        Counts an event summary in the line of its project, kind and branch
+        """
+
+        entry = bucket['entries'].get(summary['key'])
+        if entry is None:
+            if len(bucket['entries']) >= self.max_entries:
+                bucket['overflow'] += 1
+                return
+            entry = bucket['entries'][summary['key']] = {
+                'key': summary['key'],
+                'kind': summary['kind'],
+                'project': summary['project'],
+                'ref': None if summary['tag'] else summary['ref'],
+                'events': 0,
+                'commits': 0,
+                'users': [],
+                'tags': [],
+            }
+
+        entry['events'] += 1
+        entry['commits'] += summary['commits']
+        author = summary['author']
+        if author and author not in entry['users'] and len(entry['users']) < MAX_USERS:
+            entry['users'].append(author)
+        if entry['ref'] is None and len(entry['tags']) < MAX_TAGS:
+            entry['tags'].append(summary['ref'])
+
+    def merge_bucket(self, older, newer):
+        """
+        Combines a bucket that could not be delivered with the one accumulated since: its lines
+        come first, and it started earlier
+        """
+
+        bucket = self.new_bucket(min(older['since'], newer['since']))
+        bucket['overflow'] = older['overflow'] + newer['overflow']
+        for entry in itertools.chain(older['entries'].values(), newer['entries'].values()):
+            merged = bucket['entries'].get(entry['key'])
+            if merged is None:
+                if len(bucket['entries']) >= self.max_entries:
+                    bucket['overflow'] += entry['events']
+                    continue
+                bucket['entries'][entry['key']] = dict(entry, users=list(entry['users']), tags=list(entry['tags']))
+                continue
+            merged['events'] += entry['events']
+            merged['commits'] += entry['commits']
+            merged['users'].extend(user for user in entry['users'] if user not in merged['users'])
+            del merged['users'][MAX_USERS:]
+            merged['tags'].extend(entry['tags'])
+            del merged['tags'][MAX_TAGS:]
+        return bucket
+
+    def add(self, event, channel=''):
+        summary = self.summarize(event)
+        with self.lock:
+            bucket = self.channels.get(channel)
+            if bucket is None:
+                bucket = self.channels[channel] = self.new_bucket()
+            self.dirty = True
+            self.merge(bucket, summary)
+
+    @property
+    def flush_on_stop(self):
+        """
+        Whether pending summaries must be delivered when stopping, not to be lost
+        """
+
+        return not self.snapshot
+
+    def render(self, bucket):
+        lines = ['#### GitLab digest since %s' % time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(bucket['since']))]
+
+        for entry in bucket['entries'].values():
+            if entry['kind'] == constants.TAG_EVENT:
+                summary = '%d tag%s %s' % (entry['events'], 's' if entry['events'] > 1 else '', ', '.join('`%s`' % tag for tag in entry['tags']))
+                if entry['events'] > len(entry['tags']):
+                    summary += '...'
+            elif entry['kind'] == constants.PUSH_EVENT:
+                summary = '%d push%s, %d commit%s' % (
+                    entry['events'], 'es' if entry['events'] > 1 else '',
+                    entry['commits'], 's' if entry['commits'] != 1 else '')
+            else:
+                summary = '%d %s event%s' % (entry['events'], entry['kind'], 's' if entry['events'] > 1 else '')
+
+            line = '* %s%s: %s' % (entry['project'], ' `%s`' % entry['ref'] if entry['ref'] else '', summary)
+            if entry['users']:
+                line += ' by %s' % ', '.join(entry['users'])
+            lines.append(line)
+
+        if bucket['overflow']:
+            lines.append('* _and %d more events_' % bucket['overflow'])
+
+        return '\n'.join(lines)
+
+    def flush(self):
+        """
+        Delivers the pending summaries, returns how many there were
+        """
+
+        with self.lock:
+            channels, self.channels = self.channels, {}
+            self.dirty = True
+
+        for channel, bucket in sorted(channels.items()):
+            try:
+                self.deliver(delivery.Message(self.render(bucket), object_kind='digest', channel=channel or None))
+            except Exception as exc:
+                print('Could not deliver digest, keeping it for the next one: %s' % exc)
+                with self.lock:
+                    newer = self.channels.get(channel)
+                    self.channels[channel] = bucket if newer is None else self.merge_bucket(bucket, newer)
+
+        self.save()
+        return len(channels)
+
+    def next_flush(self, now):
+        """
+        Flushes happen on multiples of the interval, e.g. on the hour for an interval of 3600
+        """
+
+        return (int(now // self.interval) + 1) * self.interval
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='digest')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.save()
+
+    def run(self):
+        flush_at = self.next_flush(time.time())
+        while not self.stopping.wait(max(min(self.save_interval, flush_at - time.time()), 0)):
+            if time.time() >= flush_at:
+                try:
+                    self.flush()
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                flush_at = self.next_flush(time.time())
+            else:
+                self.save()
+
+    def save(self):
+        if not self.snapshot:
+            return
+
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            data = json.dumps({
+                channel: {'since': bucket['since'], 'overflow': bucket['overflow'], 'entries': list(bucket['entries'].values())}
+                for channel, bucket in self.channels.items()
+            })
+
+        temporary = self.snapshot + '.tmp'
+        with io.open(temporary, 'wb') as fp:
+            fp.write(data.encode('utf-8'))
+        os.rename(temporary, self.snapshot)
+
+    def load(self):
+        if not self.snapshot or not os.path.exists(self.snapshot):
+            return
+
+        try:
+            with io.open(self.snapshot, encoding='utf-8') as fp:
+                data = json.load(fp)
+        except ValueError as exc:
+            print('Ignoring unreadable digest snapshot %s: %s' % (self.snapshot, exc))
+            return
+
+        for channel, bucket in data.items():
+            self.channels[channel] = {
+                'since': bucket['since'],
+                'overflow': bucket['overflow'],
+                'entries': collections.OrderedDict((entry['key'], entry) for entry in bucket['entries']),
+            }
+
+
+class SharedDigest(Digest):
+    """
+    Digest accumulated by every replica in a shared state backend, and delivered by only one
+
+    Replicas store the summary of each event, at most `max_events` per channel and interval,
+    further events are only counted. At each interval, the first replica to claim the flush
+    delivers the digests.
+    """
+
+    def __init__(self, deliver, state_backend, interval=900, max_entries=500, max_events=None):
+        super(SharedDigest, self).__init__(deliver, interval, max_entries)
+        self.state = state_backend
+        self.max_events = max_events or max_entries * 10
+        self.ids = itertools.count()
+        self.prefix = uuid.uuid4().hex
+
+    def add(self, event, channel=''):
+        summary = self.summarize(event)
+        summary['at'] = time.time()
+        # one transaction, so that a flush never sees an event counted but not summarised
+        self.state.batch([
+            ('incr', 'digest-count:' + channel, 1),
+            ('add', 'digest-since:' + channel, time.time()),
+            ('hash_update', 'digest-channels', {channel: True}),
+            ('hash_update', 'digest:' + channel, {'%s-%d' % (self.prefix, next(self.ids)): summary}, None, self.max_events),
+        ])
+
+    def flush(self):
+        """
+        Delivers the pending summaries if no other replica did for this interval, returns how many
+        there were
+        """
+
+        if not self.state.add('digest-flush:%d' % (time.time() // self.interval), self.prefix, self.interval * 2):
+            return 0
+
+        channels = self.state.hash_pop_all('digest-channels')
+        for channel in sorted(channels):
+            summaries, since, count = self.state.batch([
+                ('hash_pop_all', 'digest:' + channel),
+                ('pop', 'digest-since:' + channel),
+                ('pop', 'digest-count:' + channel),
+            ])
+            bucket = self.new_bucket(since)
+            for summary in sorted(summaries.values(), key=lambda summary: summary['at']):
+                self.merge(bucket, summary)
+            bucket['overflow'] += max((count or 0) - len(summaries), 0)
+
+            try:
+                self.deliver(delivery.Message(self.render(bucket), object_kind='digest', channel=channel or None))
+            except Exception as exc:
+                print('Could not deliver digest, keeping it for the next one: %s' % exc)
+                self.state.batch([
+                    ('hash_update', 'digest:' + channel, summaries),
+                    ('add', 'digest-since:' + channel, bucket['since']),
+                    ('incr', 'digest-count:' + channel, count or 0),
+                    ('hash_update', 'digest-channels', {channel: True}),
+                ])
+
+        return len(channels)
+
+    @property
+    def flush_on_stop(self):
+        # the other replicas will deliver it
+        return False
+
+    def save(self):
+        pass
+
+    def load(self):
+        pass
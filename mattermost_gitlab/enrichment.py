@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Data fetched from the GitLab API to complete the messages of events
+
+Payloads lack some of what messages show: the diff stats of merge requests, the status of the
+pipeline of a push, the name of assignees. Fetches start as soon as an event is selected and
+run in the background, while the event waits at most its deadline for them: data not fetched
+by then is left out, and the fetch completes for the next events. The data extracted from the
+responses is cached for a short ttl with their ETag, then revalidated, and concurrent fetches of
+the same path are shared.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import collections
+import threading
+import time
+
+# Third-party imports
+import requests
+from six.moves.urllib.parse import quote
+
+from . import constants
+
+
+class GitLabError(Exception):
+    pass
+
+
+class GitLabClient(object):
+    """
+    Minimal client of the GitLab REST API (v4), with a pool of connections shared by the fetches
+    """
+
+    def __init__(self, url, token, verify=True, timeout=5, pool_size=8):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.headers['PRIVATE-TOKEN'] = token
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, etag=None):
+        """
+        Returns the ETag and JSON body of a resource, or None as body if it matches `etag`
+        """
+
+        url = '%s/api/v4%s' % (self.url, path)
+        headers = {'If-None-Match': etag} if etag else {}
+        try:
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise GitLabError('Encountered error calling GitLab API %s: %s' % (url, exc))
+
+        if resp.status_code == 304:
+            return etag, None
+        if resp.status_code != 200:
+            raise GitLabError('Encountered error calling GitLab API %s, status=%d' % (url, resp.status_code))
+        return resp.headers.get('ETag'), resp.json()
+
+
+class Fetch(object):
+    """
+    GET of a path, shared by the events waiting for it, `value` is the data extracted from its
+    response once `done`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.value = None
+        self.done = threading.Event()
+
+
+class Enrichment(object):
+    """
+    Fetches started for an event, `wait` returns the data of those done before the deadline
+    """
+
+    def __init__(self, enricher, deadline, fields):
+        self.enricher = enricher
+        self.deadline = deadline
+        # (name, fetch)
+        self.fields = fields
+
+    def wait(self):
+        extra = {}
+        for name, fetch in self.fields:
+            if not fetch.done.wait(max(self.deadline - time.time(), 0)):
+                self.enricher.timeouts += 1
+            elif fetch.value is not None:
+                extra[name] = fetch.value
+        return extra
+
+
+def diff_stats(changes):
+    additions = deletions = 0
+    for change in changes['changes']:
+        for line in (change.get('diff') or '').splitlines():
+            if line.startswith('+') and not line.startswith('+++'):
+                additions += 1
+            elif line.startswith('-') and not line.startswith('---'):
+                deletions += 1
+    return {'files': len(changes['changes']), 'additions': additions, 'deletions': deletions}
+
+
+def latest_pipeline(pipelines):
+    if not pipelines:
+        return None
+    return dict((key, pipelines[0].get(key)) for key in ('id', 'status', 'web_url'))
+
+
+def display_name(user):
+    return user['name']
+
+
+def project_path(project_id):
+    return '/projects/%s' % quote(str(project_id), safe='')
+
+
+def fields_for(event):
+    """
+    Extra data of an event: (name, API path, function extracting the data from the response)
+    """
+
+    data = event.data
+    fields = []
+    if event.object_kind == constants.PUSH_EVENT:
+        if data.get('project_id') is not None and data.get('after', '0' * 40) != '0' * 40:
+            fields.append(('pipeline', '%s/pipelines?sha=%s&per_page=1' % (project_path(data['project_id']), data['after']), latest_pipeline))
+    elif event.object_kind in (constants.MERGE_EVENT, constants.ISSUE_EVENT):
+        attributes = data['object_attributes']
+        if event.object_kind == constants.MERGE_EVENT and event.action in ('open', 'reopen', 'update'):
+            fields.append(('diff_stats', '%s/merge_requests/%s/changes' % (project_path(attributes['target_project_id']), attributes['iid']), diff_stats))
+        if attributes.get('assignee_id'):
+            fields.append(('assignee', '/users/%s' % attributes['assignee_id'], display_name))
+    return fields
+
+
+class Enricher(object):
+    """
+    Cache and in-flight fetches of GitLab API responses
+
+    Only the data extracted from a response is cached, with its ETag, not the response itself
+    (e.g. the full diffs of a merge request). It is fresh for `ttl` seconds, then revalidated,
+    and at most `max_entries` paths are kept, least recently used ones being evicted first. At
+    most `max_fetches` fetches are in flight, further data is left out.
+    """
+
+    def __init__(self, max_entries=1000, ttl=60, max_fetches=8):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_fetches = max_fetches
+        # path: [etag, extracted data, fresh until]
+        self.cache = collections.OrderedDict()
+        self.fetches = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def start(self, event, client, timeout):
+        """
+        Starts fetching the extra data of an event, which `wait` returns within `timeout` seconds
+        """
+
+        deadline = time.time() + timeout
+        fields = []
+        for name, path, extract in fields_for(event):
+            fetch = self.fetch(client, path, extract)
+            if fetch is not None:
+                fields.append((name, fetch))
+        return Enrichment(self, deadline, fields)
+
+    def fetch(self, client, path, extract):
+        with self.lock:
+            entry = self.cache.pop(path, None)
+            if entry is not None:
+                self.cache[path] = entry
+                if entry[2] > time.time():
+                    self.hits += 1
+                    fetch = Fetch(path)
+                    fetch.value = entry[1]
+                    fetch.done.set()
+                    return fetch
+
+            fetch = self.fetches.get(path)
+            if fetch is not None:
+                self.coalesced += 1
+                return fetch
+            if len(self.fetches) >= self.max_fetches:
+                return None
+
+            fetch = self.fetches[path] = Fetch(path)
+        thread = threading.Thread(target=self.run, args=(fetch, client, extract, entry), name='gitlab-fetch')
+        thread.daemon = True
+        thread.start()
+        return fetch
+
+    def run(self, fetch, client, extract, entry):
+        failed = False
+        try:
+            etag, body = client.get(fetch.path, entry[0] if entry is not None else None)
+            modified = body is not None
+            # only the extracted data is kept, not the response
+            value = extract(body) if modified else entry[1]
+        except (KeyError, IndexError, TypeError, ValueError) as exc:
+            print('Unexpected GitLab API response for %s: %r' % (fetch.path, exc))
+            failed = True
+        except Exception as exc:
+            print(exc)
+            failed = True
+
+        with self.lock:
+            if failed:
+                self.errors += 1
+                value = None
+            else:
+                if modified:
+                    self.misses += 1
+                else:
+                    self.revalidated += 1
+                self.cache.pop(fetch.path, None)
+                self.cache[fetch.path] = [etag, value, time.time() + self.ttl]
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+            del self.fetches[fetch.path]
+        fetch.value = value
+        fetch.done.set()
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
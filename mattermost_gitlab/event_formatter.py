@@ -5,23 +5,27 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
 # Python System imports
+import collections
 import re
 
 from . import constants
 
 
+GITLAB_LINK_PATTERN = re.compile(r'(\[[^]]*\]\s*\((/[^)]+)\))')
+# @username in a comment or description, not part of an email address or a longer name
+MENTION_PATTERN = re.compile(r'(?<![\w@/.-])@([A-Za-z0-9_](?:[A-Za-z0-9_.-]*[A-Za-z0-9_])?)')
+
+
 def fix_gitlab_links(base_url, text):
     """
     Fixes gitlab upload links that are relative and makes them absolute
     """
 
-    matches = re.findall(r'(\[[^]]*\]\s*\((/[^)]+)\))', text)
-
-    for (replace_string, link) in matches:
-        new_string = replace_string.replace(link, base_url + link)
-        text = text.replace(replace_string, new_string)
+    def make_absolute(match):
+        replace_string, link = match.groups()
+        return replace_string.replace(link, base_url + link)
 
-    return text
+    return GITLAB_LINK_PATTERN.sub(make_absolute, text)
 
 
 def add_markdown_quotes(text):
@@ -40,8 +44,17 @@ def add_markdown_quotes(text):
     return '\n'.join(split_desc)
 
 
+def thread_key(project_id, noteable, iid):
+    return '%s:%s:%s' % (project_id, noteable, iid)
+
+
 class BaseEvent(object):
 
+    # Mattermost usernames of the GitLab users to @mention, by GitLab username, others are links
+    mentions = {}
+    # data fetched from the GitLab API, see enrichment
+    extra = {}
+
     def __init__(self, data):
         self.data = data
         self.object_kind = data['object_kind']
@@ -50,19 +63,142 @@ class BaseEvent(object):
     def push_event(self):
         raise NotImplementedError
 
+    @property
+    def action(self):
+        return None
+
+    @property
+    def project_id(self):
+        for container in (self.data, self.data.get('object_attributes') or {}):
+            for key in ('project_id', 'target_project_id'):
+                if container.get(key) is not None:
+                    return container[key]
+        return self.data.get('repository', {}).get('homepage')
+
+    @property
+    def ref(self):
+        """
+        Branch or tag name of the event, if any
+        """
+
+        ref = self.data.get('ref')
+        if ref:
+            for prefix in ('refs/heads/', 'refs/tags/'):
+                if ref.startswith(prefix):
+                    return ref[len(prefix):]
+        return ref
+
+    @property
+    def timestamp(self):
+        """
+        Time of the event in GitLab, as found in the payload, if any
+        """
+
+        attributes = self.data.get('object_attributes') or {}
+        return attributes.get('updated_at') or attributes.get('created_at')
+
+    @property
+    def project_path(self):
+        """
+        Namespaced path of the project, like `group/project`
+        """
+
+        project = self.data.get('project') or {}
+        if project.get('path_with_namespace'):
+            return project['path_with_namespace']
+        homepage = self.data.get('repository', {}).get('homepage') or ''
+        return '/'.join(homepage.split('/')[-2:])
+
+    @property
+    def author(self):
+        """
+        Username of the user who triggered the event, or their name when the payload lacks it
+        """
+
+        user = self.data.get('user')
+        if isinstance(user, dict):
+            return user.get('username') or user.get('name')
+        return self.data.get('user_username') or self.data.get('user_name')
+
     def should_report_event(self, report_events):
         return report_events[self.object_kind]
 
     def format(self):
         raise NotImplementedError
 
+    @property
+    def project_link(self):
+        """
+        Markdown link to the project of the event
+        """
+
+        return '[%s](%s)' % (self.data['repository']['name'], self.data['repository']['homepage'])
+
     def gitlab_user_url(self, username):
         base_url = '/'.join(self.data['repository']['homepage'].split('/')[:-2])
         return '{}/u/{}'.format(base_url, username)
 
+    @property
+    def mentioned_usernames(self):
+        """
+        GitLab usernames which the event may @mention in Mattermost
+        """
+
+        return []
+
+    @property
+    def thread_key(self):
+        """
+        `<project>:<issue|merge_request>:<iid>` of the issue or merge request the event is about,
+        whose events can be posted in the same thread, None for other events
+        """
+
+        return None
+
+    def user_reference(self, username):
+        """
+        @mention of a GitLab user if resolved, a link to their GitLab profile otherwise
+        """
+
+        if username in self.mentions:
+            return '@' + self.mentions[username]
+        return '[%s](%s)' % (username, self.gitlab_user_url(username))
+
+    def format_extra(self):
+        """
+        Lines showing the data fetched from the GitLab API, if any
+        """
+
+        lines = []
+        pipeline = self.extra.get('pipeline')
+        if pipeline:
+            lines.append('%s [Pipeline #%s](%s) %s' % (
+                JOB_STATUS_ICONS.get(pipeline['status'], ':grey_question:'), pipeline['id'], pipeline['web_url'], pipeline['status']))
+        stats = self.extra.get('diff_stats')
+        if stats:
+            lines.append('%d file%s changed, +%d -%d' % (stats['files'], '' if stats['files'] == 1 else 's', stats['additions'], stats['deletions']))
+        if self.extra.get('assignee'):
+            lines.append('Assigned to %s' % self.extra['assignee'])
+        return ''.join('\n' + line for line in lines)
+
+    def add_mentions(self, text):
+        """
+        Rewrites the @usernames of GitLab users with a different Mattermost username
+        """
+
+        if not self.mentions or not text:
+            return text
+        return MENTION_PATTERN.sub(lambda match: '@' + self.mentions.get(match.group(1), match.group(1)), text)
+
 
 class PushEvent(BaseEvent):
 
+    @property
+    def timestamp(self):
+        # pushes are not dated, and the dates of their commits are those of their authoring,
+        # days or months earlier for rebased or cherry-picked commits
+        return None
+
     def format(self):
 
         if self.data['before'] == '0' * 40:
@@ -76,23 +212,26 @@ class PushEvent(BaseEvent):
         if len(self.data['commits']) > 0:
             suffix = ':\n'
 
-        text = '%s pushed %s into the `%s` branch for project [%s](%s)%s' % (
+        text = '%s pushed %s into the `%s` branch for project %s%s' % (
             self.data['user_name'],
             description,
             self.data['ref'],
-            self.data['repository']['name'],
-            self.data['repository']['homepage'],
+            self.project_link,
             suffix
         )
         for val in self.data['commits']:
             header = val['message'].splitlines()[0]
             text += "* [%s](%s)\n" % (header, val['url'])
 
-        return text
+        return text + self.format_extra()
 
 
 class IssueEvent(BaseEvent):
 
+    @property
+    def thread_key(self):
+        return thread_key(self.project_id, 'issue', self.data['object_attributes']['iid'])
+
     @property
     def action(self):
         return self.data['object_attributes']['action']
@@ -114,36 +253,47 @@ class IssueEvent(BaseEvent):
         else:
             raise NotImplementedError("Unsupported action %s for issue event" % self.action)
 
-        text = '#### [%s](%s)\n*[Issue #%s](%s) %s by %s in [%s](%s) on [%s](%s)*\n %s' % (
+        text = '#### [%s](%s)\n*[Issue #%s](%s) %s by %s in %s on [%s](%s)*\n %s' % (
             self.data['object_attributes']['title'],
             self.data['object_attributes']['url'],
             self.data['object_attributes']['iid'],
             self.data['object_attributes']['url'],
             verbose_action,
             self.data['user']['username'],
-            self.data['repository']['name'],
-            self.data['repository']['homepage'],
+            self.project_link,
             self.data['object_attributes']['created_at'],
             self.data['object_attributes']['url'],
             description
         )
 
-        base_url = self.data['repository']['homepage']
-
-        return fix_gitlab_links(base_url, text)
+        return fix_gitlab_links(self.data['repository']['homepage'], text) + self.format_extra()
 
 
 class TagEvent(BaseEvent):
     def format(self):
-        return '%s pushed tag `%s` to the project [%s](%s).' % (
+        return '%s pushed tag `%s` to the project %s.' % (
             self.data['user_name'],
             self.data['ref'],
-            self.data['repository']['name'],
-            self.data['repository']['homepage']
+            self.project_link
         )
 
 
 class NoteEvent(BaseEvent):
+
+    # noteable types which have threads, and the key of their attributes in the payload
+    THREADED_NOTEABLES = {'Issue': 'issue', 'MergeRequest': 'merge_request'}
+
+    @property
+    def thread_key(self):
+        noteable = self.THREADED_NOTEABLES.get(self.data['object_attributes']['noteable_type'])
+        if noteable is None or not self.data.get(noteable):
+            return None
+        return thread_key(self.project_id, noteable, self.data[noteable]['iid'])
+
+    @property
+    def mentioned_usernames(self):
+        return [self.data['user']['username']] + MENTION_PATTERN.findall(self.data['object_attributes']['note'] or '')
+
     def format(self):
         symbol = ''
         type_grammar = 'a'
@@ -172,33 +322,37 @@ class NoteEvent(BaseEvent):
         else:
             subtitle = '%s%s - %s' % (symbol, note_id, parent_title)
 
-        description = add_markdown_quotes(self.data['object_attributes']['note'])
+        description = add_markdown_quotes(self.add_mentions(self.data['object_attributes']['note']))
 
-        text = '#### **New Comment** on [%s](%s)\n*[%s](%s) commented on %s %s in [%s](%s) on [%s](%s)*\n %s' % (
+        text = '#### **New Comment** on [%s](%s)\n*%s commented on %s %s in %s on [%s](%s)*\n %s' % (
             subtitle,
             self.data['object_attributes']['url'],
-            self.data['user']['username'],
-            self.gitlab_user_url(self.data['user']['username']),
+            self.user_reference(self.data['user']['username']),
             type_grammar,
             note_type,
-            self.data['repository']['name'],
-            self.data['repository']['homepage'],
+            self.project_link,
             self.data['object_attributes']['created_at'],
             self.data['object_attributes']['url'],
             description
         )
 
-        base_url = self.data['repository']['homepage']
-
-        return fix_gitlab_links(base_url, text)
+        return fix_gitlab_links(self.data['repository']['homepage'], text)
 
 
 class MergeEvent(BaseEvent):
 
+    @property
+    def thread_key(self):
+        return thread_key(self.project_id, 'merge_request', self.data['object_attributes']['iid'])
+
     @property
     def action(self):
         return self.data['object_attributes']['action']
 
+    @property
+    def mentioned_usernames(self):
+        return [self.data['user']['username']] + MENTION_PATTERN.findall(self.data['object_attributes']['description'] or '')
+
     def format(self):
 
         if self.action == 'open':
@@ -214,12 +368,11 @@ class MergeEvent(BaseEvent):
         else:
             raise NotImplementedError('Unsupported action %s for merge event' % self.action)
 
-        text = '#### [!%s - %s](%s)\n*[%s](%s) %s merge request in [%s](%s) on [%s](%s)*' % (
+        text = '#### [!%s - %s](%s)\n*%s %s merge request in [%s](%s) on [%s](%s)*' % (
             self.data['object_attributes']['iid'],
             self.data['object_attributes']['title'],
             self.data['object_attributes']['url'],
-            self.data['user']['username'],
-            self.gitlab_user_url(self.data['user']['username']),
+            self.user_reference(self.data['user']['username']),
             text_action,
             self.data['object_attributes']['target']['name'],
             self.data['object_attributes']['target']['web_url'],
@@ -228,7 +381,7 @@ class MergeEvent(BaseEvent):
         )
 
         if self.action == 'open':
-            description = add_markdown_quotes(self.data['object_attributes']['description'])
+            description = add_markdown_quotes(self.add_mentions(self.data['object_attributes']['description']))
             text = '%s\n %s' % (
                 text,
                 description
@@ -236,7 +389,7 @@ class MergeEvent(BaseEvent):
 
         base_url = self.data['object_attributes']['target']['web_url']
 
-        return fix_gitlab_links(base_url, text)
+        return fix_gitlab_links(base_url, text) + self.format_extra()
 
 
 class CIEvent(BaseEvent):
@@ -248,12 +401,40 @@ class CIEvent(BaseEvent):
 
     def __init__(self, data):
         self.data = data
-        self.object_kind = "ci"
+        # payloads of the former GitLab CI service lack an object_kind
+        self.object_kind = constants.BUILD_EVENT
+
+    @property
+    def action(self):
+        return self.data['build_status']
+
+    @property
+    def timestamp(self):
+        # builds which are not finished are only dated by their start
+        return self.data.get('build_finished_at')
+
+    @property
+    def homepage(self):
+        return self.data.get('gitlab_url', self.data.get('repository', {}).get('homepage'))
+
+    @property
+    def job(self):
+        """
+        State of the job, as listed by format_job_matrix
+        """
+
+        return {
+            'id': self.data['build_id'],
+            'stage': self.data['build_stage'],
+            'name': self.data['build_name'],
+            'status': self.data['build_status'],
+            'url': '%s/builds/%s' % (self.homepage, self.data['build_id']),
+        }
 
     def format(self):
 
         icon = self.icons.get(self.data['build_status'], '')
-        homepage = self.data.get('gitlab_url', self.data.get('repository', {}).get('homepage'))
+        homepage = self.homepage
         build_url = '%s/builds/%s' % (homepage, self.data['build_id'])
         return '%s%s [build %s/%s](%s) for the project [%s](%s) on commit %s.' % (
             (icon + ' ') if icon else '',
@@ -267,6 +448,125 @@ class CIEvent(BaseEvent):
         )
 
 
+JOB_STATUS_ICONS = {
+    'created': ':white_circle:',
+    'pending': ':clock3:',
+    'running': ':arrow_forward:',
+    'success': ':white_check_mark:',
+    'failed': ':x:',
+    'canceled': ':no_entry_sign:',
+    'skipped': ':fast_forward:',
+    'manual': ':raised_hand:',
+}
+
+
+def overall_status(statuses):
+    """
+    Status of a pipeline according to the status of its jobs
+    """
+
+    statuses = set(statuses)
+    for status in ('failed', 'running', 'pending', 'created', 'manual', 'canceled'):
+        if status in statuses:
+            return status
+    return 'success' if statuses else 'created'
+
+
+def format_job_matrix(project_name, homepage, sha, ref, jobs, status=None, title='Pipeline'):
+    """
+    One line per stage, listing the status of its jobs. `jobs` is an ordered list of job states
+    (dicts with stage, name, status and url), the pipeline status is derived from them if not given
+    """
+
+    status = status or overall_status(job['status'] for job in jobs)
+    lines = ['%s %s %s for the project [%s](%s) on commit %s%s.' % (
+        JOB_STATUS_ICONS.get(status, ':grey_question:'),
+        status.title(),
+        title,
+        project_name,
+        homepage,
+        sha,
+        ' (`%s`)' % ref if ref else '',
+    )]
+
+    stages = collections.OrderedDict()
+    for job in jobs:
+        stages.setdefault(job['stage'], []).append(job)
+    for stage, stage_jobs in stages.items():
+        lines.append('* **%s**: %s' % (stage, ' '.join(
+            '%s [%s](%s)' % (JOB_STATUS_ICONS.get(job['status'], ':grey_question:'), job['name'], job['url']) if job.get('url')
+            else '%s %s' % (JOB_STATUS_ICONS.get(job['status'], ':grey_question:'), job['name'])
+            for job in stage_jobs
+        )))
+
+    return '\n'.join(lines)
+
+
+class PipelineEvent(BaseEvent):
+    """
+    Status of a whole pipeline, with the state of every job
+    """
+
+    @property
+    def action(self):
+        return self.data['object_attributes']['status']
+
+    @property
+    def timestamp(self):
+        # the creation of a running pipeline would count its whole runtime as lag
+        attributes = self.data['object_attributes']
+        return attributes.get('updated_at') or attributes.get('finished_at')
+
+    @property
+    def project_id(self):
+        project = self.data['project']
+        return project.get('id') or project['web_url']
+
+    @property
+    def ref(self):
+        return self.data['object_attributes']['ref']
+
+    @property
+    def project_link(self):
+        return '[%s](%s)' % (self.data['project']['name'], self.data['project']['web_url'])
+
+    @property
+    def jobs(self):
+        """
+        Job states as listed by format_job_matrix, by stage then creation order
+        """
+
+        homepage = self.data['project']['web_url']
+        stages = self.data['object_attributes'].get('stages') or []
+        builds = sorted(
+            self.data.get('builds') or [],
+            key=lambda build: (stages.index(build['stage']) if build['stage'] in stages else len(stages), build['id']),
+        )
+        return [
+            {
+                'id': build['id'],
+                'stage': build['stage'],
+                'name': build['name'],
+                'status': build['status'],
+                'url': '%s/builds/%s' % (homepage, build['id']),
+            }
+            for build in builds
+        ]
+
+    def format(self):
+        attributes = self.data['object_attributes']
+        homepage = self.data['project']['web_url']
+        return format_job_matrix(
+            self.data['project'].get('path_with_namespace') or self.data['project']['name'],
+            homepage,
+            attributes['sha'],
+            attributes['ref'],
+            self.jobs,
+            status=attributes['status'],
+            title='[Pipeline #%s](%s/pipelines/%s)' % (attributes['id'], homepage, attributes['id']),
+        )
+
+
 EVENT_CLASS_MAP = {
     constants.PUSH_EVENT: PushEvent,
     constants.ISSUE_EVENT: IssueEvent,
@@ -274,6 +574,7 @@ EVENT_CLASS_MAP = {
     constants.COMMENT_EVENT: NoteEvent,
     constants.MERGE_EVENT: MergeEvent,
     constants.BUILD_EVENT: CIEvent,
+    constants.CI_EVENT: PipelineEvent,
 }
 
 
@@ -282,3 +583,13 @@ def as_event(data):
         return EVENT_CLASS_MAP[data['object_kind']](data)
     else:
         raise NotImplementedError('Unsupported event of type %s' % data['object_kind'])
+
+
+def as_ci_event(data):
+    """
+    Events sent to the CI endpoint: pipelines, or builds, whose payload may lack an object_kind
+    """
+
+    if data.get('object_kind') == constants.CI_EVENT:
+        return PipelineEvent(data)
+    return CIEvent(data)
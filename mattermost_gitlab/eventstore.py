@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local store of the events posted, to answer questions like "what did this project emit in the
+last hour?" or "which merge requests were merged today?"
+
+The normalised fields of each event are recorded in an SQLite database in WAL mode, indexed by
+project, kind, author and time. Events are queued by the request and written in batches by a
+background thread, so that recording adds little to the handling of a webhook; when the writer
+falls behind, further events are dropped rather than delaying GitLab. Events recorded longer
+than the retention ago are pruned as new ones are written.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import sqlite3
+import threading
+import time
+
+# Third-party imports
+from six.moves import queue
+
+from . import lag
+
+
+FIELDS = ('time', 'received_at', 'object_kind', 'action', 'project_id', 'project', 'author', 'ref', 'iid', 'title', 'url')
+
+
+def normalise(event, received_at):
+    """
+    Row of an event: its time in GitLab, or when received for events without a reliable time of
+    their own (pushes, tags, running pipelines), kind, action, project, author...
+    """
+
+    attributes = event.data.get('object_attributes') or {}
+    event_time = lag.parse_timestamp(event.timestamp)
+    project_id = event.project_id
+    return (
+        event_time if event_time is not None else received_at,
+        received_at,
+        event.object_kind,
+        event.action,
+        str(project_id) if project_id is not None else None,
+        event.project_path or None,
+        event.author,
+        event.ref,
+        attributes.get('iid'),
+        attributes.get('title'),
+        attributes.get('url'),
+    )
+
+
+class EventStore(object):
+    """
+    Events in an SQLite database, kept `retention` seconds
+
+    A background thread writes the events queued since its last write in one transaction, up
+    to `batch_size` of them, so that batches grow with the load. At most `max_pending` events
+    wait for it, further ones are dropped and counted.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, time REAL NOT NULL, received_at REAL NOT NULL, object_kind TEXT NOT NULL, '
+        'action TEXT, project_id TEXT, project TEXT, author TEXT, ref TEXT, iid INTEGER, title TEXT, url TEXT)',
+        'CREATE INDEX IF NOT EXISTS events_time ON events (time)',
+        'CREATE INDEX IF NOT EXISTS events_received_at ON events (received_at)',
+        'CREATE INDEX IF NOT EXISTS events_project ON events (project, time)',
+        'CREATE INDEX IF NOT EXISTS events_project_id ON events (project_id, time)',
+        'CREATE INDEX IF NOT EXISTS events_kind ON events (object_kind, time)',
+        'CREATE INDEX IF NOT EXISTS events_author ON events (author, time)',
+    )
+    INSERT = 'INSERT INTO events (%s) VALUES (%s)' % (', '.join(FIELDS), ', '.join('?' * len(FIELDS)))
+
+    def __init__(self, path, retention=30 * 86400, batch_size=500, poll_interval=1.0, max_pending=10000, prune_interval=60, timeout=5.0):
+        self.path = path
+        self.retention = retention
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+        self.timeout = timeout
+        self.pending = queue.Queue(max_pending)
+        self.local = threading.local()
+        self.thread = None
+        self.stopped = False
+        self.pruned_at = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.pruned = 0
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.work, name='event-store')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Writes the pending events and stops the writer
+        """
+
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def record(self, event, received_at=None):
+        """
+        Queues an event for the writer, returns whether it was queued
+        """
+
+        try:
+            self.pending.put_nowait(normalise(event, received_at or time.time()))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout=None):
+        """
+        Waits until the events queued so far are written
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def take_batch(self):
+        try:
+            rows = [self.pending.get(timeout=self.poll_interval)]
+        except queue.Empty:
+            return []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def work(self):
+        while not (self.stopped and self.pending.empty()):
+            rows = self.take_batch()
+            try:
+                if rows:
+                    self.write(rows)
+                if time.time() - self.pruned_at > self.prune_interval:
+                    self.prune()
+            except sqlite3.Error as exc:
+                print('Could not record %d events: %s' % (len(rows), exc))
+            finally:
+                for __ in rows:
+                    self.pending.task_done()
+        self.close()
+
+    def write(self, rows):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(self.INSERT, rows)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.recorded += len(rows)
+
+    def prune(self, now=None):
+        """
+        Removes the events recorded longer than the retention ago, whatever their time in GitLab
+        """
+
+        now = now or time.time()
+        self.pruned_at = now
+        if self.retention:
+            self.pruned += self.connection().execute('DELETE FROM events WHERE received_at < ?', (now - self.retention,)).rowcount
+
+    def query(self, project=None, object_kind=None, action=None, author=None, ref=None, since=None, until=None, limit=100):
+        """
+        Events, newest first, of a project (path or id), kind, action, author and ref, between
+        two times
+        """
+
+        conditions, params = [], []
+        if project is not None:
+            conditions.append('project_id = ?' if project.isdigit() else 'project = ?')
+            params.append(project)
+        for condition, value in (('object_kind = ?', object_kind), ('action = ?', action), ('author = ?', author), ('ref = ?', ref),
+                                 ('time >= ?', since), ('time < ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        clause = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        rows = self.connection().execute('SELECT %s FROM events%s ORDER BY time DESC LIMIT ?' % (', '.join(FIELDS), clause), params + [limit])
+        return [dict(zip(FIELDS, row)) for row in rows]
+
+    def stats(self):
+        return {
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'pruned': self.pruned,
+            'pending': self.pending.qsize(),
+        }
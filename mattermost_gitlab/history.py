@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recent webhooks, to see what GitLab sent when a message renders wrongly or goes missing
+
+The raw payloads of the last webhooks are kept compressed, with their outcome and timings,
+within a fixed number of entries and bytes: the oldest ones are evicted first. Payloads are
+compressed by a background thread, so that recording a webhook costs its request no more than
+appending to a list.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import collections
+import itertools
+import json
+import threading
+import time
+import zlib
+
+
+# Outcomes of a webhook
+RECEIVED = 'received'
+INVALID = 'invalid'
+FILTERED = 'filtered'
+DIGESTED = 'digested'
+FORMATTED = 'formatted'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+# Estimated bytes used by an entry besides its payload, counted against the limit
+ENTRY_OVERHEAD = 512
+
+
+class Entry(object):
+    """
+    A webhook: its compressed payload, outcome, error and timings in milliseconds
+
+    Until the payload is compressed, `raw` holds it as received.
+    """
+
+    __slots__ = ('id', 'time', 'endpoint', 'object_kind', 'payload', 'raw', 'size', 'outcome', 'error', 'timings')
+
+    def __init__(self, id, endpoint, raw, size):
+        self.id = id
+        self.time = time.time()
+        self.endpoint = endpoint
+        self.object_kind = None
+        self.payload = None
+        self.raw = raw
+        self.size = size
+        self.outcome = RECEIVED
+        self.error = None
+        self.timings = {}
+
+    @property
+    def cost(self):
+        return len(self.payload or b'') + ENTRY_OVERHEAD
+
+    def data(self):
+        """
+        The payload as sent by GitLab, its text if it is not JSON, None if it was too big to keep
+        """
+
+        raw = self.raw
+        if raw is None:
+            if self.payload is None:
+                return None
+            raw = zlib.decompress(self.payload)
+        text = raw.decode('utf-8', 'replace')
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'time': self.time,
+            'endpoint': self.endpoint,
+            'object_kind': self.object_kind,
+            'size': self.size,
+            'compressed_size': len(self.payload) if self.payload is not None else None,
+            'outcome': self.outcome,
+            'error': self.error,
+            'timings': dict(self.timings),
+        }
+
+
+class WebhookHistory(object):
+    """
+    Ring buffer of the last `max_entries` webhooks, using at most `max_bytes` bytes
+
+    Payloads are compressed with the fastest zlib level by a background thread, started with
+    the first webhook, and count against `max_bytes` once compressed. Those waiting for it may
+    use another `max_bytes`: beyond that, or when too big to fit on its own once compressed,
+    a payload is left out of its entry.
+    """
+
+    def __init__(self, max_entries=100, max_bytes=2 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.deque()
+        self.bytes = 0
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # entries whose payload is not compressed yet, and its size
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.compressor = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, endpoint, body):
+        """
+        Adds the raw body of a webhook, returns its entry, or None when the history is disabled
+        """
+
+        if self.max_entries <= 0:
+            return None
+
+        with self.lock:
+            raw = body if self.pending_bytes + len(body) <= self.max_bytes else None
+            entry = Entry(next(self.ids), endpoint, raw, len(body))
+            if raw is not None:
+                self.pending.append(entry)
+                self.pending_bytes += len(body)
+                self.changed.notify_all()
+                if self.compressor is None:
+                    self.compressor = threading.Thread(target=self.compress, name='webhook-history')
+                    self.compressor.daemon = True
+                    self.compressor.start()
+            self.entries.append(entry)
+            self.bytes += entry.cost
+            self.evict()
+        return entry
+
+    def evict(self):
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            entry = self.entries.popleft()
+            self.bytes -= entry.cost
+            if entry.raw is not None:
+                self.pending_bytes -= len(entry.raw)
+                entry.raw = None
+
+    def compress(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.changed.wait()
+                entry = self.pending[0]
+                body = entry.raw
+            payload = zlib.compress(body, 1) if body is not None else None
+
+            with self.lock:
+                self.pending.popleft()
+                # unless evicted meanwhile
+                if body is not None and entry.raw is body:
+                    self.pending_bytes -= len(body)
+                    entry.raw = None
+                    if len(payload) + ENTRY_OVERHEAD <= self.max_bytes:
+                        entry.payload = payload
+                        self.bytes += len(payload)
+                        self.evict()
+                self.changed.notify_all()
+
+    def wait_compressed(self, timeout=5):
+        """
+        Waits at most `timeout` seconds for the payloads recorded so far to be compressed,
+        returns whether they were
+        """
+
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.pending and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+            return not self.pending
+
+    def get(self, id):
+        with self.lock:
+            for entry in self.entries:
+                if entry.id == id:
+                    return entry
+        return None
+
+    def list(self, outcome=None, object_kind=None):
+        """
+        Entries, newest first, optionally of an outcome and a kind of event
+        """
+
+        with self.lock:
+            entries = list(self.entries)
+        return [
+            entry for entry in reversed(entries)
+            if (outcome is None or entry.outcome == outcome) and (object_kind is None or entry.object_kind == object_kind)
+        ]
+
+
+def set_outcome(entry, outcome, error=None, **timings):
+    """
+    Sets the outcome of a webhook, if recorded, along with timings in milliseconds
+    """
+
+    if entry is not None:
+        entry.outcome = outcome
+        entry.error = error
+        entry.timings.update(timings)
+
+
+def set_message_outcome(message, outcome, error=None, **timings):
+    """
+    Sets the outcome of the webhook of a message, or of the parts of a batch
+    """
+
+    for part in getattr(message, 'parts', [message]):
+        set_outcome(getattr(part, 'history_entry', None), outcome, error, **timings)
+
+
+def describe(exc):
+    return '%s: %s' % (exc.__class__.__name__, exc)
+
+
+def elapsed_ms(start):
+    return round((time.time() - start) * 1000, 3)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Lag of the messages: time from the event in GitLab, according to the timestamp of its payload,
+to the acknowledgement of the message by Mattermost
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import bisect
+import calendar
+import collections
+import re
+import threading
+import time
+
+
+# GitLab timestamps: "2016-12-16 18:13:26 UTC", "2016-12-16T18:13:26+00:00",
+# "2016-12-16T18:13:26.123Z", "2016-12-16 18:13:26 +0100"
+TIMESTAMP_PATTERN = re.compile(
+    r'(\d{4}-\d\d-\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d+))?\s*(Z|UTC|[+-]\d\d:?\d\d)?$'
+)
+
+# Epoch of midnight UTC by date, dates being shared by most timestamps of a period
+day_starts = {}
+
+
+def parse_timestamp(value):
+    """
+    Seconds since the epoch of a GitLab timestamp, None if missing or not understood
+    """
+
+    if not value:
+        return None
+    match = TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        return None
+
+    date, hours, minutes, seconds, fraction, zone = match.groups()
+    day_start = day_starts.get(date)
+    if day_start is None:
+        if len(day_starts) > 1000:
+            day_starts.clear()
+        day_start = day_starts[date] = calendar.timegm(time.strptime(date, '%Y-%m-%d'))
+
+    timestamp = day_start + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    if fraction:
+        timestamp += float('0.' + fraction)
+    if zone and zone not in ('Z', 'UTC'):
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        timestamp += -offset if zone[0] == '+' else offset
+    return timestamp
+
+
+# Upper bounds of the histogram buckets, in seconds, the last bucket counting the others
+BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Histogram(object):
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'count': self.count, 'sum': round(self.sum, 3)}
+
+
+class LagTracker(object):
+    """
+    Histograms of the lag by kind of event and by project, and maximum lag of the last `window`
+    seconds
+
+    At most `max_projects` projects get their own histogram, later ones are counted as 'other'.
+    """
+
+    def __init__(self, max_projects=500, window=60):
+        self.max_projects = max_projects
+        self.window = window
+        self.kinds = collections.defaultdict(Histogram)
+        self.projects = {}
+        # (second, maximum lag of the messages acknowledged during that second)
+        self.recent = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, object_kind, project, lag, now=None):
+        now = now or time.time()
+        lag = max(lag, 0)
+        second = int(now)
+        project = str(project)
+        with self.lock:
+            self.kinds[object_kind].add(lag)
+            histogram = self.projects.get(project)
+            if histogram is None:
+                if len(self.projects) >= self.max_projects:
+                    project = 'other'
+                histogram = self.projects.setdefault(project, Histogram())
+            histogram.add(lag)
+
+            if self.recent and self.recent[-1][0] == second:
+                if lag > self.recent[-1][1]:
+                    self.recent[-1] = (second, lag)
+            else:
+                self.recent.append((second, lag))
+
+    def record_message(self, message, now=None):
+        """
+        Records the lag of a message acknowledged by Mattermost, or of the parts of a batch
+        """
+
+        now = now or time.time()
+        for part in getattr(message, 'parts', [message]):
+            if part.event_time is not None:
+                self.record(part.object_kind, part.project, now - part.event_time, now)
+
+    def max_lag(self, now=None):
+        since = int(now or time.time()) - self.window
+        with self.lock:
+            return max([lag for second, lag in self.recent if second > since] or [None])
+
+    def stats(self, now=None):
+        max_lag = self.max_lag(now)
+        with self.lock:
+            return {
+                'buckets': list(BUCKETS),
+                'max_lag': round(max_lag, 3) if max_lag is not None else None,
+                'window': self.window,
+                'object_kinds': dict((kind, histogram.to_dict()) for kind, histogram in self.kinds.items()),
+                'projects': dict((project, histogram.to_dict()) for project, histogram in self.projects.items()),
+            }
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import collections
+import json
+import threading
+import time
+
+# Third-party imports
+import requests
+
+from . import constants, event_formatter, state
+from .delivery import DeliveryError, parse_retry_after
+
+
+# Error of Mattermost when replying to a post which does not exist, or is itself a reply
+ROOT_NOT_FOUND = 'api.post.create_post.root_id.app_error'
+
+
+def error_id(resp):
+    """
+    Id of the error of a Mattermost API response, if any
+    """
+
+    try:
+        return resp.json().get('id')
+    except (ValueError, AttributeError):
+        return None
+
+
+class MattermostClient(object):
+    """
+    Minimal client of the Mattermost REST API (v4), authenticated with a bot token
+    """
+
+    def __init__(self, url, token, verify=True, timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.headers.update({
+            'Authorization': 'Bearer %s' % token,
+            'Content-Type': 'application/json',
+        })
+
+    def request(self, method, path, data=None):
+        url = '%s/api/v4%s' % (self.url, path)
+        try:
+            resp = self.session.request(method, url, data=json.dumps(data) if data is not None else None, timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise DeliveryError('Encountered error calling Mattermost API %s: %s' % (url, exc))
+
+        if resp.status_code == 404:
+            raise PostNotFound('Mattermost API %s %s: not found' % (method, url), status=404)
+        if resp.status_code == 400 and error_id(resp) == ROOT_NOT_FOUND:
+            raise PostNotFound('Mattermost API %s %s: root post not found' % (method, url), status=400)
+        if resp.status_code >= 300:
+            raise DeliveryError(
+                'Encountered error calling Mattermost API %s %s, status=%d, response_body=%s' % (method, url, resp.status_code, resp.text),
+                parse_retry_after(resp.headers.get('Retry-After')),
+                resp.status_code,
+            )
+        return resp.json()
+
+    def create_post(self, channel_id, message, root_id=None):
+        data = {'channel_id': channel_id, 'message': message}
+        if root_id:
+            data['root_id'] = root_id
+        return self.request('POST', '/posts', data)
+
+    def patch_post(self, post_id, message):
+        return self.request('PUT', '/posts/%s/patch' % post_id, {'message': message})
+
+    def existing_usernames(self, usernames):
+        """
+        Those of the usernames which belong to active users, in a single request
+        """
+
+        users = self.request('POST', '/users/usernames', list(usernames))
+        return [user['username'] for user in users if not user.get('delete_at')]
+
+
+class PostNotFound(DeliveryError):
+    pass
+
+
+class PipelinePosts(object):
+    """
+    Index of the post showing the jobs of each (project, sha), or of each pipeline, in a state
+    backend shared by the replicas of the service
+
+    Job states are recorded as events arrive, and the post is created by the first delivery and
+    patched by the next ones, always with the latest state so that deliveries running late or
+    out of order do not show stale jobs. Entries expire `ttl` seconds after their last update,
+    the default memory backend also keeps at most `max_entries` of them.
+
+    A replica creating a post claims it first, the others wait up to `claim_timeout` seconds
+    for its id before giving up with a DeliveryError, to be retried.
+    """
+
+    PENDING = ''
+    # state keys per post: its id, its jobs and the text of pipeline events
+    KEYS_PER_ENTRY = 3
+
+    def __init__(self, state_backend=None, max_entries=1000, max_jobs=200, ttl=7 * 24 * 3600, claim_timeout=2, stripes=64):
+        self.state = state_backend or state.MemoryBackend(max_keys=max_entries * self.KEYS_PER_ENTRY)
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        # deliveries of the same post are serialised within a process
+        self.locks = [threading.Lock() for __ in range(stripes)]
+
+    @staticmethod
+    def key(event):
+        if event.object_kind == constants.CI_EVENT:
+            return '%s:pipeline:%s' % (event.project_id, event.data['object_attributes']['id'])
+        return '%s:%s' % (event.project_id, event.data['sha'])
+
+    def lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def render(self, fields):
+        commit = fields.pop('commit')
+        jobs = sorted(fields.values(), key=lambda job: job['id'])[:self.max_jobs]
+        return event_formatter.format_job_matrix(commit['project_name'], commit['homepage'], commit['sha'], commit['ref'], jobs)
+
+    def record(self, event):
+        """
+        Records the job of a build event, or the jobs of a pipeline event, returns the key of
+        their post and the text showing all the jobs
+        """
+
+        key = self.key(event)
+        if event.object_kind == constants.CI_EVENT:
+            # pipeline events carry the state of every job
+            text = event.format()
+            self.state.set('text:' + key, text, self.ttl)
+            return key, text
+
+        job = event.job
+        commit = {'project_name': event.data['project_name'], 'homepage': event.homepage, 'sha': event.data['sha'], 'ref': event.ref}
+        __, fields = self.state.batch([
+            ('hash_update', 'jobs:' + key, {'commit': commit, str(job['id']): job}, self.ttl),
+            ('hash_get', 'jobs:' + key),
+        ])
+        return key, self.render(fields)
+
+    def publish(self, client, channel_id, key, text):
+        """
+        Creates the post of `key`, or updates it if it exists
+
+        `text` is only used when the state of the jobs is unknown, e.g. for spooled messages.
+        """
+
+        with self.lock(key):
+            post_id, fields, latest = self.state.batch([('get', 'post:' + key), ('hash_get', 'jobs:' + key), ('get', 'text:' + key)])
+            if fields:
+                text = self.render(fields)
+            elif latest:
+                text = latest
+
+            if post_id == self.PENDING:
+                post_id = self.wait_for_post(key)
+            if post_id is not None:
+                try:
+                    client.patch_post(post_id, text)
+                    return post_id
+                except PostNotFound:
+                    # deleted in Mattermost, start a new one
+                    self.state.delete('post:' + key)
+
+            if not self.state.add('post:' + key, self.PENDING, self.claim_timeout * 2):
+                raise DeliveryError('Post of %s is being created by another replica' % key, retry_after=1)
+            try:
+                post_id = client.create_post(channel_id, text)['id']
+            except Exception:
+                self.state.delete('post:' + key)
+                raise
+            self.state.set('post:' + key, post_id, self.ttl)
+            return post_id
+
+    def wait_for_post(self, key):
+        deadline = time.time() + self.claim_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            post_id = self.state.get('post:' + key)
+            if post_id != self.PENDING:
+                return post_id
+        raise DeliveryError('Post of %s is being created by another replica' % key, retry_after=1)
+
+
+class ThreadPosts(object):
+    """
+    Index of the root post of the thread of each issue and merge request, by thread key
+    (`<project>:<issue|merge_request>:<iid>`), in a state backend shared by the replicas
+
+    The first event of an issue or merge request creates a post, the next ones reply to it.
+    The last `cache_size` root posts used are kept in an LRU in front of the backend, so that
+    most lookups cost no round trip. Entries expire `ttl` seconds after their last use, which
+    is written back at most every `refresh_interval` seconds. The server always gives it the
+    SQLite backend of --state-db, since a root post forgotten on restart would split its thread;
+    the default memory backend, keeping at most `max_entries` threads, is meant for tests.
+
+    As with PipelinePosts, a replica creating a root post claims it first, the others wait up
+    to `claim_timeout` seconds for its id before giving up with a DeliveryError, to be retried.
+    """
+
+    PENDING = ''
+
+    def __init__(self, state_backend=None, max_entries=10000, cache_size=1000, ttl=90 * 24 * 3600, refresh_interval=24 * 3600, claim_timeout=2,
+                 stripes=64):
+        self.state = state_backend or state.MemoryBackend(max_keys=max_entries)
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.claim_timeout = claim_timeout
+        # thread key: (root post id, last write to the backend)
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        # replies of the same thread are serialised within a process
+        self.locks = [threading.Lock() for __ in range(stripes)]
+
+    def lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def root(self, key):
+        """
+        Id of the root post of a thread, PENDING while another replica creates it, or None
+        """
+
+        now = time.time()
+        with self.cache_lock:
+            entry = self.cache.pop(key, None)
+            if entry is not None:
+                self.cache[key] = entry
+        if entry is None:
+            post_id = self.state.get('thread:' + key)
+            if post_id is not None and post_id != self.PENDING:
+                self.remember(key, post_id, now)
+            return post_id
+
+        post_id, written_at = entry
+        if now - written_at > self.refresh_interval:
+            self.state.set('thread:' + key, post_id, self.ttl)
+            self.remember(key, post_id, now)
+        return post_id
+
+    def remember(self, key, post_id, written_at):
+        with self.cache_lock:
+            self.cache.pop(key, None)
+            self.cache[key] = (post_id, written_at)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def forget(self, key):
+        with self.cache_lock:
+            self.cache.pop(key, None)
+        self.state.delete('thread:' + key)
+
+    def publish(self, client, channel_id, key, text):
+        """
+        Replies in the thread of `key`, or starts it with a new post, returns the id of the post
+        """
+
+        with self.lock(key):
+            root_id = self.root(key)
+            if root_id == self.PENDING:
+                root_id = self.wait_for_root(key)
+            if root_id is not None:
+                try:
+                    return client.create_post(channel_id, text, root_id=root_id)['id']
+                except PostNotFound:
+                    # the root post was deleted in Mattermost, start a new thread
+                    self.forget(key)
+
+            if not self.state.add('thread:' + key, self.PENDING, self.claim_timeout * 2):
+                raise DeliveryError('Thread of %s is being started by another replica' % key, retry_after=1)
+            try:
+                post_id = client.create_post(channel_id, text)['id']
+            except Exception:
+                self.state.delete('thread:' + key)
+                raise
+            self.state.set('thread:' + key, post_id, self.ttl)
+            self.remember(key, post_id, time.time())
+            return post_id
+
+    def wait_for_root(self, key):
+        deadline = time.time() + self.claim_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            post_id = self.state.get('thread:' + key)
+            if post_id != self.PENDING:
+                if post_id is not None:
+                    self.remember(key, post_id, time.time())
+                return post_id
+        raise DeliveryError('Thread of %s is being started by another replica' % key, retry_after=1)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Resolution of GitLab users to Mattermost @mentions
+
+A GitLab user is mentioned as the Mattermost user of the same name, or of the name given by a
+mapping, if the user directory (the users API of Mattermost) knows it. Answers of the directory
+are cached, unknown users too, and the users of a payload are looked up in a single request.
+Lookups run in the background: an event waits for them at most its latency budget, after which
+users not resolved yet are shown as links, and the answer is cached for the next events.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import codecs
+import collections
+import json
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Bounded LRU cache whose entries expire after their own ttl
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        # key: (value, expiry time)
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now=None):
+        """
+        Returns whether the key is cached, and its value
+        """
+
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[1] <= (now or time.time()):
+            return False, None
+        self.entries[key] = entry
+        return True, entry[0]
+
+    def set(self, key, value, ttl, now=None):
+        self.entries.pop(key, None)
+        self.entries[key] = (value, (now or time.time()) + ttl)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class Lookup(object):
+    """
+    Directory request in flight for some Mattermost usernames, `found` are those which exist
+    """
+
+    def __init__(self, usernames):
+        self.usernames = usernames
+        self.found = set()
+        self.done = threading.Event()
+
+
+class MentionResolver(object):
+    """
+    Cached and budgeted lookups of Mattermost users
+
+    Existing users are cached for `ttl` seconds and unknown ones for `negative_ttl` seconds,
+    in at most `max_size` entries. Concurrent events looking up the same user share the same
+    request, and at most `max_lookups` requests are in flight, further users are not resolved.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, negative_ttl=300, max_lookups=4):
+        self.cache = TTLCache(max_size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_lookups = max_lookups
+        self.lookups = {}
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def resolve(self, usernames, directory=None, mapping=None, budget=0.2):
+        """
+        Mattermost usernames of the given GitLab users, by GitLab username, for those resolved
+        within `budget` seconds
+
+        `directory(usernames)` returns those of the Mattermost usernames which exist. Without
+        one, users are only resolved through the mapping, which is then trusted.
+        """
+
+        mapping = mapping or {}
+        candidates = dict((username, mapping.get(username, username)) for username in set(usernames))
+        if directory is None:
+            return dict((username, name) for username, name in candidates.items() if username in mapping)
+
+        deadline = time.time() + budget
+        resolved, waits, missing = {}, [], []
+        with self.lock:
+            for username, name in candidates.items():
+                cached, exists = self.cache.get(name)
+                if cached:
+                    self.hits += 1
+                    if exists:
+                        resolved[username] = name
+                    continue
+                self.misses += 1
+                lookup = self.lookups.get(name)
+                if lookup is None:
+                    missing.append(name)
+                else:
+                    waits.append((username, name, lookup))
+
+            if missing and self.in_flight < self.max_lookups:
+                lookup = Lookup(missing)
+                self.in_flight += 1
+                for name in missing:
+                    self.lookups[name] = lookup
+                waits.extend((username, name, lookup) for username, name in candidates.items() if name in lookup.usernames)
+                thread = threading.Thread(target=self.run, args=(lookup, directory), name='mention-lookup')
+                thread.daemon = True
+                thread.start()
+
+        for username, name, lookup in waits:
+            if not lookup.done.wait(max(deadline - time.time(), 0)):
+                self.timeouts += 1
+            elif name in lookup.found:
+                resolved[username] = name
+        return resolved
+
+    def run(self, lookup, directory):
+        try:
+            lookup.found = set(directory(lookup.usernames))
+            failed = False
+        except Exception as exc:
+            print('Could not look up Mattermost users %s: %s' % (', '.join(lookup.usernames), exc))
+            failed = True
+
+        with self.lock:
+            if failed:
+                self.errors += 1
+            else:
+                now = time.time()
+                for name in lookup.usernames:
+                    exists = name in lookup.found
+                    self.cache.set(name, exists, self.ttl if exists else self.negative_ttl, now)
+            for name in lookup.usernames:
+                self.lookups.pop(name, None)
+            self.in_flight -= 1
+        lookup.done.set()
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+def load_mapping(path):
+    """
+    argparse type reading a JSON object of Mattermost usernames by GitLab username
+    """
+
+    try:
+        with codecs.open(path, encoding='utf-8') as fp:
+            mapping = json.load(fp)
+    except (IOError, OSError, ValueError) as exc:
+        raise argparse.ArgumentTypeError('cannot read the mention mapping %s: %s' % (path, exc))
+    if not isinstance(mapping, dict):
+        raise argparse.ArgumentTypeError('the mention mapping %s must be a JSON object' % path)
+    return mapping
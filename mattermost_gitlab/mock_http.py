@@ -4,11 +4,19 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
 # Python System imports
+import collections
+import hashlib
+import itertools
+import json
+import random
+import re
+import socket
+import struct
 import threading
+import time
 from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
 from six.moves.BaseHTTPServer import HTTPServer
-from six.moves.http_client import HTTPConnection
-import socket
+from six.moves.socketserver import ThreadingMixIn
 
 # Django imports
 # from django import ...
@@ -21,33 +29,25 @@ import socket
 # Relative imports
 
 """
-code from http://www.ianlewis.org/en/testing-using-mocked-server
+Threaded stand-in for a Mattermost server, originally based on
+http://www.ianlewis.org/en/testing-using-mocked-server
 
-import threading
-import mock
-import gc
+Each server binds an ephemeral port, handles requests concurrently and keeps
+its own bounded capture of the received requests, so several of them can run
+side by side (e.g. with a parallel test runner).
 
-setup:
-    def setUp(self):
-        self.cond = threading.Condition()
-        self.server = mock.http.TestServer(port=9854, self.cond)
-        self.cond.acquire()
-        self.server.start()
-
-        # Wait until the server is ready
-        while not self.server.ready:
-            # Collect left over servers so they release their
-            # sockets
-            import gc
-            gc.collect()
-            self.cond.wait()
-
-        self.cond.release()
-
-tearDown:
-    def tearDown(self):
-        self.server.stop_server()
-        self.server = None
+Responses can be shaped to exercise the client:
+
+    server = TestServer(latency=0.05)
+    server.start()
+    server.httpd.add_rate_limit(retry_after=2)      # next request gets a 429
+    server.httpd.add_response(status=500, repeat=3)  # then three 500s
+    server.httpd.add_drop()                          # then a dropped connection
+    ...
+
+Routes also answer parts of the Mattermost API (posts, users) and of the GitLab API (resources
+set in `gitlab_objects`), e.g. `server.httpd.gitlab_objects['/users/1'] = {'name': 'Administrator'}`.
+    server.stop_server()
 """
 
 
@@ -59,123 +59,337 @@ def get_available_port():
     return port
 
 
-class StoppableHttpServer(HTTPServer):
-    """http server that reacts to self.stop flag"""
+class MockResponse(object):
+    """Response the mock server sends for one request"""
+
+    def __init__(self, status=200, body='OK\n', headers=None, delay=None, drop=False, default=False):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.delay = delay
+        self.drop = drop
+        self.default = default
+
+    @classmethod
+    def json(cls, data, status=200):
+        return cls(status, json.dumps(data), {'Content-Type': 'application/json'})
+
+
+class StoppableHttpServer(ThreadingMixIn, HTTPServer):
+    """Threaded http server with scriptable responses and a bounded request capture"""
 
-    received_requests = []
     allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, capture_limit=1000, latency=0,
+                 error_rate=0, error_status=500, rate_limit_rate=0, retry_after=1,
+                 drop_rate=0, seed=None):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.stop = False
+        self.lock = threading.Lock()
+        self.capture_limit = capture_limit
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.scripted_responses = collections.deque()
+        self.routes = []
+        self.add_route('POST', r'/api/v4/posts$', mattermost_create_post)
+        self.add_route('PUT', r'/api/v4/posts/(?P<post_id>\w+)/patch$', mattermost_patch_post)
+        self.add_route('POST', r'/api/v4/users/usernames$', mattermost_users_by_usernames)
+        # usernames of the Mattermost users known to the users API
+        self.users = set()
+        self.add_route('GET', r'/api/v4/(?:projects|users)/', gitlab_get)
+        # GitLab API responses, by path and query string after /api/v4
+        self.gitlab_objects = {}
+        self.reset()
+
+    def add_route(self, method, pattern, view):
+        """
+        Answers matching requests with `view(server, handler, data, **groups)`, which returns a MockResponse
+        """
+
+        self.routes.insert(0, (method, re.compile(pattern), view))
+
+    def route(self, handler, data):
+        path = handler.path.split('?', 1)[0]
+        for method, pattern, view in self.routes:
+            match = pattern.match(path)
+            if method == handler.command and match:
+                return view(self, handler, data, **match.groupdict())
+        return None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def reset(self):
+        """Forget captured requests and pending scripted responses"""
+        with self.lock:
+            self.received_requests = collections.deque(maxlen=self.capture_limit)
+            self.request_count = 0
+            self.scripted_responses.clear()
+            self.posts = collections.OrderedDict()
+            self.post_ids = itertools.count(1)
+
+    def add_response(self, status=200, body='OK\n', headers=None, delay=None, drop=False, repeat=1):
+        """Queue the response(s) to send to the next request(s), ahead of the random injections"""
+        with self.lock:
+            for __ in range(repeat):
+                self.scripted_responses.append(MockResponse(status, body, headers, delay, drop))
+
+    def add_rate_limit(self, retry_after=1, repeat=1):
+        self.add_response(
+            status=429,
+            body='{"id": "api.context.429", "message": "Too many requests"}',
+            headers={'Retry-After': str(retry_after)},
+            repeat=repeat,
+        )
+
+    def add_drop(self, repeat=1):
+        self.add_response(drop=True, repeat=repeat)
+
+    def next_response(self):
+        with self.lock:
+            if self.scripted_responses:
+                return self.scripted_responses.popleft()
+            roll = self.random.random()
+
+        if roll < self.drop_rate:
+            return MockResponse(drop=True)
+        roll -= self.drop_rate
+        if roll < self.rate_limit_rate:
+            return MockResponse(status=429, headers={'Retry-After': str(self.retry_after)})
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            return MockResponse(status=self.error_status, body='Internal error\n')
+        return MockResponse(default=True)
+
+    def capture(self, handler, data):
+        with self.lock:
+            self.request_count += 1
+            self.received_requests.append({
+                'method': handler.command,
+                'path': handler.path,
+                'headers': dict(handler.headers.items()),
+                'post': data,
+                'time': time.time(),
+            })
 
     def serve_forever(self, poll_interval=0.5):
-        """Handle one request at a time until stopped."""
+        """Handle requests until stopped."""
         self.stop = False
-        while not self.stop:
-            self.handle_request()
+        HTTPServer.serve_forever(self, poll_interval)
+
+
+def mattermost_create_post(server, handler, data):
+    """
+    Mattermost API: create a post
+    """
+
+    post = json.loads(data.decode('utf-8'))
+    with server.lock:
+        root = server.posts.get(post.get('root_id')) if post.get('root_id') else None
+        if post.get('root_id') and (root is None or root['root_id']):
+            return MockResponse.json({'id': 'api.post.create_post.root_id.app_error', 'status_code': 400}, status=400)
+        post['id'] = 'post%d' % next(server.post_ids)
+        post.setdefault('root_id', '')
+        post['create_at'] = post['update_at'] = int(time.time() * 1000)
+        server.posts[post['id']] = post
+    return MockResponse.json(post, status=201)
+
+
+def mattermost_patch_post(server, handler, data, post_id):
+    """
+    Mattermost API: patch the message of a post
+    """
+
+    with server.lock:
+        post = server.posts.get(post_id)
+        if post is None:
+            return MockResponse.json({'id': 'app.post.get.app_error', 'status_code': 404}, status=404)
+        post.update(json.loads(data.decode('utf-8')))
+        post['update_at'] = int(time.time() * 1000)
+    return MockResponse.json(post)
+
+
+def mattermost_users_by_usernames(server, handler, data):
+    """
+    Mattermost API: get the users of a list of usernames, unknown ones are left out
+    """
+
+    with server.lock:
+        users = [
+            {'id': 'user-%s' % username, 'username': username, 'delete_at': 0}
+            for username in json.loads(data.decode('utf-8')) if username in server.users
+        ]
+    return MockResponse.json(users)
+
+
+def gitlab_get(server, handler, data):
+    """
+    GitLab API: get a resource of `gitlab_objects`, answering 304 when it matches If-None-Match
+    """
+
+    with server.lock:
+        resource = server.gitlab_objects.get(handler.path[len('/api/v4'):])
+    if resource is None:
+        return MockResponse.json({'message': '404 Not found'}, status=404)
+
+    response = MockResponse.json(resource)
+    etag = '"%s"' % hashlib.md5(response.body.encode('utf-8')).hexdigest()
+    if handler.headers.get('If-None-Match') == etag:
+        return MockResponse(304, '', {'ETag': etag})
+    response.headers['ETag'] = etag
+    return response
 
 
 class TestRequestHandler(SimpleHTTPRequestHandler):
 
+    protocol_version = 'HTTP/1.1'
+
     def log_request(self, *args, **kwargs):
         pass
 
-    def do_POST(self):
-        """send 200 OK response, with 'OK' as content"""
-        # extract any POSTDATA
-        self.data = ""
+    def read_body(self):
         if "Content-Length" in self.headers:
-            self.data = self.rfile.read(int(self.headers["Content-Length"]))
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        return b""
 
-        self.server.received_requests.append({
-            'post': self.data,
-        })
+    def drop_connection(self):
+        """Close the socket without answering, like a crashed or restarted upstream"""
+        self.close_connection = True
+        try:
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack(str('ii'), 1, 0))
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
 
-        self.send_response(200)
+    def send_mock_response(self, response):
+        delay = self.server.latency if response.delay is None else response.delay
+        if delay:
+            time.sleep(delay)
+
+        if response.drop:
+            self.drop_connection()
+            return
+
+        body = response.body
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write('OK\n'.encode())
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """send the next scripted response, or the routed one, 200 OK with 'OK' as content by default"""
+        self.data = self.read_body()
+        self.server.capture(self, self.data)
+        response = self.server.next_response()
+        if response.default:
+            response = self.server.route(self, self.data) or response
+        self.send_mock_response(response)
+
+    do_PUT = do_POST
+    do_GET = do_POST
 
     def do_QUIT(self):
-        """send 200 OK response, and set server.stop to True"""
+        """send 200 OK response, and stop the server"""
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
         self.server.stop = True
+        threading.Thread(target=self.server.shutdown).start()
 
 
 class TestServer(threading.Thread):
-    """HTTP Server that runs in a thread and handles a predetermined number of requests"""
+    """HTTP Server that runs in a thread, on an ephemeral port unless one is given"""
     TIMEOUT = 10
 
-    def __init__(self, port, cond=None):
+    def __init__(self, port=0, cond=None, handler_class=TestRequestHandler, **server_options):
         threading.Thread.__init__(self)
+        self.daemon = True
         self.port = port
         self.ready = False
         self.cond = cond
+        self.handler_class = handler_class
+        self.server_options = server_options
+        self.httpd = None
+        self.started = threading.Event()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    def bind(self):
+        import errno
 
-    def run(self):
-        self.cond.acquire()
         timeout = 0
-        self.httpd = None
         while self.httpd is None:
             try:
-                self.httpd = StoppableHttpServer(('', self.port), TestRequestHandler)
-            except Exception as exc:
-                import socket
-                import errno
-                import time
-                if isinstance(exc, socket.error) and errno.errorcode[exc.args[0]] == 'EADDRINUSE' and timeout < self.TIMEOUT:
+                self.httpd = StoppableHttpServer(('127.0.0.1', self.port), self.handler_class, **self.server_options)
+            except socket.error as exc:
+                if exc.args and exc.args[0] == errno.EADDRINUSE and timeout < self.TIMEOUT:
                     timeout += 1
                     time.sleep(1)
                 else:
-                    print(exc)
-                    self.cond.notifyAll()
-                    self.cond.release()
-                    self.ready = True
-                    raise exc
-
-        self.ready = True
-        if self.cond:
-            self.cond.notifyAll()
-            self.cond.release()
-        self.httpd.serve_forever()
+                    raise
+        self.port = self.httpd.port
+
+    def run(self):
+        try:
+            self.bind()
+        except Exception as exc:
+            print(exc)
+            raise
+        finally:
+            self.ready = True
+            self.started.set()
+            if self.cond:
+                with self.cond:
+                    self.cond.notify_all()
+        self.httpd.serve_forever(poll_interval=0.05)
+
+    def start(self):
+        threading.Thread.start(self)
+        self.started.wait(self.TIMEOUT + 1)
 
     def stop_server(self):
-        """send QUIT request to http server running on localhost:<port>"""
-        conn = HTTPConnection("127.0.0.1:{}".format(self.port))
-        conn.request("QUIT", "/")
-        conn.getresponse()
+        """stop the serving loop and release the socket"""
+        if self.httpd is not None:
+            self.httpd.stop = True
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        self.join(self.TIMEOUT)
 
 
 class MockHttpServerMixin(object):
 
-    port = 9854
+    port = 0
+    server_options = {}
 
     def setUp(self):
         super(MockHttpServerMixin, self).setUp()
-
-        try:
-            self.server.httpd.received_requests = []
-        except AssertionError:
-            pass
+        self.server.httpd.reset()
 
     @classmethod
     def setUpClass(cls):
         super(MockHttpServerMixin, cls).setUpClass()
-        cls.cond = threading.Condition()
-        cls.server = TestServer(port=cls.port, cond=cls.cond)
-        cls.cond.acquire()
+        cls.server = TestServer(port=cls.port, **cls.server_options)
         cls.server.start()
-
-        # Wait until the server is ready
-        while not cls.server.ready:
-            # Collect left over servers so they release their
-            # sockets
-            import gc
-            gc.collect()
-            cls.cond.wait()
-
-        cls.cond.release()
+        if cls.server.httpd is None:
+            raise RuntimeError('Mock server could not be started')
+        cls.port = cls.server.port
 
     @classmethod
     def tearDownClass(cls):
         super(MockHttpServerMixin, cls).tearDownClass()
         cls.server.stop_server()
-        cls.server.httpd.server_close()
         cls.server = None
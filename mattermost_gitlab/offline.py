@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Formats GitLab payloads without a server, for backfills and dry runs
+
+    mattermost_gitlab format [options] [FILE ...]
+
+Payloads are read from the files, or the standard input, either as NDJSON or as one JSON
+document per file, and filtered with the same event options as the server. The messages are
+written as NDJSON, in the format of the spool file, and can also be posted to a webhook at a
+limited rate. Payloads are streamed, so that memory use does not depend on the input size.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import codecs
+import io
+import itertools
+import json
+import multiprocessing
+import sys
+
+from . import delivery, event_formatter, server
+
+
+# Payloads handed to the worker processes at once, which bounds memory use
+CHUNK_SIZE = 1000
+
+config = None
+
+
+def parse_args(args=None):
+    parser = server.ArgumentParser(prog='mattermost_gitlab format', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='*', metavar='FILE', help='Files of payloads, the standard input if none or -')
+    parser.add_argument('-o', '--output', default='-', metavar='FILE', help='File receiving the messages, the standard output by default')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='Format payloads with that many processes')
+    parser.add_argument('--deliver', dest='MATTERMOST_WEBHOOK_URL', default=None, metavar='URL', help='Also post the messages to that Mattermost webhook')
+    parser.add_argument('--rate', type=float, default=1, help='Messages posted per second when delivering')
+    server.add_message_arguments(parser)
+    server.add_event_arguments(parser)
+
+    options = vars(parser.parse_args(args=args))
+    options['REPORT_EVENTS'] = server.report_events(options)
+    options['MATTERMOST_API'] = None
+    return options
+
+
+def read_payloads(paths):
+    """
+    Yields the source and JSON text of each payload: lines of NDJSON files, or whole JSON files
+    """
+
+    for path in paths or ['-']:
+        if path == '-':
+            fp = io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+        else:
+            fp = codecs.open(path, encoding='utf-8')
+
+        with fp:
+            first = fp.readline()
+            try:
+                json.loads(first)
+            except ValueError:
+                # a document spanning several lines, e.g. a fixture
+                document = first + fp.read()
+                if document.strip():
+                    yield path, document
+                continue
+
+            yield '%s:1' % path, first
+            for number, line in enumerate(fp, 2):
+                if line.strip():
+                    yield '%s:%d' % (path, number), line
+
+
+def init_worker(args):
+    global config
+    config = parse_args(args)
+
+
+def render(item):
+    """
+    Formats a payload, returns its outcome (formatted, filtered or failed) and message or error
+    """
+
+    source, text = item
+    try:
+        data = json.loads(text)
+        event_class = event_formatter.as_event if data.get('object_kind') else event_formatter.as_ci_event
+        event = server.select_event(data, event_class, config)
+        if event is None:
+            return 'filtered', None
+        message = delivery.Message.from_event(event, event.format(), channel=config['CHANNEL'] or None)
+        return 'formatted', message.to_dict()
+    except Exception as exc:
+        return 'failed', '%s: %s: %s' % (source, exc.__class__.__name__, exc)
+
+
+def results(payloads, processes, args):
+    """
+    Renders payloads in order, with worker processes if more than one
+    """
+
+    if processes <= 1:
+        init_worker(args)
+        for item in payloads:
+            yield render(item)
+        return
+
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(args,))
+    try:
+        while True:
+            chunk = list(itertools.islice(payloads, CHUNK_SIZE))
+            if not chunk:
+                break
+            for result in pool.imap(render, chunk, chunksize=max(1, CHUNK_SIZE // (processes * 4))):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    options = parse_args(args)
+
+    if options['output'] == '-':
+        output = io.open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+    else:
+        output = codecs.open(options['output'], 'w', encoding='utf-8')
+
+    rate_limiter = delivery.RateLimiter(options['rate'])
+    counts = dict.fromkeys(('formatted', 'filtered', 'failed', 'delivered'), 0)
+    with output:
+        for outcome, result in results(read_payloads(options['files']), options['processes'], args):
+            counts[outcome] += 1
+            if outcome == 'failed':
+                print(result, file=sys.stderr)
+                continue
+            if outcome == 'filtered':
+                continue
+
+            output.write(json.dumps(result) + '\n')
+            if options['MATTERMOST_WEBHOOK_URL']:
+                rate_limiter.wait()
+                message = delivery.Message.from_dict(result)
+                if delivery.send(lambda message: server.post_message(message, options), message):
+                    counts['delivered'] += 1
+
+    print('%(formatted)d formatted, %(filtered)d filtered, %(failed)d failed, %(delivered)d delivered' % counts, file=sys.stderr)
+    return 1 if counts['failed'] else 0
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import cProfile
+import functools
+import gc
+import glob
+import os
+import re
+import signal
+import threading
+import time
+
+
+class SlowRequestProfiler(object):
+    """
+    Profiles requests with cProfile and keeps the stats of those slower than a threshold
+
+    Disabled, a wrapped handler costs a single attribute lookup. Only one request is
+    profiled at a time (cProfile cannot overlap), concurrent ones run unprofiled.
+    """
+
+    def __init__(self, threshold=1.0, directory='.', keep=20):
+        self.enabled = False
+        self.threshold = threshold
+        self.directory = directory
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def configure(self, threshold_ms=None, directory=None, keep=None):
+        if threshold_ms is not None:
+            self.threshold = threshold_ms / 1000.0
+        if directory is not None:
+            self.directory = directory
+        if keep is not None:
+            self.keep = keep
+        self.enabled = threshold_ms is not None
+
+    def toggle(self, signum=None, frame=None):
+        self.enabled = not self.enabled
+        print('Slow request profiling %s (threshold %dms, directory %s)' % (
+            'enabled' if self.enabled else 'disabled', self.threshold * 1000, self.directory))
+
+    def install_signal_handler(self, signum=getattr(signal, 'SIGUSR2', None)):
+        if signum is not None:
+            signal.signal(signum, self.toggle)
+
+    def wrap(self, describe):
+        """
+        Decorator profiling the wrapped function, `describe` returns the label (event kind) of the call
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                return self.profile(func, describe, args, kwargs)
+            return wrapper
+        return decorator
+
+    def profile(self, func, describe, args, kwargs):
+        if not self.lock.acquire(False):
+            return func(*args, **kwargs)
+
+        try:
+            profile = cProfile.Profile()
+            start = time.time()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                elapsed = time.time() - start
+                if elapsed >= self.threshold:
+                    self.save(profile, elapsed, describe())
+        finally:
+            self.lock.release()
+
+    def save(self, profile, elapsed, label):
+        self.counter += 1
+        label = re.sub(r'[^A-Za-z0-9_.-]+', '_', label or 'unknown')
+        filename = os.path.join(self.directory, '%s-%d-%04d-%s-%dms.pstats' % (
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), self.counter % 10000, label, elapsed * 1000))
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(filename)
+            self.rotate()
+        except (IOError, OSError) as exc:
+            print('Could not save profile %s: %s' % (filename, exc))
+
+    def rotate(self):
+        files = sorted(glob.glob(os.path.join(self.directory, '*.pstats')), key=os.path.getmtime)
+        for filename in files[:max(len(files) - self.keep, 0)]:
+            os.remove(filename)
+
+
+def tracemalloc_snapshot(limit=25, key_type='lineno'):
+    """
+    Text report of the biggest allocation sites, None when tracemalloc is not tracing
+    """
+
+    import tracemalloc
+
+    if not tracemalloc.is_tracing():
+        return None
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ['traced memory: current=%d peak=%d' % (current, peak)]
+    lines.extend(str(stat) for stat in snapshot.statistics(key_type)[:limit])
+    return '\n'.join(lines) + '\n'
+
+
+def memory_stats():
+    """
+    Resident memory in bytes (None where /proc is missing), and numbers of objects tracked by
+    the garbage collector and of threads
+    """
+
+    rss = None
+    try:
+        with open('/proc/self/statm') as fp:
+            rss = int(fp.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return {'rss': rss, 'objects': len(gc.get_objects()), 'threads': threading.active_count()}
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import os
+import signal
+import threading
+
+
+class ConfigReloader(object):
+    """
+    Reloads the configuration from a background thread, on SIGHUP or when a watched file changes
+
+    `load` returns the new options, building every derived structure, and raises if they are
+    invalid (argparse raises SystemExit), in which case the running configuration is kept.
+    `apply` installs the new options. `paths` returns the files to watch every `interval` seconds,
+    if any.
+    """
+
+    def __init__(self, load, apply, paths=lambda: (), interval=None):
+        self.load = load
+        self.apply = apply
+        self.paths = paths
+        self.interval = interval
+        self.requested = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.mtimes = self.snapshot_mtimes()
+
+    def snapshot_mtimes(self):
+        mtimes = {}
+        for path in self.paths():
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def changed(self):
+        return self.snapshot_mtimes() != self.mtimes
+
+    def request_reload(self, signum=None, frame=None):
+        self.requested.set()
+
+    def install_signal_handler(self, signum=getattr(signal, 'SIGHUP', None)):
+        if signum is not None:
+            signal.signal(signum, self.request_reload)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='config-reloader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.requested.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping:
+            requested = self.requested.wait(self.interval)
+            if self.stopping:
+                return
+            if requested or (self.interval and self.changed()):
+                self.requested.clear()
+                self.reload()
+
+    def reload(self):
+        """
+        Loads and applies the configuration, returns whether it was valid
+        """
+
+        self.mtimes = self.snapshot_mtimes()
+        try:
+            options = self.load()
+        except (Exception, SystemExit) as exc:
+            print('Invalid configuration, keeping the running one: %r' % exc)
+            return False
+
+        self.apply(options)
+        self.mtimes = self.snapshot_mtimes()
+        print('Configuration reloaded')
+        return True
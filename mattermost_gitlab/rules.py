@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Filtering rules, evaluated on the raw GitLab payload before any formatting
+
+A rules file is a JSON list of rules, or an object with a `rules` list and a `default`
+("keep" or "drop") applied to events no rule matches. The first matching rule decides
+whether the event is kept or dropped:
+
+    {
+        "default": "keep",
+        "rules": [
+            {"author": ["*-bot", "ghost"], "decision": "drop"},
+            {"kind": "push", "branch": ["main", "release/*"]},
+            {"kind": "push", "decision": "drop"},
+            {"kind": "merge_request", "label": ["needs review"]},
+            {"kind": "merge_request", "decision": "drop"},
+            {"kind": "build", "status": ["failed"]},
+            {"kind": "build", "decision": "drop"}
+        ]
+    }
+
+A rule matches when every given field matches one of its shell-style patterns. Rules are
+indexed by kind, then by the plain values of the field most of them test exactly (e.g. the
+author), so only candidate rules are evaluated. Conditions are checked cheapest first, and each
+value is extracted from the payload at most once per event.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import codecs
+import collections
+import fnmatch
+import json
+import re
+
+
+def normalize_ref(ref):
+    if ref:
+        for prefix in ('refs/heads/', 'refs/tags/'):
+            if ref.startswith(prefix):
+                return ref[len(prefix):]
+    return ref
+
+
+def extract_action(data):
+    return (data.get('object_attributes') or {}).get('action')
+
+
+def extract_status(data):
+    return data.get('build_status') or (data.get('object_attributes') or {}).get('status')
+
+
+def extract_branch(data):
+    attributes = data.get('object_attributes') or {}
+    return normalize_ref(data.get('ref') or attributes.get('ref') or attributes.get('target_branch'))
+
+
+def extract_author(data):
+    user = data.get('user')
+    if isinstance(user, dict):
+        return user.get('username') or user.get('name')
+    return data.get('user_username') or data.get('user_name')
+
+
+def extract_project(data):
+    values = []
+    project = data.get('project') or {}
+    if project.get('path_with_namespace'):
+        values.append(project['path_with_namespace'])
+    attributes = data.get('object_attributes') or {}
+    for project_id in (data.get('project_id'), attributes.get('project_id'), attributes.get('target_project_id'), project.get('id')):
+        if project_id is not None:
+            values.append(str(project_id))
+            break
+    return values
+
+
+def extract_labels(data):
+    labels = data.get('labels') or (data.get('object_attributes') or {}).get('labels') or []
+    return [label.get('title') if isinstance(label, dict) else label for label in labels]
+
+
+def extract_paths(data):
+    paths = []
+    for commit in data.get('commits') or ():
+        for key in ('added', 'modified', 'removed'):
+            paths.extend(commit.get(key) or ())
+    return paths
+
+
+# field name: (cost, extractor, whether the extractor returns several values)
+FIELDS = {
+    'action': (1, extract_action, False),
+    'status': (1, extract_status, False),
+    'branch': (1, extract_branch, False),
+    'author': (1, extract_author, False),
+    'project': (2, extract_project, True),
+    'label': (3, extract_labels, True),
+    'path': (5, extract_paths, True),
+}
+
+
+class PatternSet(object):
+    """
+    Set of shell-style patterns: plain values are looked up in a set, wildcards in a single regex
+    """
+
+    def __init__(self, patterns):
+        exact = set()
+        wildcards = []
+        for pattern in patterns:
+            if any(char in pattern for char in '*?['):
+                wildcards.append(pattern)
+            else:
+                exact.add(pattern)
+        self.exact = frozenset(exact)
+        self.regex = re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern) for pattern in wildcards)) if wildcards else None
+
+    def match(self, value):
+        if value is None:
+            return False
+        return value in self.exact or (self.regex is not None and self.regex.match(value) is not None)
+
+    def match_any(self, values):
+        return any(self.match(value) for value in values)
+
+
+class Rule(object):
+
+    def __init__(self, index, spec):
+        spec = dict(spec)
+        self.index = index
+        self.kind = spec.pop('kind', None)
+        decision = spec.pop('decision', 'keep')
+        if decision not in ('keep', 'drop'):
+            raise ValueError('rule %d: decision must be "keep" or "drop", not %r' % (index, decision))
+        self.keep = decision == 'keep'
+        self.hits = 0
+
+        conditions = []
+        for field, patterns in spec.items():
+            if field not in FIELDS:
+                raise ValueError('rule %d: unknown field %r, expected one of %s' % (index, field, ', '.join(sorted(FIELDS))))
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+            cost, __, multiple = FIELDS[field]
+            conditions.append((cost, field, multiple, PatternSet(patterns)))
+        self.conditions = [condition[1:] for condition in sorted(conditions, key=lambda condition: condition[:2])]
+
+        # single-valued fields tested against plain values only, usable to index the rule
+        self.exact_fields = dict(
+            (field, patterns.exact) for field, multiple, patterns in self.conditions
+            if not multiple and patterns.regex is None
+        )
+
+    def matches(self, data, values):
+        for field, multiple, patterns in self.conditions:
+            if field not in values:
+                values[field] = FIELDS[field][1](data)
+            value = values[field]
+            if not (patterns.match_any(value) if multiple else patterns.match(value)):
+                return False
+        return True
+
+    def describe(self):
+        return {'rule': self.index, 'kind': self.kind, 'decision': 'keep' if self.keep else 'drop', 'hits': self.hits}
+
+
+class KindIndex(object):
+    """
+    Rules of one kind, indexed by the values of the single-valued field most of them test exactly
+    """
+
+    def __init__(self, rules):
+        counts = collections.Counter(field for rule in rules for field in rule.exact_fields)
+        self.field = max(sorted(counts), key=counts.get) if counts else None
+        self.unindexed = [rule for rule in rules if self.field not in rule.exact_fields]
+        by_value = collections.defaultdict(list)
+        for rule in rules:
+            for value in rule.exact_fields.get(self.field, ()):
+                by_value[value].append(rule)
+        self.by_value = dict(
+            (value, sorted(indexed + self.unindexed, key=lambda rule: rule.index))
+            for value, indexed in by_value.items()
+        )
+
+    def candidates(self, data, values):
+        if self.field is None:
+            return self.unindexed
+        value = values[self.field] = FIELDS[self.field][1](data)
+        return self.by_value.get(value, self.unindexed)
+
+
+class RuleSet(object):
+    """
+    Compiled rules, `allows` tells whether an event payload should be reported
+    """
+
+    def __init__(self, specs, default='keep'):
+        if default not in ('keep', 'drop'):
+            raise ValueError('default must be "keep" or "drop", not %r' % default)
+        self.default_keep = default == 'keep'
+        self.rules = [Rule(index, spec) for index, spec in enumerate(specs)]
+        self.unmatched = 0
+        self.path = None
+
+        # rules without a kind apply to every kind, in file order with the others
+        self.any_kind = KindIndex([rule for rule in self.rules if rule.kind is None])
+        self.by_kind = {}
+        for kind in set(rule.kind for rule in self.rules if rule.kind is not None):
+            self.by_kind[kind] = KindIndex([rule for rule in self.rules if rule.kind in (None, kind)])
+
+    def allows(self, data):
+        values = {}
+        for rule in self.by_kind.get(data.get('object_kind'), self.any_kind).candidates(data, values):
+            if rule.matches(data, values):
+                rule.hits += 1
+                return rule.keep
+        self.unmatched += 1
+        return self.default_keep
+
+    def stats(self):
+        return {'rules': [rule.describe() for rule in self.rules], 'unmatched': self.unmatched}
+
+
+def load_rules(path):
+    """
+    argparse type reading and compiling a rules file
+    """
+
+    try:
+        with codecs.open(path, encoding='utf-8') as fp:
+            data = json.load(fp)
+        if isinstance(data, list):
+            rule_set = RuleSet(data)
+        else:
+            rule_set = RuleSet(data.get('rules', []), data.get('default', 'keep'))
+    except (IOError, OSError, ValueError) as exc:
+        raise argparse.ArgumentTypeError('invalid rules file %s: %s' % (path, exc))
+
+    rule_set.path = path
+    return rule_set
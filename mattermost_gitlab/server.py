@@ -8,15 +8,70 @@ from __future__ import unicode_literals, absolute_import, print_function
 import requests
 import json
 import argparse
+import functools
+import os
+import shlex
+import signal
+import sys
+import threading
+import time
 
 
 # Third-party imports
-from flask import Flask, request
+from flask import Flask, request, abort, jsonify
 
-from . import event_formatter, constants
+from . import event_formatter, constants, profiling, admission, delivery, digest, rules, reloader, mattermost_api, state, mentions, enrichment, history, lag, deadletter, eventstore
+from .delivery import DeliveryError
 
 
+# Seconds to wait for Mattermost to answer a post to the incoming webhook
+WEBHOOK_TIMEOUT = 10
+
+# Errors of payloads that cannot be formatted, which GitLab retrying would not fix
+FORMATTING_ERRORS = (NotImplementedError, KeyError, IndexError, TypeError, ValueError, AttributeError)
+
 app = Flask(__name__)
+profiler = profiling.SlowRequestProfiler()
+admission_control = admission.AdmissionController(backlog=lambda: len(delivery_queue) if delivery_queue else 0)
+delivery_queue = None
+digest_store = None
+pipeline_posts = mattermost_api.PipelinePosts()
+thread_posts = mattermost_api.ThreadPosts()
+mention_resolver = mentions.MentionResolver()
+enricher = enrichment.Enricher()
+webhook_history = history.WebhookHistory()
+lag_tracker = lag.LagTracker()
+dead_letters = None
+event_store = None
+redrive = None
+accepting = True
+
+
+def event_kind():
+    """
+    Kind of the GitLab event being handled, used to label profiles
+    """
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        return data.get('object_kind')
+    return None
+
+
+def admin_only(func):
+    """
+    Restricts an endpoint to requests bearing the admin token, hides it when no token is configured
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = app.config.get('ADMIN_TOKEN')
+        if not token:
+            abort(404)
+        if request.headers.get('X-Admin-Token') != token:
+            abort(403)
+        return func(*args, **kwargs)
+    return wrapper
 
 
 @app.route('/')
@@ -28,88 +83,632 @@ def root():
     return "OK"
 
 
+@app.route('/ready')
+def ready():
+    """
+    Readiness probe, fails once shutting down
+    """
+
+    if not accepting:
+        return 'Shutting down', 503
+    return 'OK'
+
+
 @app.route('/new_event', methods=['POST'])
+@profiler.wrap(event_kind)
 def new_event():
     """
     GitLab event handler, handles POST events from a GitLab project
     """
 
-    if request.json is None:
-        print('Invalid Content-Type')
-        return 'Content-Type must be application/json and the request body must contain valid JSON', 400
+    return handle_event(event_formatter.as_event)
+
+
+@app.route('/new_ci_event', methods=['POST'])
+@profiler.wrap(event_kind)
+def new_ci_event():
+    """
+    GitLab event handler, handles POST events from a GitLab CI project
+    """
+
+    return handle_event(event_formatter.as_ci_event)
+
+
+def handle_event(event_class):
+    """
+    Admits, formats and forwards a GitLab event
+
+    Overload and Mattermost failures are reported to GitLab with a Retry-After header so that
+    the hook is retried later, as are unexpected errors of the server itself (e.g. its state
+    database being locked). Unsupported or malformed events are logged and dropped, or kept as
+    dead letters.
+    The configuration is read once, so that a reload does not affect requests in flight.
+    """
+
+    config = app.config
+    if not accepting:
+        return 'Shutting down', 503, {'Retry-After': str(config['ADMISSION_LIMITS'].retry_after)}
+
+    object_kind = admission.HOOK_EVENT_KINDS.get(request.headers.get('X-Gitlab-Event')) or event_kind()
 
     try:
-        event = event_formatter.as_event(request.json)
+        with admission_control.admit(object_kind, config['ADMISSION_LIMITS']):
+            entry = webhook_history.record(request.path, request.get_data())
+            if request.json is None:
+                print('Invalid Content-Type')
+                history.set_outcome(entry, history.INVALID)
+                return 'Content-Type must be application/json and the request body must contain valid JSON', 400
+
+            if entry is not None:
+                entry.object_kind = object_kind
+            start = time.time()
+            try:
+                event = select_event(request.json, event_class, config)
+                if event is None:
+                    history.set_outcome(entry, history.FILTERED)
+                else:
+                    digest_rules = config['DIGEST_RULES']
+                    if digest_store is not None and digest_rules is not None and digest_rules.accepts(event):
+                        digest_store.add(event, config['CHANNEL'])
+                        history.set_outcome(entry, history.DIGESTED)
+                    else:
+                        pending = enricher.start(event, config['GITLAB_API'], config['ENRICH_DEADLINE'] / 1000.0) if config['GITLAB_API'] else None
+                        resolve_mentions(event, config)
+                        if pending is not None:
+                            event.extra = pending.wait()
+                        if config['MATTERMOST_API'] is not None and event.object_kind in (constants.BUILD_EVENT, constants.CI_EVENT):
+                            post_key, text = pipeline_posts.record(event)
+                        else:
+                            post_key, text = None, event.format()
+                        thread_key = event.thread_key if config['MATTERMOST_API'] is not None and config['REPLY_THREADS'] else None
+                        message = delivery.Message.from_event(event, text, config['PRIORITIES'], config['CHANNEL'], post_key, thread_key)
+                        message.history_entry = entry
+                        history.set_outcome(entry, history.FORMATTED, format=history.elapsed_ms(start))
+                        deliver(message, config)
+                        # once accepted, so that the retries of GitLab are not recorded again
+                        if event_store is not None:
+                            event_store.record(event)
+            except DeliveryError as exc:
+                print(exc)
+                return 'Could not deliver to Mattermost', 503, {'Retry-After': str(exc.retry_after or config['ADMISSION_LIMITS'].retry_after)}
+            except FORMATTING_ERRORS as exc:
+                history.set_outcome(entry, history.FAILED, history.describe(exc), format=history.elapsed_ms(start))
+                import traceback
+                traceback.print_exc()
+                if dead_letters is not None:
+                    dead_letters.add_payload(request.path, request.json, exc)
+            except Exception as exc:
+                history.set_outcome(entry, history.FAILED, history.describe(exc), format=history.elapsed_ms(start))
+                import traceback
+                traceback.print_exc()
+                return 'Could not handle the event', 503, {'Retry-After': str(config['ADMISSION_LIMITS'].retry_after)}
+    except admission.Overloaded as exc:
+        return str(exc), exc.status, {'Retry-After': str(exc.retry_after)}
+
+    return 'OK'
+
+
+def select_event(data, event_class, config):
+    """
+    Applies the filtering rules and the event switches of the configuration to a payload,
+    returns its event if it should be reported, None otherwise
+    """
+
+    rule_set = config['RULES']
+    if rule_set is not None and not rule_set.allows(data):
+        return None
+
+    event = event_class(data)
+    if not event.should_report_event(config['REPORT_EVENTS']):
+        return None
+    return event
+
+
+def resolve_mentions(event, config):
+    """
+    Resolves the GitLab users of the event to Mattermost users to @mention, within the latency budget
+    """
+
+    directory = config['MATTERMOST_CLIENT'].existing_usernames if config['MENTION_USERS'] else None
+    if directory is None and not config['MENTION_MAP']:
+        return
+    usernames = event.mentioned_usernames
+    if usernames:
+        event.mentions = mention_resolver.resolve(usernames, directory, config['MENTION_MAP'], config['MENTION_BUDGET'] / 1000.0)
+
+
+@app.route('/admin/rules', methods=['GET'])
+@admin_only
+def rules_stats():
+    """
+    Reports how many events each filtering rule matched
+    """
+
+    rule_set = app.config['RULES']
+    return jsonify(rule_set.stats() if rule_set is not None else {'rules': [], 'unmatched': 0})
+
+
+@app.route('/admin/lag', methods=['GET'])
+@admin_only
+def lag_stats():
+    """
+    Reports histograms of the lag from GitLab events to their posts, by kind and by project,
+    and the maximum lag of the last minute
+    """
+
+    return jsonify(lag_tracker.stats())
 
-        if event.should_report_event(app.config['REPORT_EVENTS']):
-            text = event.format()
-            post_text(text)
-    except Exception:
-        import traceback
-        traceback.print_exc()
 
+@app.route('/admin/tracemalloc', methods=['GET'])
+@admin_only
+def tracemalloc_report():
+    """
+    Reports the biggest allocation sites since tracing was started
+    """
+
+    report = profiling.tracemalloc_snapshot(limit=request.args.get('limit', 25, type=int))
+    if report is None:
+        return 'tracemalloc is not tracing, POST to /admin/tracemalloc/start first', 409
+    return report, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+@app.route('/admin/memory', methods=['GET'])
+@admin_only
+def memory():
+    """
+    Reports the resident memory and the numbers of objects and threads, e.g. for soak tests
+    """
+
+    return jsonify(profiling.memory_stats())
+
+
+@app.route('/admin/tracemalloc/<action>', methods=['POST'])
+@admin_only
+def tracemalloc_control(action):
+    """
+    Starts or stops memory allocation tracing
+    """
+
+    import tracemalloc
+
+    if action == 'start':
+        tracemalloc.start(request.args.get('frames', 1, type=int))
+    elif action == 'stop':
+        tracemalloc.stop()
+    else:
+        abort(404)
     return 'OK'
 
 
-@app.route('/new_ci_event', methods=['POST'])
-def new_ci_event():
+@app.route('/admin/webhooks', methods=['GET'])
+@admin_only
+def recent_webhooks():
     """
-    GitLab event handler, handles POST events from a GitLab CI project
+    Lists the recent webhooks, newest first, optionally of an ?outcome= and a ?kind=
     """
 
-    if request.json is None:
-        print('Invalid Content-Type')
-        return 'Content-Type must be application/json and the request body must contain valid JSON', 400
+    entries = webhook_history.list(request.args.get('outcome'), request.args.get('kind'))
+    return jsonify({'webhooks': [entry.to_dict() for entry in entries[:request.args.get('limit', 100, type=int)]]})
+
 
+def recent_webhook(webhook_id):
+    entry = webhook_history.get(webhook_id)
+    if entry is None:
+        abort(404)
+    return entry
+
+
+@app.route('/admin/webhooks/<int:webhook_id>', methods=['GET'])
+@admin_only
+def show_webhook(webhook_id):
+    """
+    Reports a recent webhook along with its payload
+    """
+
+    entry = recent_webhook(webhook_id)
+    data = entry.to_dict()
+    data['payload'] = entry.data()
+    return jsonify(data)
+
+
+@app.route('/admin/webhooks/<int:webhook_id>/replay', methods=['POST'])
+@admin_only
+def replay_webhook(webhook_id):
+    """
+    Formats the payload of a recent webhook again with the current configuration, and posts
+    the message with ?deliver=1
+    """
+
+    entry = recent_webhook(webhook_id)
+    data = entry.data()
+    if data is None:
+        return 'The payload of this webhook was too big to keep', 409
+
+    config = app.config
+    event_class = event_formatter.as_ci_event if entry.endpoint == '/new_ci_event' else event_formatter.as_event
     try:
-        event = event_formatter.CIEvent(request.json)
+        event = select_event(data, event_class, config)
+        if event is None:
+            return jsonify({'outcome': history.FILTERED, 'text': None})
+        text = event.format()
+    except Exception as exc:
+        return jsonify({'outcome': history.FAILED, 'error': history.describe(exc)}), 422
+
+    if not request.args.get('deliver', 0, type=int):
+        return jsonify({'outcome': history.FORMATTED, 'text': text})
+    message = delivery.Message.from_event(event, text, channel=config['CHANNEL'])
+    # the lag of a replay says nothing about the service
+    message.event_time = None
+    try:
+        post_message(message, config)
+    except DeliveryError as exc:
+        return jsonify({'outcome': history.FAILED, 'text': text, 'error': str(exc)}), 502
+    return jsonify({'outcome': history.DELIVERED, 'text': text})
 
-        if event.should_report_event(app.config['REPORT_EVENTS']):
-            text = event.format()
-            post_text(text)
-    except Exception:
-        import traceback
-        traceback.print_exc()
 
-    return 'OK'
+@app.route('/admin/events', methods=['GET'])
+@admin_only
+def query_events():
+    """
+    Lists the events recorded in the event store, newest first, optionally of a ?project= (path
+    or id), ?kind=, ?action=, ?author= and ?ref=, ?since= and ?until= a time
+    """
+
+    if event_store is None:
+        abort(404, 'Events are not recorded, see --event-store')
+    try:
+        since, until = [deadletter.parse_time(request.args[name]) if name in request.args else None for name in ('since', 'until')]
+    except argparse.ArgumentTypeError as exc:
+        abort(400, str(exc))
+    events = event_store.query(
+        project=request.args.get('project'),
+        object_kind=request.args.get('kind'),
+        action=request.args.get('action'),
+        author=request.args.get('author'),
+        ref=request.args.get('ref'),
+        since=since,
+        until=until,
+        limit=request.args.get('limit', 100, type=int),
+    )
+    return jsonify({'events': events, 'stats': event_store.stats()})
+
+
+def dead_letter_store():
+    if dead_letters is None:
+        abort(404, 'Dead letters are not kept, see --dead-letters')
+    return dead_letters
+
+
+def dead_letter_filters():
+    try:
+        since, until = [deadletter.parse_time(request.args[name]) if name in request.args else None for name in ('since', 'until')]
+    except argparse.ArgumentTypeError as exc:
+        abort(400, str(exc))
+    return {
+        'reason': request.args.get('reason'),
+        'project': request.args.get('project'),
+        'error_class': request.args.get('error'),
+        'since': since,
+        'until': until,
+    }
+
+
+@app.route('/admin/dead-letters', methods=['GET'])
+@admin_only
+def list_dead_letters():
+    """
+    Lists dead letters, newest first, optionally of a ?reason=, ?project= and ?error= class,
+    ?since= and ?until= a time, along with their numbers by reason and error class
+    """
+
+    store = dead_letter_store()
+    filters = dead_letter_filters()
+    return jsonify({
+        'dead_letters': [dead_letter.to_dict() for dead_letter in store.list(request.args.get('limit', 100, type=int), **filters)],
+        'summary': store.summary(**filters),
+    })
+
+
+@app.route('/admin/dead-letters/<int:dead_letter_id>', methods=['GET', 'DELETE'])
+@admin_only
+def show_dead_letter(dead_letter_id):
+    """
+    Reports a dead letter along with its payload or message, or removes it
+    """
+
+    store = dead_letter_store()
+    dead_letter = store.get(dead_letter_id)
+    if dead_letter is None:
+        abort(404)
+    if request.method == 'DELETE':
+        store.delete([dead_letter_id])
+        return 'OK'
+    data = dead_letter.to_dict()
+    data['payload'] = dead_letter.data()
+    return jsonify(data)
+
+
+@app.route('/admin/dead-letters/redrive', methods=['GET', 'POST'])
+@admin_only
+def redrive_dead_letters():
+    """
+    Delivers the dead letters selected by the filters of the list again, in the background, at
+    most ?rate= per second (5 by default) from ?workers= threads (4 by default); GET reports
+    the progress of the last redrive
+    """
+
+    global redrive
+
+    store = dead_letter_store()
+    if request.method == 'GET':
+        if redrive is None:
+            abort(404)
+        return jsonify(redrive.to_dict())
+
+    if redrive is not None and not redrive.done:
+        return 'A redrive is in progress', 409
+    config = app.config
+    redrive = deadletter.Redrive(
+        store,
+        store.ids(**dead_letter_filters()),
+        lambda dead_letter: redeliver(dead_letter, config),
+        rate=request.args.get('rate', 5, type=float),
+        workers=request.args.get('workers', 4, type=int),
+    ).start()
+    return jsonify(redrive.to_dict()), 202
+
+
+def redeliver(dead_letter, config=None):
+    """
+    Posts a dead letter right away, formatting its payload again if it could not be formatted
+    """
+
+    config = config or app.config
+    message = dead_letter.message(config['CHANNEL'])
+    # the lag of a redrive says nothing about the service
+    message.event_time = None
+    post_message(message, config)
+
+
+def deliver(message, config=None):
+    """
+    Queues the message when delivering from workers, otherwise posts it right away
+    """
+
+    if delivery_queue is not None:
+        delivery_queue.put(message)
+    else:
+        post_message(message, config)
 
 
-def post_text(text):
+def post_message(message, config=None):
+    """
+    Posts a message with the incoming webhook or, when configured, the posts API
+
+    In API mode, messages with a post key update the post created by the first of them, and
+    messages with a thread key reply to the post created by the first of them.
+    """
+
+    config = config or app.config
+    client = config['MATTERMOST_API']
+    start = time.time()
+    try:
+        if client is None:
+            post_text(message.text, message.channel, config)
+        elif message.post_key:
+            pipeline_posts.publish(client, config['CHANNEL_ID'], message.post_key, message.text.strip())
+        elif message.thread_key:
+            thread_posts.publish(client, config['CHANNEL_ID'], message.thread_key, message.text.strip())
+        else:
+            client.create_post(config['CHANNEL_ID'], message.text.strip())
+    except Exception as exc:
+        history.set_message_outcome(message, history.FAILED, history.describe(exc), deliver=history.elapsed_ms(start))
+        raise
+    history.set_message_outcome(message, history.DELIVERED, deliver=history.elapsed_ms(start))
+    lag_tracker.record_message(message)
+
+
+def post_text(text, channel=None, config=None):
     """
     Mattermost POST method, posts text to the Mattermost incoming webhook URL
     """
 
+    config = config or app.config
     data = {}
     data['text'] = text.strip()
-    if app.config['USERNAME']:
-        data['username'] = app.config['USERNAME']
-    if app.config['ICON_URL']:
-        data['icon_url'] = app.config['ICON_URL']
-    if app.config['CHANNEL']:
-        data['channel'] = app.config['CHANNEL']
+    if config['USERNAME']:
+        data['username'] = config['USERNAME']
+    if config['ICON_URL']:
+        data['icon_url'] = config['ICON_URL']
+    if channel or config['CHANNEL']:
+        data['channel'] = channel or config['CHANNEL']
 
     headers = {'Content-Type': 'application/json'}
-    resp = requests.post(app.config['MATTERMOST_WEBHOOK_URL'], headers=headers, data=json.dumps(data), verify=app.config['VERIFY_SSL'])
+    try:
+        resp = requests.post(config['MATTERMOST_WEBHOOK_URL'], headers=headers, data=json.dumps(data), verify=config['VERIFY_SSL'], timeout=WEBHOOK_TIMEOUT)
+    except requests.RequestException as exc:
+        raise DeliveryError('Encountered error posting to Mattermost URL %s: %s' % (config['MATTERMOST_WEBHOOK_URL'], exc))
 
-    if resp.status_code is not requests.codes.ok:
-        print('Encountered error posting to Mattermost URL %s, status=%d, response_body=%s' % (app.config['MATTERMOST_WEBHOOK_URL'], resp.status_code, resp.json()))
+    if resp.status_code != requests.codes.ok:
+        raise DeliveryError(
+            'Encountered error posting to Mattermost URL %s, status=%d, response_body=%s' % (config['MATTERMOST_WEBHOOK_URL'], resp.status_code, resp.text),
+            delivery.parse_retry_after(resp.headers.get('Retry-After')),
+            resp.status_code,
+        )
 
 
-def parse_args(args=None):
-    parser = argparse.ArgumentParser()
-    parser.add_argument('MATTERMOST_WEBHOOK_URL', help='The Mattermost webhook URL you created')
+def shutdown(timeout, spool_file=None):
+    """
+    Stops accepting events and drains pending deliveries for at most `timeout` seconds
+
+    Messages still queued or in flight after that are appended to `spool_file`, to be replayed by the next
+    start, and are lost without one. Returns the number of messages delivered, saved and lost.
+    """
+
+    global accepting
+
+    accepting = False
+    deadline = time.time() + timeout
+    report = {'delivered': 0, 'saved': 0, 'lost': 0}
+
+    if digest_store is not None:
+        if digest_store.flush_on_stop:
+            digest_store.flush()
+        digest_store.stop()
+
+    while admission_control.in_flight and time.time() < deadline:
+        time.sleep(0.05)
+
+    if event_store is not None:
+        event_store.stop()
+
+    if delivery_queue is not None:
+        delivered = delivery_queue.delivered
+        delivery_queue.join(max(deadline - time.time(), 0))
+        # interrupts retries, messages still in flight are saved with the queued ones
+        delivery_queue.stop(max(deadline - time.time(), 0))
+        remaining = delivery_queue.take_pending()
+        report['delivered'] = delivery_queue.delivered - delivered
+
+        if remaining and spool_file:
+            delivery.save_messages(spool_file, remaining)
+            report['saved'] = len(remaining)
+        else:
+            report['lost'] = len(remaining)
+
+    print('Shutdown: %(delivered)d messages delivered, %(saved)d saved for the next start, %(lost)d lost' % report)
+    return report
+
+
+def spool_failures(spool_file):
+    """
+    Handler of the messages the delivery queue gave up on, appending them to `spool_file` to be
+    replayed by the next start, when there is no dead letter store to keep them
+    """
+
+    lock = threading.Lock()
+
+    def on_failure(message, exc):
+        with lock:
+            delivery.save_messages(spool_file, getattr(message, 'parts', [message]))
+
+    return on_failure
+
+
+def replay_spool(spool_file):
+    """
+    Delivers the messages saved by the previous shutdown, saving back those that fail
+    """
+
+    messages = delivery.load_messages(spool_file)
+    failed = []
+    for message in messages:
+        try:
+            deliver(message)
+        except DeliveryError as exc:
+            print(exc)
+            failed.append(message)
+    if failed:
+        delivery.save_messages(spool_file, failed)
+    if messages:
+        print('Replayed %d spooled messages, %d failed' % (len(messages), len(failed)))
+    return len(messages) - len(failed)
+
+
+def install_shutdown_handler(timeout, spool_file):
+    """
+    On SIGTERM, drains in the background while answering 503, then stops the server
+    """
+
+    def drain_and_stop():
+        shutdown(timeout, spool_file)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def handler(signum, frame):
+        if accepting:
+            threading.Thread(target=drain_and_stop, name='shutdown').start()
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+# Options of the threads started by main, which a reload cannot change
+RESTART_OPTIONS = ('EVENT_STORE', 'EVENT_RETENTION', 'DEAD_LETTERS', 'DEAD_LETTERS_MAX', 'RECENT_WEBHOOKS', 'RECENT_WEBHOOKS_MAX_BYTES', 'MENTION_CACHE_TTL', 'ENRICH_CACHE_TTL', 'DELIVERY_WORKERS', 'BATCH_THRESHOLD', 'BATCH_MAX_CHARS', 'MAX_TRACKED_COMMITS', 'STATE_DB', 'DIGEST_INTERVAL', 'DIGEST_MAX_ENTRIES', 'DIGEST_SNAPSHOT', 'WATCH_CONFIG', 'DRAIN_TIMEOUT', 'SPOOL_FILE')
 
-    server_options = parser.add_argument_group("Server")
-    server_options.add_argument('-p', '--port', type=int, default=5000)
-    server_options.add_argument('--host', default='0.0.0.0')
 
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    Argument parser also reading arguments from @files, with shell-like quoting and # comments
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('fromfile_prefix_chars', '@')
+        super(ArgumentParser, self).__init__(*args, **kwargs)
+
+    def convert_arg_line_to_args(self, arg_line):
+        return shlex.split(arg_line, comments=True)
+
+
+def config_files(args):
+    """
+    Files the configuration is read from: @files and the rules file
+    """
+
+    paths = [arg[1:] for arg in args if arg.startswith('@')]
+    rule_set = app.config.get('RULES')
+    if rule_set is not None and rule_set.path:
+        paths.append(rule_set.path)
+    return paths
+
+
+def restart_changes(previous, config):
+    """
+    Options changed between two configurations which only take effect after a restart
+    """
+
+    changed = [name for name in RESTART_OPTIONS if previous.get(name) != config.get(name)]
+    # the digest only runs if enabled when starting, its rules can change at any time
+    if (previous.get('DIGEST_RULES') is None) != (config.get('DIGEST_RULES') is None):
+        changed.append('DIGEST_RULES')
+    return changed
+
+
+def apply_config(options):
+    """
+    Swaps in a new configuration, requests in flight keep using the one they started with
+    """
+
+    previous = app.config
+    config = previous.__class__(previous.root_path, previous)
+    config.update(options)
+    app.config = config
+
+    changed = restart_changes(previous, config)
+    if changed:
+        print('Changes to %s only take effect after a restart' % ', '.join(changed))
+
+    if any(previous.get(name) != config[name] for name in ('PROFILE_THRESHOLD', 'PROFILE_DIR', 'PROFILE_KEEP')):
+        profiler.configure(config['PROFILE_THRESHOLD'], config['PROFILE_DIR'], config['PROFILE_KEEP'])
+
+
+def add_message_arguments(parser):
     parser.add_argument('-u', '--username', dest='USERNAME', default='gitlab')
     parser.add_argument('--channel', dest='CHANNEL', default='')  # Leave this blank to post to the default channel of your webhook
     parser.add_argument('--icon', dest='ICON_URL', default='https://gitlab.com/uploads/system/project/avatar/13083/logo-extra-whitespace.png')
     parser.add_argument('--no-verify-ssl', dest='VERIFY_SSL', action='store_false', help='Do not verify SSL certificates when POSTing to GitLab.')
 
+
+def add_event_arguments(parser):
     event_options = parser.add_argument_group("Events")
 
+    event_options.add_argument(
+        '--rules',
+        dest='RULES',
+        type=rules.load_rules,
+        default=None,
+        metavar='FILE',
+        help='JSON file of rules filtering events by branch, author, label, status, path...'
+    )
+
     event_options.add_argument(
         '--push',
         action='store_true',
@@ -144,14 +743,22 @@ def parse_args(args=None):
         '--no-ci',
         action='store_false',
         dest=constants.CI_EVENT,
-        help='On Continuous Integration events'
+        help='On Continuous Integration events, pipelines and builds'
+    )
+    event_options.add_argument(
+        '--no-build',
+        action='store_false',
+        dest=constants.BUILD_EVENT,
+        help='On changes of each build (job) of a pipeline, which pipeline events already show'
     )
 
-    options = vars(parser.parse_args(args=args))
 
-    host, port = options.pop("host"), options.pop("port")
+def report_events(options):
+    """
+    Pops the switches of the event options, returns whether to report each kind of event
+    """
 
-    options["REPORT_EVENTS"] = {
+    events = {
         constants.PUSH_EVENT: options.pop(constants.PUSH_EVENT),
         constants.TAG_EVENT: options.pop(constants.TAG_EVENT),
         constants.ISSUE_EVENT: options.pop(constants.ISSUE_EVENT),
@@ -159,15 +766,241 @@ def parse_args(args=None):
         constants.MERGE_EVENT: options.pop(constants.MERGE_EVENT),
         constants.CI_EVENT: options.pop(constants.CI_EVENT),
     }
+    events[constants.BUILD_EVENT] = options.pop(constants.BUILD_EVENT) and events[constants.CI_EVENT]
+    return events
+
+
+def parse_args(args=None):
+    parser = ArgumentParser(epilog='Arguments can be read from files given as @FILE, one option per line, which are reloaded on SIGHUP.')
+    parser.add_argument('MATTERMOST_WEBHOOK_URL', nargs='?', default=None,
+                        help='The Mattermost webhook URL you created, unless posting with --mattermost-api-url')
+
+    server_options = parser.add_argument_group("Server")
+    server_options.add_argument('-p', '--port', type=int, default=5000)
+    server_options.add_argument('--host', default='0.0.0.0')
+    server_options.add_argument('--state-db', dest='STATE_DB', default=None, metavar='FILE',
+                                help='SQLite database where the replicas of a host share the posts of CI jobs, the threads and the digest, across restarts. '
+                                     'Single host only: it must be on a local filesystem, network filesystems (NFS, SMB...) are refused')
+    server_options.add_argument('--event-store', dest='EVENT_STORE', default=None, metavar='FILE',
+                                help='SQLite database recording the events handled, queried with /admin/events')
+    server_options.add_argument('--event-retention', dest='EVENT_RETENTION', type=float, default=30, metavar='DAYS',
+                                help='Days the recorded events are kept')
+    server_options.add_argument('--watch-config', dest='watch_config', type=float, default=None, metavar='SECONDS',
+                                help='Check every SECONDS whether the @files or the rules file changed, and reload them')
+
+    add_message_arguments(parser)
+
+    parser.add_argument('--admin-token', dest='ADMIN_TOKEN', default='', help='Token expected in the X-Admin-Token header of /admin endpoints, which are disabled when empty')
+    parser.add_argument('--recent-webhooks', dest='RECENT_WEBHOOKS', type=int, default=100, metavar='N',
+                        help='Keep the payloads and outcomes of the last N webhooks for /admin/webhooks (0: none)')
+    parser.add_argument('--recent-webhooks-max-bytes', dest='RECENT_WEBHOOKS_MAX_BYTES', type=int, default=2 * 1024 * 1024,
+                        help='Memory used by the recent webhooks, whose payloads are kept compressed, as much again for those waiting to be compressed')
+
+    api_options = parser.add_argument_group("Mattermost API", "Post with a bot account instead of a webhook, updating one post per commit as its CI jobs progress")
+    api_options.add_argument('--mattermost-api-url', dest='mattermost_api_url', default=None, metavar='URL', help='URL of the Mattermost server, e.g. https://mattermost.example.com')
+    api_options.add_argument('--bot-token', dest='bot_token', default=os.environ.get('MATTERMOST_BOT_TOKEN'),
+                             help='Access token of the bot account, defaults to the MATTERMOST_BOT_TOKEN environment variable')
+    api_options.add_argument('--channel-id', dest='CHANNEL_ID', default=None, help='Id of the channel to post to')
+    api_options.add_argument('--reply-threads', dest='REPLY_THREADS', action='store_true',
+                             help='Post the events of an issue or merge request, and comments on it, as replies to its first post, '
+                                  'remembered in --state-db, which is required')
+    api_options.add_argument('--max-tracked-commits', dest='MAX_TRACKED_COMMITS', type=int, default=1000,
+                             help='Commits whose post is remembered, older ones get a new post on their next job update')
+
+    mention_options = parser.add_argument_group("Mentions", "@mention the GitLab users of comments and merge requests in Mattermost, instead of linking to them")
+    mention_options.add_argument('--mention-users', dest='MENTION_USERS', action='store_true',
+                                 help='Mention GitLab users who have a Mattermost account of the same name, or of their name in --mention-map, looked up with --mattermost-api-url')
+    mention_options.add_argument('--mention-map', dest='MENTION_MAP', type=mentions.load_mapping, default=None, metavar='FILE',
+                                 help='JSON object of Mattermost usernames by GitLab username, trusted without --mention-users')
+    mention_options.add_argument('--mention-budget', dest='MENTION_BUDGET', type=int, default=200, metavar='MS',
+                                 help='Milliseconds an event waits for the lookup of its users, which are linked to when not resolved in time')
+    mention_options.add_argument('--mention-cache-ttl', dest='MENTION_CACHE_TTL', type=int, default=3600, metavar='SECONDS',
+                                 help='Seconds a Mattermost user found by a lookup is remembered')
+
+    gitlab_options = parser.add_argument_group("GitLab API", "Complete messages with data fetched from GitLab: diff stats of merge requests, pipeline status of pushes, assignees")
+    gitlab_options.add_argument('--gitlab-api-url', dest='gitlab_api_url', default=None, metavar='URL', help='URL of the GitLab server, e.g. https://gitlab.example.com')
+    gitlab_options.add_argument('--gitlab-token', dest='gitlab_token', default=os.environ.get('GITLAB_API_TOKEN'),
+                                help='Access token with the read_api scope, defaults to the GITLAB_API_TOKEN environment variable')
+    gitlab_options.add_argument('--enrich-deadline', dest='ENRICH_DEADLINE', type=int, default=300, metavar='MS',
+                                help='Milliseconds an event waits for its data, which is left out when not fetched in time')
+    gitlab_options.add_argument('--enrich-cache-ttl', dest='ENRICH_CACHE_TTL', type=int, default=60, metavar='SECONDS',
+                                help='Seconds a response is used before being revalidated with its ETag')
+
+    profiling_options = parser.add_argument_group("Profiling")
+    profiling_options.add_argument('--profile-threshold', dest='PROFILE_THRESHOLD', type=int, default=None, metavar='MS',
+                                   help='Profile webhooks and keep the stats of those slower than MS milliseconds. Can be toggled with SIGUSR2')
+    profiling_options.add_argument('--profile-dir', dest='PROFILE_DIR', default='profiles', help='Directory receiving the pstats files')
+    profiling_options.add_argument('--profile-keep', dest='PROFILE_KEEP', type=int, default=20, help='Number of pstats files to keep')
+
+    load_options = parser.add_argument_group("Load shedding")
+    load_options.add_argument('--max-pending', dest='max_pending', type=int, default=0,
+                              help='Answer 503 to every event while this many events are being handled or queued (0: no limit)')
+    load_options.add_argument('--shed-at', dest='shed_at', type=admission.parse_kind_limit, action='append', default=[], metavar='KIND=N',
+                              help='Answer 429 to KIND events (push, tag_push, issue, note, merge_request, build, pipeline) while N events are pending, e.g. --shed-at push=20')
+    load_options.add_argument('--retry-after', dest='retry_after', type=int, default=10, help='Seconds GitLab is asked to wait before retrying a rejected event')
+
+    delivery_options = parser.add_argument_group("Delivery")
+    delivery_options.add_argument('--delivery-workers', dest='DELIVERY_WORKERS', type=int, default=0,
+                                  help='Deliver messages from a queue with that many threads, by priority, instead of while answering GitLab; '
+                                       'requires --dead-letters or --spool-file, where messages still failing after their retries are kept')
+    delivery_options.add_argument('--batch-threshold', dest='BATCH_THRESHOLD', type=int, default=10, metavar='N',
+                                  help='When more than N messages wait for the same channel, post them together (0: never)')
+    delivery_options.add_argument('--batch-max-chars', dest='BATCH_MAX_CHARS', type=int, default=16000,
+                                  help='Maximum length of a post of batched messages, at most the MaxPostSize of Mattermost')
+    delivery_options.add_argument('--drain-timeout', dest='DRAIN_TIMEOUT', type=float, default=25,
+                                  help='On SIGTERM, seconds given to pending deliveries before exiting')
+    delivery_options.add_argument('--spool-file', dest='SPOOL_FILE', default=None, metavar='FILE',
+                                  help='File where messages still pending on exit are saved, and replayed from on start')
+    delivery_options.add_argument('--dead-letters', dest='DEAD_LETTERS', default=None, metavar='FILE',
+                                  help='SQLite database keeping the payloads which could not be formatted and the messages which could not be delivered')
+    delivery_options.add_argument('--dead-letters-max', dest='DEAD_LETTERS_MAX', type=int, default=10000, metavar='N',
+                                  help='Dead letters kept, the oldest ones are removed first')
+    delivery_options.add_argument('--priority', dest='priority', type=delivery.parse_priority, action='append', default=[], metavar='KIND[:ACTION]=N',
+                                  help='Priority class of events (lower is sooner), e.g. --priority build:failed=0 --priority push=3')
+    delivery_options.add_argument('--priority-aging', dest='priority_aging', type=float, default=30,
+                                  help='Seconds of waiting worth one priority class, so that low priority messages are not starved')
+
+    digest_options = parser.add_argument_group("Digest")
+    digest_options.add_argument('--digest', dest='digest', action='append', default=[], metavar='KIND',
+                                help='Summarise events of that kind (e.g. push, tag_push) in a periodic digest instead of posting them')
+    digest_options.add_argument('--digest-branch', dest='digest_branch', action='append', default=[], metavar='PATTERN',
+                                help='Only summarise events on branches matching the pattern (e.g. "feature/*"), the others are posted')
+    digest_options.add_argument('--digest-project', dest='digest_project', action='append', default=[], metavar='PATTERN',
+                                help='Only summarise events of projects (group/project or id) matching the pattern, the others are posted')
+    digest_options.add_argument('--digest-interval', dest='DIGEST_INTERVAL', type=int, default=900, help='Seconds between digests')
+    digest_options.add_argument('--digest-max-entries', dest='DIGEST_MAX_ENTRIES', type=int, default=500,
+                                help='Lines kept in a digest, further events are only counted')
+    digest_options.add_argument('--digest-snapshot', dest='DIGEST_SNAPSHOT', default=None, metavar='FILE',
+                                help='File where the pending digest is saved, to survive restarts')
+
+    add_event_arguments(parser)
+
+    options = vars(parser.parse_args(args=args))
+
+    host, port = options.pop("host"), options.pop("port")
+    options["WATCH_CONFIG"] = options.pop("watch_config")
+
+    api_url, bot_token = options.pop("mattermost_api_url"), options.pop("bot_token")
+    options["MATTERMOST_CLIENT"] = None
+    if api_url:
+        if not bot_token:
+            parser.error('--mattermost-api-url requires --bot-token')
+        options["MATTERMOST_CLIENT"] = mattermost_api.MattermostClient(api_url, bot_token, verify=options["VERIFY_SSL"])
+
+    # posting with the API needs a channel id, the client may otherwise only look up users
+    if options["MATTERMOST_CLIENT"] is not None and options["CHANNEL_ID"]:
+        options["MATTERMOST_API"] = options["MATTERMOST_CLIENT"]
+    elif options["MATTERMOST_WEBHOOK_URL"] and not options["CHANNEL_ID"]:
+        options["MATTERMOST_API"] = None
+    else:
+        parser.error('either MATTERMOST_WEBHOOK_URL, or --mattermost-api-url with --bot-token and --channel-id, is required')
+
+    if options["REPLY_THREADS"] and options["MATTERMOST_API"] is None:
+        parser.error('--reply-threads requires --mattermost-api-url, --bot-token and --channel-id')
+    # WAL mode needs memory shared by the processes using the database, which hosts do not share
+    filesystem = state.network_filesystem(options["STATE_DB"]) if options["STATE_DB"] else None
+    if filesystem:
+        parser.error('--state-db must be on a local filesystem, not on %s: replicas of several hosts cannot share it' % filesystem)
+
+    # a root post forgotten on restart would split its thread in two
+    if options["REPLY_THREADS"] and not options["STATE_DB"]:
+        parser.error('--reply-threads requires --state-db, to remember the root posts of threads across restarts')
+
+    # GitLab is answered before delivering, failures must be kept somewhere
+    if options["DELIVERY_WORKERS"] > 0 and not (options["DEAD_LETTERS"] or options["SPOOL_FILE"]):
+        parser.error('--delivery-workers requires --dead-letters or --spool-file, to keep the messages which cannot be delivered')
+
+    if options["MENTION_USERS"] and options["MATTERMOST_CLIENT"] is None:
+        parser.error('--mention-users requires --mattermost-api-url and --bot-token')
+
+    gitlab_api_url, gitlab_token = options.pop("gitlab_api_url"), options.pop("gitlab_token")
+    options["GITLAB_API"] = None
+    if gitlab_api_url:
+        if not gitlab_token:
+            parser.error('--gitlab-api-url requires --gitlab-token')
+        options["GITLAB_API"] = enrichment.GitLabClient(gitlab_api_url, gitlab_token, verify=options["VERIFY_SSL"])
+
+    options["ADMISSION_LIMITS"] = admission.Limits(
+        max_load=options.pop("max_pending"),
+        kind_limits=dict(options.pop("shed_at")),
+        retry_after=options.pop("retry_after"),
+    )
+    options["PRIORITIES"] = delivery.PriorityClasses(dict(options.pop("priority")))
+    options["PRIORITY_AGING"] = options.pop("priority_aging")
+
+    digest_kinds = options.pop("digest")
+    options["DIGEST_RULES"] = digest.DigestRules(digest_kinds, options.pop("digest_branch"), options.pop("digest_project")) if digest_kinds else None
+
+    options["REPORT_EVENTS"] = report_events(options)
 
     return host, port, options
 
 
 def main():
-    host, port, options = parse_args()
+    global delivery_queue, digest_store, pipeline_posts, thread_posts, mention_resolver, enricher, webhook_history, dead_letters, event_store
+
+    args = sys.argv[1:]
+    if args[:1] == ['format']:
+        from . import offline
+        return offline.main(args[1:])
+    if args[:1] == ['dead-letters']:
+        return deadletter.main(args[1:])
+
+    host, port, options = parse_args(args)
     app.config.update(options)
 
-    app.run(host=host, port=port)
+    config_reloader = reloader.ConfigReloader(
+        load=lambda: parse_args(args)[2],
+        apply=apply_config,
+        paths=lambda: config_files(args),
+        interval=options['WATCH_CONFIG'],
+    )
+    config_reloader.install_signal_handler()
+    config_reloader.start()
+
+    state_backend = state.SQLiteBackend(options['STATE_DB']) if options['STATE_DB'] else None
+    pipeline_posts = mattermost_api.PipelinePosts(state_backend, max_entries=options['MAX_TRACKED_COMMITS'])
+    thread_posts = mattermost_api.ThreadPosts(state_backend)
+    mention_resolver = mentions.MentionResolver(ttl=options['MENTION_CACHE_TTL'])
+    enricher = enrichment.Enricher(ttl=options['ENRICH_CACHE_TTL'])
+    webhook_history = history.WebhookHistory(options['RECENT_WEBHOOKS'], options['RECENT_WEBHOOKS_MAX_BYTES'])
+    if options['EVENT_STORE']:
+        event_store = eventstore.EventStore(options['EVENT_STORE'], retention=options['EVENT_RETENTION'] * 86400)
+        event_store.start()
+    if options['DEAD_LETTERS']:
+        dead_letters = deadletter.DeadLetterStore(options['DEAD_LETTERS'], options['DEAD_LETTERS_MAX'])
+
+    if options['DELIVERY_WORKERS'] > 0:
+        delivery_queue = delivery.DeliveryQueue(
+            post_message,
+            workers=options['DELIVERY_WORKERS'],
+            aging=options['PRIORITY_AGING'],
+            batch_threshold=options['BATCH_THRESHOLD'],
+            batch_max_chars=options['BATCH_MAX_CHARS'],
+            on_failure=dead_letters.add_message if dead_letters is not None else spool_failures(options['SPOOL_FILE']),
+        )
+        delivery_queue.start()
+
+    if options['DIGEST_RULES'] is not None:
+        if state_backend is not None:
+            digest_store = digest.SharedDigest(deliver, state_backend, options['DIGEST_INTERVAL'], options['DIGEST_MAX_ENTRIES'])
+        else:
+            digest_store = digest.Digest(deliver, options['DIGEST_INTERVAL'], options['DIGEST_MAX_ENTRIES'], options['DIGEST_SNAPSHOT'])
+        digest_store.start()
+
+    if options['SPOOL_FILE']:
+        replay_spool(options['SPOOL_FILE'])
+
+    profiler.configure(options['PROFILE_THRESHOLD'], options['PROFILE_DIR'], options['PROFILE_KEEP'])
+    profiler.install_signal_handler()
+    install_shutdown_handler(options['DRAIN_TIMEOUT'], options['SPOOL_FILE'])
+
+    try:
+        app.run(host=host, port=port, threaded=True)
+    except KeyboardInterrupt:
+        pass
+    if accepting:
+        shutdown(options['DRAIN_TIMEOUT'], options['SPOOL_FILE'])
 
 
 if __name__ == "__main__":
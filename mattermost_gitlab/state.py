@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+State shared by the replicas of the service, e.g. behind a load balancer
+
+Backends store JSON-serialisable values under string keys, and hashes (dicts of fields) under
+names, both of which expire `ttl` seconds after their last write if given. Operations are
+grouped with `batch`, which runs them atomically and in a single round trip, so that handling
+an event costs a bounded number of round trips whatever the number of keys involved:
+
+    post_id, jobs = state.batch([('get', 'post:61:92a9bc78'), ('hash_get', 'jobs:61:92a9bc78')])
+
+The memory backend only shares state between the threads of a process, the SQLite backend
+between the processes of a host using the same database file. Its WAL mode relies on shared
+memory, which network filesystems (NFS, SMB...) do not provide: replicas on several hosts would
+corrupt the database.
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import collections
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+OPERATIONS = ('get', 'set', 'add', 'pop', 'delete', 'incr', 'hash_update', 'hash_get', 'hash_pop_all')
+# Filesystem types of /proc/mounts on which the SQLite backend must not be used
+NETWORK_FILESYSTEMS = frozenset(('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', 'ceph', 'glusterfs', 'lustre', 'gpfs', '9p',
+                                 'fuse.sshfs', 'fuse.glusterfs', 'fuse.s3fs', 'fuse.gcsfuse'))
+
+
+def network_filesystem(path, mounts='/proc/mounts'):
+    """
+    Type of the network filesystem holding `path`, or None if it is local or cannot be told,
+    e.g. where there is no /proc/mounts
+    """
+
+    path = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(mounts) as fp:
+            lines = fp.read().splitlines()
+    except (IOError, OSError):
+        return None
+
+    best, fstype = '', None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # spaces and the like are escaped as octal, e.g. \040
+        mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best):
+            best, fstype = mount_point, fields[2]
+    return fstype if fstype in NETWORK_FILESYSTEMS else None
+
+
+class StateBackend(object):
+    """
+    Interface of state backends: subclasses implement `batch`, the other methods are shortcuts
+
+    Operations are (name, arguments...) tuples, `batch` returns their results in order:
+
+    * `get(key)`: the value, or None
+    * `set(key, value, ttl=None)`
+    * `add(key, value, ttl=None)`: sets the value only if the key is absent, returns whether it was
+    * `pop(key)`: removes the key and returns its value, or None
+    * `delete(key)`
+    * `incr(key, amount=1, ttl=None)`: adds to an integer value (0 if absent), returns the new value
+    * `hash_update(name, fields, ttl=None, max_fields=None)`: sets the given fields of a hash, only
+      if it has fewer than `max_fields` fields if given, returns whether they were set
+    * `hash_get(name)`: the fields of a hash, {} if absent
+    * `hash_pop_all(name)`: removes a hash and returns its fields
+    """
+
+    def batch(self, operations):
+        raise NotImplementedError
+
+    def get(self, key):
+        return self.batch([('get', key)])[0]
+
+    def set(self, key, value, ttl=None):
+        self.batch([('set', key, value, ttl)])
+
+    def add(self, key, value, ttl=None):
+        return self.batch([('add', key, value, ttl)])[0]
+
+    def pop(self, key):
+        return self.batch([('pop', key)])[0]
+
+    def delete(self, key):
+        self.batch([('delete', key)])
+
+    def incr(self, key, amount=1, ttl=None):
+        return self.batch([('incr', key, amount, ttl)])[0]
+
+    def hash_update(self, name, fields, ttl=None, max_fields=None):
+        return self.batch([('hash_update', name, fields, ttl, max_fields)])[0]
+
+    def hash_get(self, name):
+        return self.batch([('hash_get', name)])[0]
+
+    def hash_pop_all(self, name):
+        return self.batch([('hash_pop_all', name)])[0]
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def check(operation):
+        if operation[0] not in OPERATIONS:
+            raise ValueError('unknown state operation %r' % (operation[0],))
+
+
+def expiry(ttl, now):
+    return now + ttl if ttl is not None else None
+
+
+class MemoryBackend(StateBackend):
+    """
+    State of a single process, keeping at most `max_keys` keys and hashes, least recently used
+    ones being evicted first
+    """
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys
+        # key or hash name: [value or fields, expiry time]
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def batch(self, operations):
+        now = time.time()
+        with self.lock:
+            results = []
+            for operation in operations:
+                self.check(operation)
+                results.append(getattr(self, 'do_' + operation[0])(now, *operation[1:]))
+            if self.max_keys is not None:
+                while len(self.items) > self.max_keys:
+                    self.items.popitem(last=False)
+            return results
+
+    def lookup(self, key, now):
+        item = self.items.pop(key, None)
+        if item is None or (item[1] is not None and item[1] <= now):
+            return None
+        self.items[key] = item
+        return item
+
+    def do_get(self, now, key):
+        item = self.lookup(key, now)
+        return item[0] if item is not None else None
+
+    def do_set(self, now, key, value, ttl=None):
+        self.items.pop(key, None)
+        self.items[key] = [value, expiry(ttl, now)]
+
+    def do_add(self, now, key, value, ttl=None):
+        if self.lookup(key, now) is not None:
+            return False
+        self.do_set(now, key, value, ttl)
+        return True
+
+    def do_pop(self, now, key):
+        item = self.lookup(key, now)
+        self.items.pop(key, None)
+        return item[0] if item is not None else None
+
+    def do_delete(self, now, key):
+        self.items.pop(key, None)
+
+    def do_incr(self, now, key, amount=1, ttl=None):
+        item = self.lookup(key, now)
+        if item is None:
+            item = self.items[key] = [0, expiry(ttl, now)]
+        elif ttl is not None:
+            item[1] = expiry(ttl, now)
+        item[0] += amount
+        return item[0]
+
+    def do_hash_update(self, now, name, fields, ttl=None, max_fields=None):
+        item = self.lookup(name, now)
+        if item is None:
+            item = self.items[name] = [{}, None]
+        elif max_fields is not None and len(item[0]) >= max_fields:
+            return False
+        item[0].update(fields)
+        item[1] = expiry(ttl, now)
+        return True
+
+    def do_hash_get(self, now, name):
+        item = self.lookup(name, now)
+        return dict(item[0]) if item is not None else {}
+
+    def do_hash_pop_all(self, now, name):
+        fields = self.do_hash_get(now, name)
+        self.items.pop(name, None)
+        return fields
+
+
+class SQLiteBackend(StateBackend):
+    """
+    State in an SQLite database in WAL mode, shared by every process opening the same file
+
+    Each batch is one transaction. Writers wait at most `timeout` seconds for each other, which
+    bounds the latency added to an event, and raise sqlite3.OperationalError beyond that.
+    Expired rows are purged every `purge_interval` seconds.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)',
+        'CREATE TABLE IF NOT EXISTS hashes (name TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, expires REAL, PRIMARY KEY (name, field))',
+    )
+    READ_ONLY = frozenset(('get', 'hash_get'))
+
+    def __init__(self, path, timeout=1.0, purge_interval=60):
+        self.path = path
+        self.timeout = timeout
+        self.purge_interval = purge_interval
+        self.purged_at = time.time()
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # autocommit mode, transactions are started explicitly by batch
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def batch(self, operations):
+        now = time.time()
+        conn = self.connection()
+        read_only = all(operation[0] in self.READ_ONLY for operation in operations)
+        conn.execute('BEGIN' if read_only else 'BEGIN IMMEDIATE')
+        try:
+            results = []
+            for operation in operations:
+                self.check(operation)
+                results.append(getattr(self, 'do_' + operation[0])(conn, now, *operation[1:]))
+            if not read_only and now - self.purged_at > self.purge_interval:
+                self.purged_at = now
+                conn.execute('DELETE FROM state WHERE expires <= ?', (now,))
+                conn.execute('DELETE FROM hashes WHERE expires <= ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return results
+
+    def do_get(self, conn, now, key):
+        row = conn.execute('SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, now)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def do_set(self, conn, now, key, value, ttl=None):
+        conn.execute('INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), expiry(ttl, now)))
+
+    def do_add(self, conn, now, key, value, ttl=None):
+        conn.execute('DELETE FROM state WHERE key = ? AND expires <= ?', (key, now))
+        cursor = conn.execute('INSERT OR IGNORE INTO state (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), expiry(ttl, now)))
+        return cursor.rowcount == 1
+
+    def do_pop(self, conn, now, key):
+        value = self.do_get(conn, now, key)
+        self.do_delete(conn, now, key)
+        return value
+
+    def do_delete(self, conn, now, key):
+        conn.execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def do_incr(self, conn, now, key, amount=1, ttl=None):
+        row = conn.execute('SELECT value, expires FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, now)).fetchone()
+        if row is None:
+            value, expires = amount, expiry(ttl, now)
+        else:
+            value, expires = json.loads(row[0]) + amount, expiry(ttl, now) if ttl is not None else row[1]
+        conn.execute('INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), expires))
+        return value
+
+    def do_hash_update(self, conn, now, name, fields, ttl=None, max_fields=None):
+        expires = expiry(ttl, now)
+        conn.execute('DELETE FROM hashes WHERE name = ? AND expires <= ?', (name, now))
+        if max_fields is not None and conn.execute('SELECT COUNT(*) FROM hashes WHERE name = ?', (name,)).fetchone()[0] >= max_fields:
+            return False
+        conn.executemany(
+            'INSERT OR REPLACE INTO hashes (name, field, value, expires) VALUES (?, ?, ?, ?)',
+            [(name, field, json.dumps(value), expires) for field, value in fields.items()],
+        )
+        # like the memory backend, the whole hash expires after its last write
+        conn.execute('UPDATE hashes SET expires = ? WHERE name = ?', (expires, name))
+        return True
+
+    def do_hash_get(self, conn, now, name):
+        rows = conn.execute('SELECT field, value FROM hashes WHERE name = ? AND (expires IS NULL OR expires > ?)', (name, now))
+        return dict((field, json.loads(value)) for field, value in rows)
+
+    def do_hash_pop_all(self, conn, now, name):
+        fields = self.do_hash_get(conn, now, name)
+        conn.execute('DELETE FROM hashes WHERE name = ?', (name,))
+        return fields
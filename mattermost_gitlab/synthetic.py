@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Seeded generator of synthetic GitLab webhook payloads, for benchmarks and load tests
+
+Payloads follow the structure of those sent by GitLab (see tests/data/gitlab) for every
+supported object kind, spread over many projects and users, and can be scaled up to sizes
+seen in production: thousands of commits per push, megabyte descriptions, many upload links
+and Unicode-heavy titles.
+
+    python -m mattermost_gitlab.synthetic --count 1000 --seed 1 > payloads.ndjson
+    python -m mattermost_gitlab.synthetic --count 100 --kind push --max-commits 5000 --output corpus/
+"""
+
+# Python Future imports
+from __future__ import unicode_literals, absolute_import, print_function
+
+# Python System imports
+import argparse
+import codecs
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+from . import constants
+
+
+ASCII_WORDS = (
+    'fix', 'add', 'remove', 'update', 'refactor', 'bump', 'merge', 'revert', 'cache', 'parser',
+    'build', 'deploy', 'config', 'test', 'docs', 'release', 'branch', 'server', 'client', 'query',
+    'index', 'memory', 'timeout', 'retry', 'webhook', 'pipeline', 'runner', 'token', 'schema', 'api',
+)
+UNICODE_WORDS = (
+    'café', 'naïve', 'Ünïcödé', 'Größe', 'résumé', 'señal', 'żółw', 'Ærø',
+    '修复', '缓存', 'テスト', 'ビルド', '데이터', '배포', 'ошибка', 'сборка', 'δοκιμή',
+    'إصلاح', 'בדיקה', 'परीक्षण', '⇗', '⟾', '✓', '🚀', '🐛', '🔥', '👍',
+)
+FIRST_NAMES = ('Alice', 'Bob', 'Chloé', 'Dmitri', 'Émilie', 'Farid', 'Guðrún', 'Hiroshi', 'Ines', 'José', 'Kwame', 'Łukasz', 'Mei', 'Nnamdi', 'Øyvind', 'Priya')
+LAST_NAMES = ('Martin', 'Nguyễn', 'Smith', 'Müller', 'Kowalski', 'García', 'Sørensen', 'Tanaka', 'Okafor', 'Ivanova', 'Li', 'Öztürk')
+GROUPS = ('platform', 'infra', 'data', 'web', 'mobile', 'research', 'tools', 'security')
+UPLOAD_NAMES = ('screenshot.png', 'trace.log', 'diagram.svg', 'report.pdf', 'capture d’écran.png', 'dump.tar.gz')
+STAGES = ('build', 'test', 'deploy')
+JOB_NAMES = {
+    'build': ('compile', 'assets', 'docker'),
+    'test': ('unit', 'integration', 'lint', 'flaky'),
+    'deploy': ('staging', 'production'),
+}
+
+KINDS = (
+    constants.PUSH_EVENT,
+    constants.TAG_EVENT,
+    constants.ISSUE_EVENT,
+    constants.COMMENT_EVENT,
+    constants.MERGE_EVENT,
+    constants.BUILD_EVENT,
+    constants.CI_EVENT,
+)
+# Relative frequency of each kind when none is requested, roughly as seen on a busy instance
+DEFAULT_WEIGHTS = {
+    constants.PUSH_EVENT: 30,
+    constants.TAG_EVENT: 2,
+    constants.ISSUE_EVENT: 8,
+    constants.COMMENT_EVENT: 15,
+    constants.MERGE_EVENT: 10,
+    constants.BUILD_EVENT: 25,
+    constants.CI_EVENT: 10,
+}
+NULL_SHA = '0' * 40
+
+
+class PayloadGenerator(object):
+    """
+    Generates payloads from a seed: the same seed and options always give the same payloads
+
+    `max_commits` bounds the commits of a push (GitLab itself lists at most 20 of them, and
+    counts the others in `total_commits_count`, which `commit_limit` mimics), `description_size`
+    the characters of issue, merge request and comment texts, which contain up to `uploads`
+    relative upload links. `unicode_ratio` is the share of non-ASCII words in texts.
+    """
+
+    def __init__(self, seed=0, projects=20, users=100, max_commits=20, commit_limit=None,
+                 description_size=500, uploads=2, unicode_ratio=0.2, gitlab_url='http://gitlab.example.com'):
+        self.random = random.Random(seed)
+        self.max_commits = max_commits
+        self.commit_limit = commit_limit
+        self.description_size = description_size
+        self.uploads = uploads
+        self.unicode_ratio = unicode_ratio
+        self.gitlab_url = gitlab_url
+        self.ids = itertools.count(1)
+        # a fixed start keeps payloads reproducible, events are a few seconds apart
+        self.clock = 1481911200.0
+        self.users = [self.make_user(index) for index in range(users)]
+        self.projects = [self.make_project(index) for index in range(projects)]
+
+    # Building blocks
+
+    def next_id(self):
+        return next(self.ids)
+
+    def tick(self):
+        self.clock += self.random.uniform(0.1, 10)
+        return self.clock
+
+    def timestamp(self):
+        """
+        Timestamp as in object attributes, e.g. 2016-12-16 18:13:27 UTC
+        """
+
+        return time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(self.tick()))
+
+    def iso_timestamp(self):
+        """
+        Timestamp as in commits, e.g. 2016-12-16T18:13:26+00:00
+        """
+
+        return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(self.tick()))
+
+    def sha(self):
+        return hashlib.sha1(('%r' % self.random.random()).encode('ascii')).hexdigest()
+
+    def word(self):
+        if self.random.random() < self.unicode_ratio:
+            return self.random.choice(UNICODE_WORDS)
+        return self.random.choice(ASCII_WORDS)
+
+    def sentence(self, words=6):
+        return ' '.join(self.word() for __ in range(max(1, self.random.randint(words // 2, words))))
+
+    def title(self):
+        return self.sentence(8).capitalize()
+
+    def text(self, size):
+        """
+        Markdown text of about `size` characters, in paragraphs, with up to `uploads` upload links
+        """
+
+        paragraphs = []
+        length = 0
+        while length < size:
+            paragraph = '. '.join(self.sentence(12) for __ in range(self.random.randint(1, 5))) + '.'
+            paragraphs.append(paragraph)
+            length += len(paragraph) + 2
+
+        for __ in range(self.random.randint(0, self.uploads)):
+            name = self.random.choice(UPLOAD_NAMES)
+            link = '[%s](/uploads/%s/%s)' % (name, self.sha()[:32], name)
+            if name.endswith(('.png', '.svg')):
+                link = '!' + link
+            index = self.random.randrange(len(paragraphs))
+            paragraphs[index] += ' ' + link
+
+        return '\n\n'.join(paragraphs)
+
+    def make_user(self, index):
+        name = '%s %s' % (self.random.choice(FIRST_NAMES), self.random.choice(LAST_NAMES))
+        username = '%s%d' % (name.split()[0].lower().encode('ascii', 'ignore').decode('ascii') or 'user', index)
+        return {
+            'id': index + 1,
+            'name': name,
+            'username': username,
+            'email': '%s@example.com' % username,
+            'avatar_url': 'http://www.gravatar.com/avatar/%s?s=80&d=identicon' % hashlib.md5(username.encode('ascii')).hexdigest(),
+        }
+
+    def make_project(self, index):
+        namespace = self.random.choice(GROUPS)
+        path = '%s-%d' % (self.random.choice(ASCII_WORDS), index)
+        web_url = '%s/%s/%s' % (self.gitlab_url, namespace, path)
+        ssh_url = 'git@%s:%s/%s.git' % (self.gitlab_url.split('://')[-1], namespace, path)
+        return {
+            'id': index + 1,
+            'name': path,
+            'description': self.sentence(10),
+            'web_url': web_url,
+            'avatar_url': None,
+            'git_ssh_url': ssh_url,
+            'git_http_url': web_url + '.git',
+            'namespace': namespace,
+            'visibility_level': self.random.choice((0, 10, 20)),
+            'path_with_namespace': '%s/%s' % (namespace, path),
+            'default_branch': 'master',
+            'homepage': web_url,
+            'url': ssh_url,
+            'ssh_url': ssh_url,
+            'http_url': web_url + '.git',
+        }
+
+    def repository(self, project):
+        return {
+            'name': project['name'],
+            'url': project['url'],
+            'description': project['description'],
+            'homepage': project['homepage'],
+            'git_http_url': project['git_http_url'],
+            'git_ssh_url': project['git_ssh_url'],
+            'visibility_level': project['visibility_level'],
+        }
+
+    def user(self, user):
+        return {'name': user['name'], 'username': user['username'], 'avatar_url': user['avatar_url']}
+
+    def branch(self):
+        if self.random.random() < 0.4:
+            return 'master'
+        return '%s/%s-%d' % (self.random.choice(('feature', 'fix', 'release')), self.random.choice(ASCII_WORDS), self.random.randint(1, 999))
+
+    def commit(self, project, author=None):
+        author = author or self.random.choice(self.users)
+        sha = self.sha()
+        message = self.title()
+        if self.random.random() < 0.3:
+            message += '\n\n' + self.text(200)
+        return {
+            'id': sha,
+            'message': message,
+            'timestamp': self.iso_timestamp(),
+            'url': '%s/commit/%s' % (project['web_url'], sha),
+            'author': {'name': author['name'], 'email': author['email']},
+        }
+
+    # Payloads
+
+    def push(self, tag=False):
+        project = self.random.choice(self.projects)
+        user = self.random.choice(self.users)
+        created = self.random.random() < 0.05
+        if tag:
+            count = 0
+        elif self.max_commits > 20 and self.random.random() < 0.2:
+            # occasional huge pushes, e.g. importing a repository
+            count = self.random.randint(21, self.max_commits)
+        else:
+            count = self.random.randint(1, min(self.max_commits, 20))
+
+        commits = []
+        for __ in range(count if self.commit_limit is None else min(count, self.commit_limit)):
+            commit = self.commit(project, user)
+            commit['added'] = ['src/%s.py' % self.random.choice(ASCII_WORDS) for __ in range(self.random.randint(0, 3))]
+            commit['modified'] = ['src/%s.py' % self.random.choice(ASCII_WORDS) for __ in range(self.random.randint(0, 5))]
+            commit['removed'] = []
+            commits.append(commit)
+
+        after = commits[-1]['id'] if commits else self.sha()
+        if tag:
+            ref = 'refs/tags/v%d.%d.%d' % (self.random.randint(0, 9), self.random.randint(0, 20), self.random.randint(0, 50))
+        else:
+            ref = 'refs/heads/' + self.branch()
+
+        return {
+            'object_kind': constants.TAG_EVENT if tag else constants.PUSH_EVENT,
+            'event_name': constants.TAG_EVENT if tag else constants.PUSH_EVENT,
+            'before': NULL_SHA if created else self.sha(),
+            'after': after,
+            'ref': ref,
+            'checkout_sha': after,
+            'message': None,
+            'user_id': user['id'],
+            'user_name': user['name'],
+            'user_email': user['email'],
+            'user_avatar': user['avatar_url'],
+            'project_id': project['id'],
+            'project': project,
+            'repository': self.repository(project),
+            'commits': commits,
+            'total_commits_count': count,
+        }
+
+    def tag_push(self):
+        return self.push(tag=True)
+
+    def issue_attributes(self, project, author):
+        iid = self.random.randint(1, 5000)
+        created_at = self.timestamp()
+        return {
+            'id': self.next_id(),
+            'iid': iid,
+            'title': self.title(),
+            'description': self.text(self.description_size),
+            'state': 'opened',
+            'author_id': author['id'],
+            'assignee_id': self.random.choice(self.users)['id'] if self.random.random() < 0.5 else None,
+            'project_id': project['id'],
+            'milestone_id': None,
+            'confidential': False,
+            'created_at': created_at,
+            'updated_at': created_at,
+            'url': '%s/issues/%d' % (project['web_url'], iid),
+        }
+
+    def issue(self):
+        project = self.random.choice(self.projects)
+        user = self.random.choice(self.users)
+        attributes = self.issue_attributes(project, user)
+        attributes['action'] = self.random.choice(('open', 'open', 'update', 'close', 'reopen'))
+        attributes['state'] = 'closed' if attributes['action'] == 'close' else 'opened'
+        return {
+            'object_kind': constants.ISSUE_EVENT,
+            'user': self.user(user),
+            'project': project,
+            'repository': self.repository(project),
+            'object_attributes': attributes,
+            'labels': [{'title': self.random.choice(('bug', 'feature', 'needs review', 'régression', '優先'))} for __ in range(self.random.randint(0, 3))],
+        }
+
+    def merge_request_attributes(self, project, author):
+        iid = self.random.randint(1, 5000)
+        created_at = self.timestamp()
+        return {
+            'id': self.next_id(),
+            'iid': iid,
+            'title': self.title(),
+            'description': self.text(self.description_size),
+            'state': 'opened',
+            'merge_status': 'unchecked',
+            'author_id': author['id'],
+            'assignee_id': self.random.choice(self.users)['id'] if self.random.random() < 0.5 else None,
+            'source_branch': self.branch(),
+            'target_branch': 'master',
+            'source_project_id': project['id'],
+            'target_project_id': project['id'],
+            'source': project,
+            'target': project,
+            'last_commit': self.commit(project, author),
+            'work_in_progress': self.random.random() < 0.1,
+            'created_at': created_at,
+            'updated_at': created_at,
+            'url': '%s/merge_requests/%d' % (project['web_url'], iid),
+        }
+
+    def merge_request(self):
+        project = self.random.choice(self.projects)
+        user = self.random.choice(self.users)
+        attributes = self.merge_request_attributes(project, user)
+        attributes['action'] = self.random.choice(('open', 'open', 'update', 'update', 'merge', 'close', 'reopen'))
+        attributes['state'] = {'merge': 'merged', 'close': 'closed'}.get(attributes['action'], 'opened')
+        return {
+            'object_kind': constants.MERGE_EVENT,
+            'user': self.user(user),
+            'project': project,
+            'repository': self.repository(project),
+            'object_attributes': attributes,
+        }
+
+    def note(self):
+        project = self.random.choice(self.projects)
+        user = self.random.choice(self.users)
+        noteable_type = self.random.choice(('Issue', 'Issue', 'MergeRequest', 'MergeRequest', 'Commit', 'Snippet'))
+        created_at = self.timestamp()
+        payload = {
+            'object_kind': constants.COMMENT_EVENT,
+            'user': self.user(user),
+            'project_id': project['id'],
+            'project': project,
+            'repository': self.repository(project),
+        }
+
+        if noteable_type == 'Issue':
+            payload['issue'] = parent = self.issue_attributes(project, self.random.choice(self.users))
+            anchor = parent['url']
+        elif noteable_type == 'MergeRequest':
+            payload['merge_request'] = parent = self.merge_request_attributes(project, self.random.choice(self.users))
+            anchor = parent['url']
+        elif noteable_type == 'Commit':
+            payload['commit'] = parent = self.commit(project)
+            anchor = parent['url']
+        else:
+            iid = self.random.randint(1, 500)
+            payload['snippet'] = parent = {'id': self.next_id(), 'iid': iid, 'title': self.title(), 'file_name': 'snippet.py'}
+            anchor = '%s/snippets/%d' % (project['web_url'], iid)
+
+        note_id = self.next_id()
+        payload['object_attributes'] = {
+            'id': note_id,
+            'note': self.text(max(self.description_size // 4, 1)),
+            'noteable_type': noteable_type,
+            'noteable_id': parent.get('id') if noteable_type != 'Commit' else None,
+            'commit_id': parent['id'] if noteable_type == 'Commit' else None,
+            'author_id': user['id'],
+            'project_id': project['id'],
+            'system': False,
+            'created_at': created_at,
+            'updated_at': created_at,
+            'url': '%s#note_%d' % (anchor, note_id),
+        }
+        return payload
+
+    def jobs(self, project):
+        jobs = []
+        for stage in STAGES[:self.random.randint(1, len(STAGES))]:
+            for name in self.random.sample(JOB_NAMES[stage], self.random.randint(1, len(JOB_NAMES[stage]))):
+                jobs.append({'id': self.next_id(), 'stage': stage, 'name': name})
+        return jobs
+
+    def job_status(self):
+        return self.random.choice(('created', 'pending', 'running', 'running', 'success', 'success', 'success', 'failed', 'canceled', 'skipped'))
+
+    def build(self):
+        project = self.random.choice(self.projects)
+        user = self.random.choice(self.users)
+        job = self.random.choice(self.jobs(project))
+        status = self.job_status()
+        commit = self.commit(project, user)
+        started = self.timestamp() if status not in ('created', 'pending') else None
+        finished = self.timestamp() if status in ('success', 'failed', 'canceled') else None
+        return {
+            'object_kind': constants.BUILD_EVENT,
+            'ref': self.branch(),
+            'tag': False,
+            'before_sha': self.sha(),
+            'sha': commit['id'],
+            'build_id': job['id'],
+            'build_name': job['name'],
+            'build_stage': job['stage'],
+            'build_status': status,
+            'build_started_at': started,
+            'build_finished_at': finished,
+            'build_duration': self.random.uniform(1, 600) if finished else None,
+            'build_allow_failure': job['name'] == 'flaky',
+            'project_id': project['id'],
+            'project_name': '%s / %s' % (project['namespace'], project['name']),
+            'user': {'id': user['id'], 'name': user['name'], 'email': user['email']},
+            'commit': {
+                'id': self.next_id(),
+                'sha': commit['id'],
+                'message': commit['message'],
+                'author_name': commit['author']['name'],
+                'author_email': commit['author']['email'],
+                'status': 'running',
+                'duration': None,
+                'started_at': started,
+                'finished_at': None,
+            },
+            'repository': self.repository(project),
+        }
+
+    def pipeline(self):
+        project = self.random.choice(self.projects)
+        user = self.random.choice(self.users)
+        commit = self.commit(project, user)
+        jobs = self.jobs(project)
+        builds = []
+        for job in jobs:
+            status = self.job_status()
+            builds.append({
+                'id': job['id'],
+                'stage': job['stage'],
+                'name': job['name'],
+                'status': status,
+                'created_at': self.timestamp(),
+                'started_at': self.timestamp() if status not in ('created', 'pending') else None,
+                'finished_at': self.timestamp() if status in ('success', 'failed', 'canceled') else None,
+                'when': 'on_success',
+                'manual': False,
+                'user': self.user(user),
+                'runner': None,
+                'artifacts_file': {'filename': None, 'size': None},
+            })
+        statuses = set(build['status'] for build in builds)
+        status = next((candidate for candidate in ('failed', 'running', 'pending', 'created', 'canceled') if candidate in statuses), 'success')
+        pipeline_id = self.next_id()
+        return {
+            'object_kind': constants.CI_EVENT,
+            'object_attributes': {
+                'id': pipeline_id,
+                'ref': self.branch(),
+                'tag': False,
+                'sha': commit['id'],
+                'before_sha': self.sha(),
+                'status': status,
+                'stages': sorted(set(job['stage'] for job in jobs), key=STAGES.index),
+                'created_at': self.timestamp(),
+                'finished_at': self.timestamp() if status in ('success', 'failed', 'canceled') else None,
+                'duration': self.random.randint(10, 3600) if status in ('success', 'failed') else None,
+            },
+            'user': self.user(user),
+            'project': project,
+            'commit': commit,
+            # GitLab lists the most recent jobs first
+            'builds': builds[::-1],
+        }
+
+    GENERATORS = {
+        constants.PUSH_EVENT: push,
+        constants.TAG_EVENT: tag_push,
+        constants.ISSUE_EVENT: issue,
+        constants.COMMENT_EVENT: note,
+        constants.MERGE_EVENT: merge_request,
+        constants.BUILD_EVENT: build,
+        constants.CI_EVENT: pipeline,
+    }
+
+    def generate(self, kind=None):
+        """
+        Generates a payload of the given kind, or of a kind picked according to DEFAULT_WEIGHTS
+        """
+
+        if kind is None:
+            kind = self.random.choice([kind for kind in KINDS for __ in range(DEFAULT_WEIGHTS[kind])])
+        return self.GENERATORS[kind](self)
+
+    def stream(self, count, kinds=None):
+        """
+        Yields `count` payloads, cycling through `kinds` if given
+        """
+
+        cycle = itertools.cycle(kinds) if kinds else itertools.repeat(None)
+        for __ in range(count):
+            yield self.generate(next(cycle))
+
+
+def write_ndjson(payloads, fp):
+    for payload in payloads:
+        fp.write(json.dumps(payload, sort_keys=True) + '\n')
+
+
+def write_files(payloads, directory):
+    """
+    Writes payloads as <directory>/<object_kind>/<index>.json, like the fixtures of the tests
+    """
+
+    for index, payload in enumerate(payloads):
+        kind_directory = os.path.join(directory, payload['object_kind'])
+        if not os.path.isdir(kind_directory):
+            os.makedirs(kind_directory)
+        with codecs.open(os.path.join(kind_directory, '%06d.json' % index), 'w', encoding='utf-8') as fp:
+            json.dump(payload, fp, sort_keys=True, indent=4)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Generates synthetic GitLab webhook payloads')
+    parser.add_argument('-n', '--count', type=int, default=100, help='Number of payloads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--kind', dest='kinds', action='append', choices=KINDS, default=[],
+                        help='Only generate payloads of that kind, in turn when given several times')
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--max-commits', type=int, default=20, help='Maximum commits of a push')
+    parser.add_argument('--commit-limit', type=int, default=None, help='Commits listed in a push payload, GitLab lists 20')
+    parser.add_argument('--description-size', type=int, default=500, help='Characters of issue, merge request and comment texts')
+    parser.add_argument('--uploads', type=int, default=2, help='Maximum upload links in a text')
+    parser.add_argument('--unicode-ratio', type=float, default=0.2, help='Share of non-ASCII words in texts')
+    parser.add_argument('--gitlab-url', default='http://gitlab.example.com')
+    parser.add_argument('-o', '--output', default=None, metavar='DIR',
+                        help='Write one JSON file per payload in DIR/<object_kind>/, instead of NDJSON on the standard output')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    generator = PayloadGenerator(
+        seed=args.seed,
+        projects=args.projects,
+        users=args.users,
+        max_commits=args.max_commits,
+        commit_limit=args.commit_limit,
+        description_size=args.description_size,
+        uploads=args.uploads,
+        unicode_ratio=args.unicode_ratio,
+        gitlab_url=args.gitlab_url,
+    )
+    payloads = generator.stream(args.count, args.kinds)
+
+    if args.output:
+        write_files(payloads, args.output)
+    else:
+        # json.dumps escapes non-ASCII characters, so the output is plain ASCII
+        write_ndjson(payloads, io.open(sys.stdout.fileno(), 'w', encoding='ascii', closefd=False))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -5,15 +5,30 @@
 from __future__ import unicode_literals, absolute_import, print_function
 
 # Python System imports
+import calendar
 import os
+import glob
+import pstats
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
 import json
 import codecs
+import threading
+import time
 
 # Third-party imports
+import requests
 
-from mattermost_gitlab.mock_http import MockHttpServerMixin, get_available_port
-from mattermost_gitlab import server
+from mattermost_gitlab.mock_http import MockHttpServerMixin, TestServer
+from mattermost_gitlab import server, admission, delivery, event_formatter, digest, rules, reloader, mattermost_api, synthetic, state, offline, mentions, enrichment, history, lag, deadletter, eventstore
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import soak  # noqa: E402
 
 
 def relative_path(name):
@@ -43,9 +58,63 @@ class BaseTest(FlaskMixin):
         self.assertEqual(resp.status_code, 405)
 
 
+class MockServerTest(unittest.TestCase):
+
+    def setUp(self):
+        super(MockServerTest, self).setUp()
+        self.server = TestServer(capture_limit=3)
+        self.server.start()
+
+    def tearDown(self):
+        super(MockServerTest, self).tearDown()
+        self.server.stop_server()
+
+    def test_ephemeral_ports(self):
+        other = TestServer()
+        other.start()
+        try:
+            self.assertNotEqual(self.server.port, other.port)
+            requests.post(other.url, data='x')
+            self.assertEqual(len(other.httpd.received_requests), 1)
+            self.assertEqual(len(self.server.httpd.received_requests), 0)
+        finally:
+            other.stop_server()
+
+    def test_bounded_capture(self):
+        for index in range(5):
+            requests.post(self.server.url, data=str(index))
+        self.assertEqual(self.server.httpd.request_count, 5)
+        self.assertEqual([r['post'] for r in self.server.httpd.received_requests], [b'2', b'3', b'4'])
+
+    def test_rate_limit(self):
+        self.server.httpd.add_rate_limit(retry_after=7)
+        resp = requests.post(self.server.url, data='x')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '7')
+        self.assertEqual(requests.post(self.server.url, data='x').status_code, 200)
+
+    def test_error_and_drop(self):
+        self.server.httpd.add_response(status=503)
+        self.server.httpd.add_drop()
+        self.assertEqual(requests.post(self.server.url, data='x').status_code, 503)
+        with self.assertRaises(requests.ConnectionError):
+            requests.post(self.server.url, data='x')
+
+    def test_concurrent_latency(self):
+        self.server.httpd.latency = 0.3
+        threads = [threading.Thread(target=requests.post, args=(self.server.url,), kwargs={'data': 'x'}) for __ in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 0.8)
+
+
 class ServerTestMixin(MockHttpServerMixin, FlaskMixin):
 
-    port = get_available_port()
     url = '/new_event'
 
     def setUp(self):
@@ -168,5 +237,1448 @@ class BuildTest(ServerTestMixin):
         self.assertResponse("gitlab/build/successful_build")
 
 
+class PipelineTest(ServerTestMixin):
+
+    def test_failed_pipeline(self):
+        self.assertResponse("gitlab/pipeline/failed_pipeline")
+
+    def test_running_pipeline(self):
+        self.assertResponse("gitlab/pipeline/running_pipeline")
+
+    def test_ci_endpoint(self):
+        self.url = "/new_ci_event"
+        self.assertResponse("gitlab/pipeline/failed_pipeline")
+
+    def test_no_build(self):
+        _, _, options = server.parse_args(["http://127.0.0.1:{}".format(self.port), "--no-build"])
+        server.app.config.update(options)
+        self.url = "/new_ci_event"
+        self.assertResponseNotSent("gitlab/build/failed_build")
+        self.assertResponse("gitlab/pipeline/failed_pipeline")
+
+    def test_no_ci(self):
+        _, _, options = server.parse_args(["http://127.0.0.1:{}".format(self.port), "--no-ci"])
+        self.assertEqual(options['REPORT_EVENTS']['build'], False)
+        self.assertEqual(options['REPORT_EVENTS']['pipeline'], False)
+
+
+class SyntheticPayloadTest(ServerTestMixin):
+
+    def test_reproducible(self):
+        first = list(synthetic.PayloadGenerator(seed=3).stream(20))
+        second = list(synthetic.PayloadGenerator(seed=3).stream(20))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, list(synthetic.PayloadGenerator(seed=4).stream(20)))
+
+    def test_every_kind_is_handled(self):
+        server.app.config['REPORT_EVENTS'] = dict((kind, True) for kind in synthetic.KINDS)
+        generator = synthetic.PayloadGenerator(seed=1, max_commits=3000, description_size=20000, uploads=10)
+        for payload in generator.stream(len(synthetic.KINDS) * 3, synthetic.KINDS):
+            event = event_formatter.as_event(payload)
+            if event.action == 'update':
+                continue
+            self.assertTrue(event.format())
+            resp = self.app.post(self.url, data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+        self.assertGreater(len(self.server.httpd.received_requests), len(synthetic.KINDS))
+
+    def test_sizes(self):
+        generator = synthetic.PayloadGenerator(seed=1, max_commits=5000, commit_limit=20, description_size=100000)
+        pushes = list(generator.stream(30, ['push']))
+        self.assertGreater(max(push['total_commits_count'] for push in pushes), 20)
+        self.assertTrue(all(len(push['commits']) <= 20 for push in pushes))
+        self.assertGreaterEqual(len(generator.generate('issue')['object_attributes']['description']), 100000)
+
+    def test_output(self):
+        directory = tempfile.mkdtemp()
+        try:
+            synthetic.main(['-n', '5', '--kind', 'issue', '--kind', 'tag_push', '--output', directory])
+            self.assertEqual(sorted(os.listdir(directory)), ['issue', 'tag_push'])
+            self.assertEqual(len(glob.glob(os.path.join(directory, '*', '*.json'))), 5)
+        finally:
+            shutil.rmtree(directory)
+
+
+class OfflineFormatTest(MockHttpServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(OfflineFormatTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'messages.ndjson')
+        self.payloads = os.path.join(self.directory, 'payloads.ndjson')
+        with codecs.open(self.payloads, 'w', encoding='utf-8') as fp:
+            for name in ("push/commit_master_branch", "issue/update_issue", "issue/close_issue", "note/issue_note"):
+                fp.write(json.dumps(json.loads(file_content("gitlab/%s.json" % name))) + '\n')
+            fp.write('{"object_kind": "wiki_page"}\n')
+
+    def tearDown(self):
+        super(OfflineFormatTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def messages(self):
+        with codecs.open(self.output, encoding='utf-8') as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_format(self):
+        status = offline.main(['-o', self.output, '--push', self.payloads, relative_path('gitlab/tag_push/tag.json')])
+        self.assertEqual(status, 1)
+        self.assertEqual(
+            [message['text'].strip() for message in self.messages()],
+            [file_content("gitlab/%s.md" % name) for name in ("push/commit_master_branch", "issue/close_issue", "note/issue_note")],
+        )
+
+    def test_processes(self):
+        offline.main(['-o', self.output, '-j', '2', '--no-comment', self.payloads])
+        self.assertEqual([message['object_kind'] for message in self.messages()], ['issue'])
+        self.assertEqual(len(delivery.load_messages(self.output)), 1)
+
+    def test_deliver(self):
+        start = time.time()
+        offline.main(['-o', self.output, '--push', '--deliver', self.server.url, '--rate', '20', self.payloads])
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        texts = [json.loads(r["post"].decode())["text"] for r in self.server.httpd.received_requests]
+        self.assertEqual(texts, [message['text'].strip() for message in self.messages()])
+        self.assertEqual(len(texts), 3)
+
+
+class LoadSheddingTest(ServerTestMixin):
+
+    def setUp(self):
+        super(LoadSheddingTest, self).setUp()
+        server.app.config['ADMISSION_LIMITS'] = admission.Limits(max_load=3, kind_limits={'push': 1}, retry_after=42)
+
+    def tearDown(self):
+        super(LoadSheddingTest, self).tearDown()
+        server.admission_control.backlog = lambda: 0
+
+    def test_low_value_events_are_shed_first(self):
+        server.admission_control.backlog = lambda: 1
+
+        resp = self.post("gitlab/push/commit_master_branch.json")
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '42')
+        self.assertResponse("gitlab/issue/open_issue")
+
+    def test_overloaded(self):
+        server.admission_control.backlog = lambda: 3
+
+        resp = self.post("gitlab/issue/open_issue.json")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '42')
+        self.assertEqual(len(self.server.httpd.received_requests), 0)
+
+    def test_rejected_from_header(self):
+        server.admission_control.backlog = lambda: 1
+
+        resp = self.app.post(self.url, data='not even json', content_type='text/plain', headers={'X-Gitlab-Event': 'Push Hook'})
+        self.assertEqual(resp.status_code, 429)
+
+    def test_delivery_failure_is_retried(self):
+        self.server.httpd.add_rate_limit(retry_after=7)
+
+        resp = self.post("gitlab/issue/open_issue.json")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '7')
+
+    def test_parse_args(self):
+        _, _, options = server.parse_args(["http://mattermost", "--max-pending", "50", "--shed-at", "push=10", "--shed-at", "tag_push=5"])
+        self.assertEqual(options['ADMISSION_LIMITS'].max_load, 50)
+        self.assertEqual(options['ADMISSION_LIMITS'].kind_limits, {'push': 10, 'tag_push': 5})
+
+
+class GitLabLinksTest(unittest.TestCase):
+
+    def test_fix_gitlab_links(self):
+        text = '![img](/uploads/a.png) and [doc](/uploads/b.pdf), [site](http://example.com/c)'
+        self.assertEqual(event_formatter.fix_gitlab_links('http://gitlab.example.com/root/example', text), (
+            '![img](http://gitlab.example.com/root/example/uploads/a.png) and [doc](http://gitlab.example.com/root/example/uploads/b.pdf), '
+            '[site](http://example.com/c)'
+        ))
+
+
+class DeliveryQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        super(DeliveryQueueTest, self).setUp()
+        self.delivered = []
+        self.queue = delivery.DeliveryQueue(self.delivered.append, workers=0, aging=30)
+        self.priorities = delivery.PriorityClasses({'note': 5})
+
+    def message(self, text, object_kind, action=None, project=1, ref=None, age=0):
+        message = delivery.Message(text, object_kind, action, project, ref, priority=self.priorities.lookup(object_kind, action))
+        message.enqueued_at -= age
+        return message
+
+    def take(self):
+        message = self.queue.get(timeout=0)
+        if message is not None:
+            self.queue.task_done(message)
+            return message.text
+
+    def test_priority_classes(self):
+        self.assertEqual(self.priorities.lookup('build', 'failed'), 0)
+        self.assertEqual(self.priorities.lookup('build', 'success'), 2)
+        self.assertEqual(self.priorities.lookup('note'), 5)
+        self.assertEqual(self.priorities.lookup('unknown'), 2)
+
+    def test_priority_order(self):
+        self.queue.put(self.message('push', 'push', ref='master'))
+        self.queue.put(self.message('issue', 'issue', 'open'))
+        self.queue.put(self.message('failed', 'build', 'failed', ref='dev'))
+        self.assertEqual([self.take() for __ in range(4)], ['failed', 'issue', 'push', None])
+
+    def test_aging(self):
+        self.queue.put(self.message('failed', 'build', 'failed', ref='dev'))
+        self.queue.put(self.message('old push', 'push', ref='master', age=100))
+        self.assertEqual([self.take(), self.take()], ['old push', 'failed'])
+
+    def test_order_within_project_and_ref(self):
+        self.queue.put(self.message('push', 'push', ref='master'))
+        self.queue.put(self.message('failed', 'build', 'failed', ref='master'))
+        self.queue.put(self.message('other project', 'push', project=2, ref='master'))
+
+        first = self.queue.get(timeout=0)
+        self.assertEqual(first.text, 'push')
+        # the failed build waits for the push before it to be delivered
+        self.assertEqual(self.take(), 'other project')
+        self.assertIsNone(self.take())
+        self.queue.task_done(first)
+        self.assertEqual(self.take(), 'failed')
+        self.assertEqual(len(self.queue), 0)
+
+    def test_workers(self):
+        attempts = []
+
+        def flaky(message):
+            attempts.append(message.text)
+            if len(attempts) == 1:
+                raise server.DeliveryError('blip', retry_after=0)
+            self.delivered.append(message.text)
+
+        self.queue.deliver = flaky
+        for index in range(5):
+            self.queue.put(self.message(str(index), 'push', ref='master'))
+        self.queue.workers = 2
+        self.queue.start()
+        try:
+            self.assertTrue(self.queue.join(timeout=5))
+        finally:
+            self.queue.stop()
+        self.assertEqual(self.delivered, ['0', '1', '2', '3', '4'])
+        self.assertEqual(len(attempts), 6)
+
+    def test_no_batching_without_backlog(self):
+        self.queue.batch_threshold = 3
+        for index in range(3):
+            self.queue.put(self.message(str(index), 'push', project=index))
+        self.assertEqual([self.take() for __ in range(3)], ['0', '1', '2'])
+
+    def test_batching(self):
+        self.queue.batch_threshold = 3
+        self.queue.batch_max_chars = 20
+        for index in range(3):
+            self.queue.put(self.message('push %d' % index, 'push', project=index, ref='master'))
+        self.queue.put(self.message('note', 'note', project=0))
+        self.queue.put(self.message('build', 'build', project=0, ref='master'))
+        other = self.message('other channel', 'push', project=5)
+        other.channel = 'town-square'
+        self.queue.put(other)
+
+        batch = self.queue.get(timeout=0)
+        self.assertEqual(batch.text, 'push 0\n\n---\n\nbuild')
+        self.assertEqual([part.text for part in batch.parts], ['push 0', 'build'])
+        self.queue.task_done(batch)
+        self.assertEqual(self.queue.delivered, 2)
+        self.assertEqual(len(self.queue), 4)
+        # the others no longer are a backlog
+        self.assertEqual([self.take() for __ in range(5)], ['push 1', 'push 2', 'other channel', 'note', None])
+
+
+class DigestTest(ServerTestMixin):
+
+    def setUp(self):
+        super(DigestTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.directory, 'digest.json')
+        server.app.config['DIGEST_RULES'] = digest.DigestRules(['push', 'tag_push'], branches=['dev', 'v*'])
+        server.digest_store = digest.Digest(server.deliver, snapshot=self.snapshot)
+
+    def tearDown(self):
+        super(DigestTest, self).tearDown()
+        server.digest_store = None
+        shutil.rmtree(self.directory)
+
+    def test_digest(self):
+        self.assertResponseNotSent("gitlab/push/create_dev_branch")
+        self.assertResponseNotSent("gitlab/push/commit_dev_branch")
+        self.assertResponseNotSent("gitlab/tag_push/tag")
+        self.assertResponse("gitlab/push/commit_master_branch")
+        self.server.httpd.reset()
+
+        self.assertEqual(server.digest_store.flush(), 1)
+        self.assertEqual(len(self.server.httpd.received_requests), 1)
+        text = json.loads(self.server.httpd.received_requests[0]["post"].decode())["text"]
+        lines = text.splitlines()
+        self.assertTrue(lines[0].startswith('#### GitLab digest since '))
+        self.assertEqual(lines[1:], [
+            '* [example repository](http://gitlab.example.com/root/example-repository) `dev`: 2 pushes, 1 commit by Example User',
+            '* [example repository](http://gitlab.example.com/root/example-repository): 1 tag `v0.1` by Example User',
+        ])
+
+        self.assertEqual(server.digest_store.flush(), 0)
+
+    def test_memory_cap(self):
+        server.digest_store.max_entries = 1
+        self.assertResponseNotSent("gitlab/push/commit_dev_branch")
+        self.assertResponseNotSent("gitlab/tag_push/tag")
+        self.assertIn('_and 1 more events_', server.digest_store.render(server.digest_store.channels['']))
+
+    def test_failed_flush_is_merged(self):
+        event = event_formatter.as_event(json.loads(file_content("gitlab/push/commit_dev_branch.json")))
+        tag = event_formatter.as_event(json.loads(file_content("gitlab/tag_push/tag.json")))
+        delivered = []
+
+        def deliver(message):
+            # events keep coming while the digest is being delivered
+            store.add(event)
+            store.add(tag)
+            raise delivery.DeliveryError('unavailable')
+
+        store = digest.Digest(deliver, max_entries=1)
+        store.add(event)
+        since = store.channels['']['since']
+        self.assertEqual(store.flush(), 1)
+
+        bucket = store.channels['']
+        self.assertEqual(bucket['since'], since)
+        self.assertEqual(list(bucket['entries']), [digest.Digest.summarize(event)['key']])
+        self.assertEqual(bucket['entries'][digest.Digest.summarize(event)['key']]['events'], 2)
+        self.assertEqual(bucket['overflow'], 1)
+
+        store.deliver = delivered.append
+        self.assertEqual(store.flush(), 1)
+        self.assertIn('`dev`: 2 pushes, 2 commits', delivered[0].text)
+        self.assertIn('_and 1 more events_', delivered[0].text)
+
+    def test_snapshot(self):
+        self.assertResponseNotSent("gitlab/push/commit_dev_branch")
+        server.digest_store.stop()
+
+        restored = digest.Digest(server.deliver, snapshot=self.snapshot)
+        self.assertEqual(restored.flush(), 1)
+        self.assertIn('`dev`: 1 push, 1 commit', json.loads(self.server.httpd.received_requests[0]["post"].decode())["text"])
+
+
+class SharedDigestTest(ServerTestMixin):
+
+    def setUp(self):
+        super(SharedDigestTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'state.db')
+        self.replicas = [digest.SharedDigest(server.deliver, state.SQLiteBackend(path)) for __ in range(2)]
+
+    def tearDown(self):
+        super(SharedDigestTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def event(self, name):
+        return event_formatter.as_event(json.loads(file_content(name)))
+
+    def test_one_digest_for_all_replicas(self):
+        self.replicas[0].add(self.event("gitlab/push/commit_dev_branch.json"))
+        self.replicas[1].add(self.event("gitlab/push/create_dev_branch.json"))
+        self.replicas[1].add(self.event("gitlab/tag_push/tag.json"))
+
+        self.assertEqual(self.replicas[1].flush(), 1)
+        self.assertEqual(self.replicas[0].flush(), 0)
+        self.assertEqual(len(self.server.httpd.received_requests), 1)
+        text = json.loads(self.server.httpd.received_requests[0]["post"].decode())["text"]
+        self.assertIn('`dev`: 2 pushes, 1 commit by Example User', text)
+        self.assertIn('1 tag `v0.1`', text)
+        self.assertFalse(self.replicas[0].flush_on_stop)
+
+    def test_event_cap(self):
+        backend = self.replicas[0].state
+        batches = []
+        batch = backend.batch
+        backend.batch = lambda operations: batches.append(operations) or batch(operations)
+        self.replicas[0].max_events = 1
+        self.replicas[0].add(self.event("gitlab/push/commit_dev_branch.json"))
+        self.replicas[0].add(self.event("gitlab/tag_push/tag.json"))
+        # counted and summarised in the same transaction
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(len(backend.hash_get('digest:')), 1)
+        self.replicas[0].flush()
+        self.assertIn('_and 1 more events_', json.loads(self.server.httpd.received_requests[0]["post"].decode())["text"])
+
+
+class StateBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        super(StateBackendTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'state.db')
+        self.backends = [state.MemoryBackend(), state.SQLiteBackend(path)]
+
+    def tearDown(self):
+        super(StateBackendTest, self).tearDown()
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.directory)
+
+    def test_operations(self):
+        for backend in self.backends:
+            self.assertEqual(backend.batch([
+                ('set', 'a', {'x': 1}),
+                ('get', 'a'),
+                ('add', 'a', 2),
+                ('add', 'b', 'é'),
+                ('incr', 'n', 2),
+                ('incr', 'n'),
+                ('pop', 'b'),
+                ('get', 'b'),
+                ('hash_update', 'h', {'f': [1], 'g': None}),
+                ('hash_update', 'h', {'f': [2]}),
+                ('hash_update', 'h', {'k': 3}, None, 2),
+                ('hash_get', 'h'),
+                ('hash_pop_all', 'h'),
+                ('hash_get', 'h'),
+                ('get', 'missing'),
+            ]), [None, {'x': 1}, False, True, 2, 3, 'é', None, True, True, False, {'f': [2], 'g': None}, {'f': [2], 'g': None}, {}, None])
+            with self.assertRaises(ValueError):
+                backend.batch([('eval', 'x')])
+
+    def test_expiry(self):
+        for backend in self.backends:
+            backend.batch([('set', 'a', 1, 0.05), ('hash_update', 'h', {'f': 1}, 0.05), ('incr', 'n', 1, 0.05)])
+            self.assertEqual(backend.get('a'), 1)
+            time.sleep(0.1)
+            self.assertEqual(backend.batch([('get', 'a'), ('hash_get', 'h'), ('add', 'a', 2), ('incr', 'n')]), [None, {}, True, 1])
+
+    def test_network_filesystem(self):
+        mounts = os.path.join(self.directory, 'mounts')
+        with open(mounts, 'w') as fp:
+            fp.write('/dev/sda1 / ext4 rw 0 0\nserver:/export /mnt/shared\\040state nfs4 rw 0 0\n/dev/sdb1 /mnt/shared\\040state/local ext4 rw 0 0\n')
+        self.assertEqual(state.network_filesystem('/mnt/shared state/state.db', mounts), 'nfs4')
+        self.assertIsNone(state.network_filesystem('/mnt/shared state/local/state.db', mounts))
+        self.assertIsNone(state.network_filesystem('/mnt/shared/state.db', mounts))
+        self.assertIsNone(state.network_filesystem('/mnt/shared state/state.db', os.path.join(self.directory, 'missing')))
+
+    def test_memory_bound(self):
+        backend = state.MemoryBackend(max_keys=2)
+        for key in ('a', 'b', 'a', 'c'):
+            backend.set(key, key)
+        self.assertEqual([backend.get(key) for key in ('a', 'b', 'c')], ['a', None, 'c'])
+
+    def test_shared_between_processes(self):
+        path = os.path.join(self.directory, 'state.db')
+        script = 'from mattermost_gitlab import state; print(state.SQLiteBackend(%r).incr("n"))' % path
+        for expected in (1, 2):
+            output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.join(os.path.dirname(__file__), '..'))
+            self.assertEqual(int(output), expected)
+        self.assertEqual(self.backends[1].get('n'), 2)
+
+
+class RulesTest(ServerTestMixin):
+
+    def rule_set(self, specs, default='keep'):
+        return rules.RuleSet(specs, default)
+
+    def payload(self, name):
+        return json.loads(file_content(name + ".json"))
+
+    def test_branches(self):
+        rule_set = self.rule_set([
+            {"kind": "push", "branch": ["dev", "release/*"]},
+            {"kind": "push", "decision": "drop"},
+        ])
+        self.assertTrue(rule_set.allows(self.payload("gitlab/push/commit_dev_branch")))
+        self.assertFalse(rule_set.allows(self.payload("gitlab/push/commit_master_branch")))
+        self.assertTrue(rule_set.allows(self.payload("gitlab/issue/open_issue")))
+        self.assertEqual([rule['hits'] for rule in rule_set.stats()['rules']], [1, 1])
+        self.assertEqual(rule_set.stats()['unmatched'], 1)
+
+    def test_fields(self):
+        rule_set = self.rule_set([
+            {"author": "ro*", "kind": "note", "decision": "drop"},
+            {"kind": "build", "status": "failed"},
+            {"project": ["root/example-repository"], "action": ["open", "close"]},
+            {"kind": "push", "path": "*.md", "decision": "drop"},
+        ], default='drop')
+        self.assertFalse(rule_set.allows(self.payload("gitlab/note/issue_note")))
+        self.assertTrue(rule_set.allows(self.payload("gitlab/build/failed_build")))
+        self.assertFalse(rule_set.allows(self.payload("gitlab/build/successful_build")))
+        self.assertTrue(rule_set.allows(self.payload("gitlab/issue/open_issue")))
+        self.assertTrue(rule_set.allows(self.payload("gitlab/merge_request/open_merge_request")))
+        self.assertFalse(rule_set.allows(self.payload("gitlab/issue/reopen_issue")))
+
+    def test_labels(self):
+        payload = self.payload("gitlab/merge_request/open_merge_request")
+        rule_set = self.rule_set([{"kind": "merge_request", "label": "needs review"}], default='drop')
+        self.assertFalse(rule_set.allows(payload))
+        payload['labels'] = [{'title': 'needs review'}]
+        self.assertTrue(rule_set.allows(payload))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.rule_set([{"colour": "red"}])
+        with self.assertRaises(ValueError):
+            self.rule_set([{"decision": "maybe"}])
+
+    def test_server(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'rules.json')
+            with open(path, 'w') as fp:
+                json.dump({"rules": [{"kind": "issue", "action": "close", "decision": "drop"}]}, fp)
+            _, _, options = server.parse_args(["http://127.0.0.1:{}".format(self.port), "--rules", path])
+        finally:
+            shutil.rmtree(directory)
+        server.app.config.update(options)
+
+        self.assertResponseNotSent("gitlab/issue/close_issue")
+        self.assertResponse("gitlab/issue/open_issue")
+
+
+class ReloadTest(ServerTestMixin):
+
+    def setUp(self):
+        super(ReloadTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mattermost-gitlab.conf')
+        self.write_config('--channel "town square"  # posted there\n--push\n')
+        self.args = ["http://127.0.0.1:{}".format(self.port), "@" + self.path]
+        server.app.config.update(server.parse_args(self.args)[2])
+        self.reloader = reloader.ConfigReloader(
+            load=lambda: server.parse_args(self.args)[2],
+            apply=server.apply_config,
+            paths=lambda: server.config_files(self.args),
+        )
+
+    def tearDown(self):
+        super(ReloadTest, self).tearDown()
+        self.reloader.stop()
+        shutil.rmtree(self.directory)
+
+    def write_config(self, content):
+        with open(self.path, 'w') as fp:
+            fp.write(content)
+        # make sure the modification time changes, whatever the filesystem resolution
+        os.utime(self.path, (time.time(), time.time() + getattr(self, 'writes', 0) + 1))
+        self.writes = getattr(self, 'writes', 0) + 1
+
+    def test_config_file(self):
+        self.assertEqual(server.app.config['CHANNEL'], 'town square')
+        self.assertTrue(server.app.config['REPORT_EVENTS']['push'])
+
+    def test_reload(self):
+        old_config = server.app.config
+        self.assertFalse(self.reloader.changed())
+
+        self.write_config('--channel dev\n')
+        self.assertTrue(self.reloader.changed())
+        self.assertTrue(self.reloader.reload())
+        self.assertFalse(self.reloader.changed())
+
+        self.assertEqual(server.app.config['CHANNEL'], 'dev')
+        self.assertFalse(server.app.config['REPORT_EVENTS']['push'])
+        self.assertEqual(old_config['CHANNEL'], 'town square')
+
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        self.assertEqual(json.loads(self.server.httpd.received_requests[0]["post"].decode())["channel"], 'dev')
+
+    def test_restart_changes(self):
+        def changes(*args):
+            return server.restart_changes(server.app.config, server.parse_args(self.args + list(args))[2])
+
+        self.assertEqual(changes('--channel', 'dev', '--push'), [])
+        self.assertEqual(changes('--event-store', 'events.db', '--dead-letters', 'dead.db'), ['EVENT_STORE', 'DEAD_LETTERS'])
+        self.assertEqual(changes('--digest', 'push'), ['DIGEST_RULES'])
+
+        server.app.config.update(server.parse_args(self.args + ['--digest', 'push'])[2])
+        self.assertEqual(changes('--digest', 'push', '--digest-branch', 'dev'), [])
+        self.assertEqual(changes(), ['DIGEST_RULES'])
+
+    def test_invalid_config_is_ignored(self):
+        old_config = server.app.config
+        self.write_config('--no-such-option\n')
+        self.assertFalse(self.reloader.reload())
+        self.assertIs(server.app.config, old_config)
+
+    def test_reload_on_request(self):
+        self.reloader.start()
+        self.write_config('--channel signalled\n')
+        self.reloader.request_reload()
+        for __ in range(100):
+            if server.app.config['CHANNEL'] == 'signalled':
+                break
+            time.sleep(0.01)
+        self.assertEqual(server.app.config['CHANNEL'], 'signalled')
+
+
+class ShutdownTest(ServerTestMixin):
+
+    def setUp(self):
+        super(ShutdownTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.spool_file = os.path.join(self.directory, 'spool.ndjson')
+        server.delivery_queue = delivery.DeliveryQueue(server.post_message, workers=1, max_attempts=1)
+
+    def tearDown(self):
+        super(ShutdownTest, self).tearDown()
+        server.delivery_queue.stop()
+        server.delivery_queue = None
+        server.accepting = True
+        shutil.rmtree(self.directory)
+
+    def test_drain(self):
+        self.server.httpd.latency = 0.05
+        server.delivery_queue.start()
+        for name in ("issue/open_issue", "issue/close_issue", "note/issue_note"):
+            self.assertGitlabHookWorks("gitlab/" + name)
+
+        report = server.shutdown(timeout=5, spool_file=self.spool_file)
+        self.assertEqual(report, {'delivered': 3, 'saved': 0, 'lost': 0})
+        self.assertEqual(len(self.server.httpd.received_requests), 3)
+
+        self.assertEqual(self.app.get('/ready').status_code, 503)
+        resp = self.post("gitlab/issue/open_issue.json")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+    def test_failures_are_spooled_without_dead_letters(self):
+        with self.assertRaises(SystemExit):
+            server.parse_args(["http://mattermost", "--delivery-workers", "2"])
+        server.parse_args(["http://mattermost", "--delivery-workers", "2", "--spool-file", self.spool_file])
+
+        server.delivery_queue = delivery.DeliveryQueue(server.post_message, workers=1, max_attempts=2, retry_delay=0,
+                                                       on_failure=server.spool_failures(self.spool_file))
+        server.delivery_queue.start()
+        self.server.httpd.add_response(status=500, repeat=2)
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        server.delivery_queue.join(5)
+
+        spooled, = delivery.load_messages(self.spool_file)
+        self.assertEqual(spooled.text, file_content("gitlab/issue/open_issue.md"))
+
+    def test_spool_and_replay(self):
+        # workers not started: nothing can be delivered before the deadline
+        for name in ("issue/open_issue", "issue/close_issue"):
+            self.assertGitlabHookWorks("gitlab/" + name)
+
+        report = server.shutdown(timeout=0.1, spool_file=self.spool_file)
+        self.assertEqual(report, {'delivered': 0, 'saved': 2, 'lost': 0})
+        self.assertEqual(len(self.server.httpd.received_requests), 0)
+
+        server.delivery_queue = None
+        server.accepting = True
+        self.assertEqual(server.replay_spool(self.spool_file), 2)
+        self.assertFalse(os.path.exists(self.spool_file))
+        texts = [json.loads(r["post"].decode())["text"] for r in self.server.httpd.received_requests]
+        self.assertEqual(texts, [file_content("gitlab/issue/open_issue.md"), file_content("gitlab/issue/close_issue.md")])
+        server.delivery_queue = delivery.DeliveryQueue(server.post_message)
+
+    def test_deadline_interrupts_retries(self):
+        server.delivery_queue = delivery.DeliveryQueue(server.post_message, workers=1, max_attempts=3)
+        server.delivery_queue.start()
+        self.server.httpd.add_rate_limit(retry_after=30)
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        while not self.server.httpd.request_count:
+            time.sleep(0.01)
+
+        start = time.time()
+        report = server.shutdown(timeout=0.5, spool_file=self.spool_file)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(report, {'delivered': 0, 'saved': 1, 'lost': 0})
+        self.assertEqual([m.object_kind for m in delivery.load_messages(self.spool_file)], ['issue'])
+
+    def test_message_in_flight_is_saved(self):
+        self.server.httpd.latency = 2
+        server.delivery_queue.start()
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+
+        start = time.time()
+        report = server.shutdown(timeout=0.3, spool_file=self.spool_file)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(report, {'delivered': 0, 'saved': 1, 'lost': 0})
+
+    def test_failed_replay_is_kept(self):
+        delivery.save_messages(self.spool_file, [delivery.Message('hello', 'issue')])
+        server.delivery_queue = None
+        self.server.httpd.add_response(status=500)
+        self.assertEqual(server.replay_spool(self.spool_file), 0)
+        self.assertEqual([m.text for m in delivery.load_messages(self.spool_file)], ['hello'])
+        server.delivery_queue = delivery.DeliveryQueue(server.post_message)
+
+
+class ApiModeTest(ServerTestMixin):
+
+    url = "/new_ci_event"
+
+    def setUp(self):
+        super(ApiModeTest, self).setUp()
+        api_url = "http://127.0.0.1:{}".format(self.port)
+        _, _, options = server.parse_args(["--mattermost-api-url", api_url, "--bot-token", "secret", "--channel-id", "town-square"])
+        server.app.config.update(options)
+        server.pipeline_posts = mattermost_api.PipelinePosts()
+
+    def test_requires_a_destination(self):
+        with self.assertRaises(SystemExit):
+            server.parse_args(["--channel-id", "town-square"])
+        with self.assertRaises(SystemExit):
+            server.parse_args(["--mattermost-api-url", "http://localhost"])
+
+    def test_one_post_per_commit(self):
+        for name in ("create_build_1", "create_build_2", "start_build_1", "failed_build", "successful_build"):
+            self.assertGitlabHookWorks("gitlab/build/" + name)
+
+        requests_sent = self.server.httpd.received_requests
+        self.assertEqual([r['path'] for r in requests_sent], ['/api/v4/posts'] + ['/api/v4/posts/post1/patch'] * 4)
+        self.assertEqual(requests_sent[0]['headers']['Authorization'], 'Bearer secret')
+        self.assertEqual(json.loads(requests_sent[0]['post'].decode())['channel_id'], 'town-square')
+
+        self.assertEqual(list(self.server.httpd.posts), ['post1'])
+        text = self.server.httpd.posts['post1']['message']
+        self.assertTrue(text.startswith(':x: Failed Pipeline'))
+        self.assertIn(':white_check_mark: [success]', text)
+        self.assertIn(':x: [fail]', text)
+
+    def test_deleted_post_is_recreated(self):
+        self.assertGitlabHookWorks("gitlab/build/create_build_1")
+        self.server.httpd.posts.clear()
+        self.assertGitlabHookWorks("gitlab/build/start_build_1")
+        self.assertEqual(list(self.server.httpd.posts), ['post2'])
+
+    def test_one_post_per_pipeline(self):
+        self.url = "/new_event"
+        self.assertGitlabHookWorks("gitlab/pipeline/running_pipeline")
+        self.assertGitlabHookWorks("gitlab/pipeline/failed_pipeline")
+        self.assertEqual(list(self.server.httpd.posts), ['post1'])
+        self.assertEqual(self.server.httpd.posts['post1']['message'], file_content("gitlab/pipeline/failed_pipeline.md"))
+
+    def test_other_events_create_posts(self):
+        self.url = "/new_event"
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        self.assertEqual(self.server.httpd.posts['post1']['message'], file_content("gitlab/issue/open_issue.md").strip())
+
+    def test_replicas_share_posts(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'state.db')
+            replicas = [mattermost_api.PipelinePosts(state.SQLiteBackend(path)) for __ in range(2)]
+            for replica, name in zip(replicas * 2, ("create_build_1", "create_build_2", "start_build_1", "failed_build")):
+                server.pipeline_posts = replica
+                self.assertGitlabHookWorks("gitlab/build/" + name)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(list(self.server.httpd.posts), ['post1'])
+        self.assertIn(':x: [fail]', self.server.httpd.posts['post1']['message'])
+        self.assertIn(':arrow_forward: [success]', self.server.httpd.posts['post1']['message'])
+
+
+class ReplyThreadTest(ServerTestMixin):
+
+    def setUp(self):
+        super(ReplyThreadTest, self).setUp()
+        api_url = "http://127.0.0.1:{}".format(self.port)
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'state.db')
+        _, _, options = server.parse_args(["--mattermost-api-url", api_url, "--bot-token", "secret", "--channel-id", "town-square", "--reply-threads",
+                                           "--state-db", path])
+        server.app.config.update(options)
+        server.thread_posts = mattermost_api.ThreadPosts(state.SQLiteBackend(path))
+
+    def tearDown(self):
+        super(ReplyThreadTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def roots(self):
+        return dict((post_id, post['root_id']) for post_id, post in self.server.httpd.posts.items())
+
+    def test_replies(self):
+        for name in ("issue/open_issue", "merge_request/open_merge_request", "note/issue_note", "note/merge_request_note", "issue/close_issue", "note/commit_note"):
+            self.assertGitlabHookWorks("gitlab/" + name)
+
+        self.assertEqual(self.roots(), {'post1': '', 'post2': '', 'post3': 'post1', 'post4': 'post2', 'post5': 'post1', 'post6': ''})
+        self.assertEqual(self.server.httpd.posts['post3']['message'], file_content("gitlab/note/issue_note.md").strip())
+
+    def test_deleted_root_starts_a_new_thread(self):
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        self.server.httpd.posts.clear()
+        self.assertGitlabHookWorks("gitlab/note/issue_note")
+        self.assertGitlabHookWorks("gitlab/issue/close_issue")
+        self.assertEqual(self.roots(), {'post2': '', 'post3': 'post2'})
+
+    def test_other_errors_keep_the_thread(self):
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        self.server.httpd.add_response(status=400, body='{"id": "api.post.create_post.message.app_error"}')
+        resp = self.app.post(self.url, data=file_content("gitlab/note/issue_note.json"), content_type='application/json')
+        self.assertEqual(resp.status_code, 503)
+        self.assertGitlabHookWorks("gitlab/note/issue_note")
+        self.assertEqual(self.roots(), {'post1': '', 'post2': 'post1'})
+
+    def test_root_claimed_by_another_replica(self):
+        backend = state.MemoryBackend()
+        replicas = [mattermost_api.ThreadPosts(backend, claim_timeout=0.5) for __ in range(2)]
+        client = server.app.config['MATTERMOST_CLIENT']
+        self.assertTrue(backend.add('thread:61:issue:1', mattermost_api.ThreadPosts.PENDING))
+        with self.assertRaises(delivery.DeliveryError) as context:
+            replicas[0].publish(client, 'town-square', '61:issue:1', 'note')
+        self.assertEqual(context.exception.retry_after, 1)
+
+        root_id = client.create_post('town-square', 'issue')['id']
+        threading.Timer(0.1, backend.set, ('thread:61:issue:1', root_id)).start()
+        reply_id = replicas[1].publish(client, 'town-square', '61:issue:1', 'note')
+        self.assertEqual(self.roots(), {root_id: '', reply_id: root_id})
+        self.assertEqual(replicas[0].publish(client, 'town-square', '61:issue:1', 'close'), 'post3')
+        self.assertEqual(self.roots()['post3'], root_id)
+
+    def test_threads_survive_restarts(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'state.db')
+            server.thread_posts = mattermost_api.ThreadPosts(state.SQLiteBackend(path))
+            self.assertGitlabHookWorks("gitlab/issue/open_issue")
+            server.thread_posts = mattermost_api.ThreadPosts(state.SQLiteBackend(path))
+            self.assertGitlabHookWorks("gitlab/note/issue_note")
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(self.roots(), {'post1': '', 'post2': 'post1'})
+
+    def test_bounded_cache(self):
+        backend = state.MemoryBackend()
+        threads = mattermost_api.ThreadPosts(backend, cache_size=2)
+        for iid in range(5):
+            threads.remember('61:issue:%d' % iid, 'post%d' % iid, time.time())
+        self.assertEqual(list(threads.cache), ['61:issue:3', '61:issue:4'])
+
+        backend.set('thread:61:issue:0', 'post0')
+        self.assertEqual(threads.root('61:issue:0'), 'post0')
+        self.assertEqual(list(threads.cache), ['61:issue:4', '61:issue:0'])
+        self.assertIsNone(threads.root('61:issue:1'))
+
+    def test_requires_api_mode(self):
+        with self.assertRaises(SystemExit):
+            server.parse_args(["http://mattermost", "--reply-threads", "--state-db", "state.db"])
+
+    def test_requires_state(self):
+        with self.assertRaises(SystemExit):
+            server.parse_args(["--mattermost-api-url", "http://mattermost", "--bot-token", "secret", "--channel-id", "town-square", "--reply-threads"])
+
+
+class MentionTest(ServerTestMixin):
+
+    def setUp(self):
+        super(MentionTest, self).setUp()
+        url = "http://127.0.0.1:{}".format(self.port)
+        _, _, options = server.parse_args([url, "--mattermost-api-url", url, "--bot-token", "secret", "--mention-users"])
+        server.app.config.update(options)
+        server.mention_resolver = mentions.MentionResolver()
+        self.server.httpd.users.add('root')
+
+    def posted_texts(self):
+        return [json.loads(r['post'].decode())['text'] for r in self.server.httpd.received_requests if r['path'] != '/api/v4/users/usernames']
+
+    def lookups(self):
+        return [json.loads(r['post'].decode()) for r in self.server.httpd.received_requests if r['path'] == '/api/v4/users/usernames']
+
+    def test_mention(self):
+        self.assertGitlabHookWorks("gitlab/note/issue_note")
+        self.assertGitlabHookWorks("gitlab/merge_request/open_merge_request")
+        texts = self.posted_texts()
+        self.assertIn('*@root commented on an issue', texts[0])
+        self.assertIn('*@root created a merge request', texts[1])
+        self.assertEqual(self.lookups(), [['root']])
+
+    def test_unknown_user_is_linked(self):
+        self.server.httpd.users.clear()
+        self.assertGitlabHookWorks("gitlab/note/issue_note")
+        self.assertGitlabHookWorks("gitlab/note/issue_note")
+        self.assertEqual(self.posted_texts(), [file_content("gitlab/note/issue_note.md")] * 2)
+        self.assertEqual(len(self.lookups()), 1)
+
+    def test_requires_a_directory(self):
+        with self.assertRaises(SystemExit):
+            server.parse_args(["http://localhost", "--mention-users"])
+
+    def test_mapping(self):
+        data = json.loads(file_content("gitlab/note/issue_note.json"))
+        data['object_attributes']['note'] = '@root and @someone, see foo@root.example.com'
+        event = event_formatter.as_event(data)
+        event.mentions = mentions.MentionResolver().resolve(event.mentioned_usernames, mapping={'root': 'admin'})
+        self.assertEqual(event.mentions, {'root': 'admin'})
+        text = event.format()
+        self.assertIn('*@admin commented', text)
+        self.assertIn('> @admin and @someone, see foo@root.example.com', text)
+
+    def test_batched_and_cached_lookups(self):
+        calls = []
+        resolver = mentions.MentionResolver(negative_ttl=0)
+
+        def directory(usernames):
+            calls.append(sorted(usernames))
+            return [name for name in usernames if name != 'ghost']
+
+        self.assertEqual(resolver.resolve(['alice', 'bob', 'ghost'], directory, {'bob': 'robert'}), {'alice': 'alice', 'bob': 'robert'})
+        self.assertEqual(resolver.resolve(['alice', 'ghost'], directory), {'alice': 'alice'})
+        self.assertEqual(calls, [['alice', 'ghost', 'robert'], ['ghost']])
+
+    def test_latency_budget(self):
+        resolver = mentions.MentionResolver()
+        release = threading.Event()
+
+        def directory(usernames):
+            release.wait(5)
+            return usernames
+
+        start = time.time()
+        self.assertEqual(resolver.resolve(['alice'], directory, budget=0.05), {})
+        self.assertEqual(resolver.resolve(['alice'], directory, budget=0.05), {})
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(resolver.timeouts, 2)
+
+        release.set()
+        deadline = time.time() + 5
+        while resolver.in_flight and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(resolver.resolve(['alice'], directory, budget=0), {'alice': 'alice'})
+
+
+class EnrichmentTest(ServerTestMixin):
+
+    pipelines_path = '/projects/61/pipelines?sha=2e03a84ed69727606a8d662b60125c6c48f6484f&per_page=1'
+
+    def setUp(self):
+        super(EnrichmentTest, self).setUp()
+        url = "http://127.0.0.1:{}".format(self.port)
+        _, _, options = server.parse_args([url, "--push", "--gitlab-api-url", url, "--gitlab-token", "secret"])
+        server.app.config.update(options)
+        server.enricher = enrichment.Enricher()
+        self.server.httpd.gitlab_objects.update({
+            self.pipelines_path: [{'id': 7, 'status': 'failed', 'web_url': 'http://gitlab.example.com/root/example-repository/pipelines/7'}],
+            '/projects/61/merge_requests/1/changes': {'changes': [
+                {'new_path': 'README.md', 'diff': '--- a/README.md\n+++ b/README.md\n@@ -1 +1,2 @@\n-old\n+new\n+line'},
+                {'new_path': 'setup.py', 'diff': '+print(1)'},
+            ]},
+            '/users/1': {'id': 1, 'username': 'root', 'name': 'Administrator'},
+        })
+
+    def posted_texts(self):
+        return [json.loads(r['post'].decode())['text'] for r in self.server.httpd.received_requests if r['method'] == 'POST']
+
+    def gitlab_requests(self):
+        return [r for r in self.server.httpd.received_requests if r['method'] == 'GET']
+
+    def test_push_pipeline(self):
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        pipeline = ':x: [Pipeline #7](http://gitlab.example.com/root/example-repository/pipelines/7) failed'
+        self.assertEqual(self.posted_texts(), [file_content("gitlab/push/commit_master_branch.md").strip() + '\n\n' + pipeline])
+        self.assertEqual(self.gitlab_requests()[0]['headers']['PRIVATE-TOKEN'], 'secret')
+
+    def test_merge_request(self):
+        data = json.loads(file_content("gitlab/merge_request/open_merge_request.json"))
+        data['object_attributes']['assignee_id'] = 1
+        self.app.post(self.url, data=json.dumps(data), content_type='application/json')
+        text = self.posted_texts()[0]
+        self.assertTrue(text.endswith('\n2 files changed, +3 -1\nAssigned to Administrator'), text)
+        # the diffs are not kept
+        self.assertEqual(server.enricher.cache['/projects/61/merge_requests/1/changes'][1], {'files': 2, 'additions': 3, 'deletions': 1})
+
+    def test_cache(self):
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        self.assertEqual(len(self.gitlab_requests()), 1)
+        self.assertEqual(server.enricher.hits, 1)
+
+        server.enricher.ttl = 0
+        server.enricher.clear()
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        revalidation = self.gitlab_requests()[-1]
+        self.assertIn('If-None-Match', revalidation['headers'])
+        self.assertEqual(server.enricher.revalidated, 1)
+        self.assertEqual(len(set(self.posted_texts())), 1)
+
+    def test_missing_resource(self):
+        self.server.httpd.gitlab_objects.clear()
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        self.assertEqual(self.posted_texts(), [file_content("gitlab/push/commit_master_branch.md").strip()])
+        self.assertEqual(server.enricher.errors, 1)
+
+    def test_deadline_and_coalescing(self):
+        release = threading.Event()
+        calls = []
+
+        class SlowClient(object):
+            def get(self, path, etag=None):
+                calls.append(path)
+                release.wait(5)
+                return '"1"', [{'id': 7, 'status': 'success', 'web_url': 'http://gitlab.example.com/pipelines/7'}]
+
+        event = event_formatter.as_event(json.loads(file_content("gitlab/push/commit_master_branch.json")))
+        start = time.time()
+        pending = [server.enricher.start(event, SlowClient(), 0.05) for __ in range(3)]
+        self.assertEqual([enrichment.wait() for enrichment in pending], [{}] * 3)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(server.enricher.coalesced, 2)
+
+        release.set()
+        self.assertEqual(server.enricher.start(event, SlowClient(), 1).wait()['pipeline']['status'], 'success')
+
+
+class WebhookHistoryTest(ServerTestMixin):
+
+    def setUp(self):
+        super(WebhookHistoryTest, self).setUp()
+        server.webhook_history = history.WebhookHistory()
+        server.app.config['ADMIN_TOKEN'] = 'secret'
+
+    def tearDown(self):
+        super(WebhookHistoryTest, self).tearDown()
+        server.app.config['ADMIN_TOKEN'] = ''
+
+    def admin(self, method, path):
+        resp = getattr(self.app, method)(path, headers={'X-Admin-Token': 'secret'})
+        return resp.status_code, json.loads(resp.data.decode('utf-8'))
+
+    def test_outcomes(self):
+        self.assertGitlabHookWorks("gitlab/issue/update_issue")
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        self.server.httpd.add_response(status=500)
+        self.assertEqual(self.post("gitlab/issue/close_issue.json").status_code, 503)
+
+        self.assertTrue(server.webhook_history.wait_compressed())
+        status, data = self.admin('get', '/admin/webhooks')
+        webhooks = data['webhooks']
+        self.assertEqual([webhook['outcome'] for webhook in webhooks], ['failed', 'delivered', 'filtered'])
+        self.assertIn('status=500', webhooks[0]['error'])
+        self.assertEqual(sorted(webhooks[1]['timings']), ['deliver', 'format'])
+        self.assertEqual(webhooks[1]['object_kind'], 'issue')
+        self.assertLess(webhooks[1]['compressed_size'], webhooks[1]['size'])
+
+        status, data = self.admin('get', '/admin/webhooks?outcome=filtered')
+        self.assertEqual([webhook['id'] for webhook in data['webhooks']], [webhooks[2]['id']])
+
+    def test_show_and_replay(self):
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        webhook_id = server.webhook_history.list()[0].id
+
+        status, data = self.admin('get', '/admin/webhooks/%d' % webhook_id)
+        self.assertEqual(data['payload'], json.loads(file_content("gitlab/issue/open_issue.json")))
+
+        status, data = self.admin('post', '/admin/webhooks/%d/replay' % webhook_id)
+        self.assertEqual(data, {'outcome': 'formatted', 'text': file_content("gitlab/issue/open_issue.md")})
+        self.assertEqual(len(self.server.httpd.received_requests), 1)
+
+        status, data = self.admin('post', '/admin/webhooks/%d/replay?deliver=1' % webhook_id)
+        self.assertEqual(data['outcome'], 'delivered')
+        self.assertEqual(len(self.server.httpd.received_requests), 2)
+
+        self.assertEqual(self.app.get('/admin/webhooks/999', headers={'X-Admin-Token': 'secret'}).status_code, 404)
+        self.assertEqual(self.app.get('/admin/webhooks').status_code, 403)
+
+    def test_bounded(self):
+        payload = file_content("gitlab/push/commit_master_branch.json").encode('utf-8')
+        recent = history.WebhookHistory(max_entries=3)
+        for __ in range(5):
+            recent.record('/new_event', payload)
+        self.assertEqual([entry.id for entry in recent.list()], [5, 4, 3])
+
+        recent = history.WebhookHistory(max_entries=100, max_bytes=4096)
+        for __ in range(20):
+            recent.record('/new_event', payload)
+            self.assertTrue(recent.wait_compressed())
+            self.assertLessEqual(recent.bytes, 4096)
+        self.assertGreater(len(recent), 1)
+        self.assertTrue(all(entry.payload is not None for entry in recent.list()))
+        self.assertEqual(recent.list()[0].data(), json.loads(payload.decode('utf-8')))
+        entry = recent.record('/new_event', os.urandom(8192))
+        self.assertTrue(recent.wait_compressed())
+        self.assertIsNone(entry.payload)
+        self.assertIsNone(entry.data())
+        self.assertEqual(entry.size, 8192)
+
+        self.assertIsNone(history.WebhookHistory(max_entries=0).record('/new_event', payload))
+
+    def test_capture_cost(self):
+        payload = file_content("gitlab/merge_request/open_merge_request.json").encode('utf-8')
+        recent = history.WebhookHistory()
+        start = time.time()
+        for __ in range(1000):
+            recent.record('/new_event', payload)
+        self.assertLess((time.time() - start) / 1000, 0.001)
+
+
+class DeadLetterTest(ServerTestMixin):
+
+    def setUp(self):
+        super(DeadLetterTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dead-letters.db')
+        server.dead_letters = deadletter.DeadLetterStore(self.path)
+        server.app.config['ADMIN_TOKEN'] = 'secret'
+
+    def tearDown(self):
+        super(DeadLetterTest, self).tearDown()
+        server.dead_letters.close()
+        server.dead_letters = None
+        server.redrive = None
+        server.app.config['ADMIN_TOKEN'] = ''
+        shutil.rmtree(self.directory)
+
+    def admin(self, method, path):
+        resp = getattr(self.app, method)(path, headers={'X-Admin-Token': 'secret'})
+        return resp.status_code, json.loads(resp.data.decode('utf-8'))
+
+    def unsupported_issue(self):
+        data = json.loads(file_content("gitlab/issue/open_issue.json"))
+        data['object_attributes']['action'] = 'archive'
+        return data
+
+    def test_formatting_failure(self):
+        resp = self.app.post(self.url, data=json.dumps(self.unsupported_issue()), content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        status, data = self.admin('get', '/admin/dead-letters?reason=format')
+        dead_letter = data['dead_letters'][0]
+        self.assertEqual((dead_letter['error_class'], dead_letter['object_kind'], dead_letter['project'], dead_letter['attempts']), ('NotImplementedError', 'issue', '61', 1))
+        self.assertEqual(data['summary'], {'format': {'NotImplementedError': 1}})
+        status, data = self.admin('get', '/admin/dead-letters/%d' % dead_letter['id'])
+        self.assertEqual(data['payload'], self.unsupported_issue())
+
+        # still unsupported: the dead letter is kept with one more attempt
+        redrive = deadletter.Redrive(server.dead_letters, server.dead_letters.ids(), server.redeliver).start()
+        redrive.join()
+        self.assertEqual((redrive.delivered, redrive.failed), (0, 1))
+        self.assertEqual(server.dead_letters.get(dead_letter['id']).attempts, 2)
+
+    def test_server_failure_is_retried(self):
+        def locked(event, channel=''):
+            raise sqlite3.OperationalError('database is locked')
+
+        server.app.config['DIGEST_RULES'] = digest.DigestRules(['issue'])
+        server.digest_store = digest.Digest(server.deliver)
+        server.digest_store.add = locked
+        try:
+            resp = self.app.post(self.url, data=file_content("gitlab/issue/open_issue.json"), content_type='application/json')
+        finally:
+            server.app.config['DIGEST_RULES'] = None
+            server.digest_store = None
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+        self.assertEqual(server.dead_letters.list(), [])
+
+    def test_delivery_failure(self):
+        queue = delivery.DeliveryQueue(server.post_message, max_attempts=2, retry_delay=0, on_failure=server.dead_letters.add_message)
+        self.server.httpd.add_response(status=500)
+        self.server.httpd.add_response(status=503)
+        queue.start()
+        try:
+            message = delivery.Message('hello', 'issue', 'open', project=61, event_time=time.time())
+            queue.put(message)
+            queue.join(5)
+        finally:
+            queue.stop()
+
+        dead_letter, = server.dead_letters.list()
+        self.assertEqual((dead_letter.reason, dead_letter.error_class, dead_letter.attempts, dead_letter.last_status), ('delivery', 'DeliveryError', 2, 503))
+        self.assertEqual(server.dead_letters.get(dead_letter.id).message().text, 'hello')
+
+    def test_filters(self):
+        store = server.dead_letters
+        error = delivery.DeliveryError('down', status=502)
+        for project in (1, 2, 2):
+            store.add_message(delivery.Message('text', 'push', project=project), error)
+        store.add_payload('/new_event', self.unsupported_issue(), NotImplementedError('archive'))
+
+        self.assertEqual(len(store.list(project=2)), 2)
+        self.assertEqual(len(store.list(reason='delivery', project=1)), 1)
+        self.assertEqual(len(store.list(error_class='NotImplementedError')), 1)
+        self.assertEqual(len(store.list(since=time.time() - 60)), 4)
+        self.assertEqual(len(store.list(until=time.time() - 60)), 0)
+        self.assertEqual(store.summary(), {'delivery': {'DeliveryError': 3}, 'format': {'NotImplementedError': 1}})
+
+        status, data = self.admin('get', '/admin/dead-letters?project=2&since=1h')
+        self.assertEqual(len(data['dead_letters']), 2)
+        self.assertEqual(self.app.get('/admin/dead-letters?since=yesterday', headers={'X-Admin-Token': 'secret'}).status_code, 400)
+
+        self.assertEqual(store.purge(reason='format'), 1)
+        bounded = deadletter.DeadLetterStore(os.path.join(self.directory, 'bounded.db'), max_entries=2)
+        for __ in range(5):
+            bounded.add_message(delivery.Message('text', 'push'), error)
+        self.assertEqual(len(bounded.list()), 2)
+
+    def test_redrive(self):
+        store = server.dead_letters
+        for index in range(6):
+            store.add_message(delivery.Message('message %d' % index, 'push', project=index % 2), delivery.DeliveryError('down'))
+
+        status, data = self.admin('post', '/admin/dead-letters/redrive?project=1&rate=50&workers=2')
+        self.assertEqual(status, 202)
+        self.assertEqual(data['total'], 3)
+        server.redrive.join()
+        status, data = self.admin('get', '/admin/dead-letters/redrive')
+        self.assertEqual((data['delivered'], data['failed'], data['done']), (3, 0, True))
+
+        texts = sorted(json.loads(r["post"].decode())["text"] for r in self.server.httpd.received_requests)
+        self.assertEqual(texts, ['message 1', 'message 3', 'message 5'])
+        self.assertEqual(len(store.list()), 3)
+
+    def test_cli(self):
+        server.dead_letters.add_payload('/new_event', json.loads(file_content("gitlab/issue/open_issue.json")), ValueError('bug'))
+        server.dead_letters.add_message(delivery.Message('hello', 'push', project=3), delivery.DeliveryError('down'))
+
+        self.assertEqual(deadletter.main(['--db', self.path, 'list', '--reason', 'format']), 0)
+        self.assertEqual(deadletter.main(['--db', self.path, 'redrive', '--deliver', 'http://127.0.0.1:%d' % self.port, '--rate', '0']), 0)
+        texts = sorted(json.loads(r["post"].decode())["text"] for r in self.server.httpd.received_requests)
+        self.assertEqual(texts, sorted(['hello', file_content("gitlab/issue/open_issue.md").strip()]))
+        self.assertEqual(server.dead_letters.list(), [])
+
+    def test_disabled(self):
+        server.dead_letters = None
+        self.assertEqual(self.app.get('/admin/dead-letters', headers={'X-Admin-Token': 'secret'}).status_code, 404)
+        server.dead_letters = deadletter.DeadLetterStore(self.path)
+
+
+class EventStoreTest(ServerTestMixin):
+
+    def setUp(self):
+        super(EventStoreTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        server.event_store = eventstore.EventStore(os.path.join(self.directory, 'events.db'), poll_interval=0.05)
+        server.event_store.start()
+        server.app.config['ADMIN_TOKEN'] = 'secret'
+
+    def tearDown(self):
+        super(EventStoreTest, self).tearDown()
+        server.event_store.stop()
+        server.event_store = None
+        server.app.config['ADMIN_TOKEN'] = ''
+        shutil.rmtree(self.directory)
+
+    def query(self, query=''):
+        resp = self.app.get('/admin/events' + query, headers={'X-Admin-Token': 'secret'})
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.data.decode('utf-8'))['events']
+
+    def test_query(self):
+        for name in ("issue/open_issue", "merge_request/merge_merge_request", "merge_request/open_merge_request", "push/commit_master_branch"):
+            self.assertGitlabHookWorks("gitlab/" + name)
+        self.assertTrue(server.event_store.flush(5))
+
+        events = self.query()
+        self.assertEqual(len(events), 4)
+        self.assertEqual([event['time'] for event in events], sorted((event['time'] for event in events), reverse=True))
+
+        merged, = self.query('?kind=merge_request&action=merge')
+        self.assertEqual((merged['project_id'], merged['iid'], merged['time']), ('61', 1, calendar.timegm((2016, 12, 16, 18, 13, 28))))
+        author = merged['author']
+        self.assertEqual(len(self.query('?author=%s&kind=merge_request' % author)), 2)
+
+        push, = self.query('?kind=push')
+        self.assertEqual(push['ref'], 'master')
+        self.assertEqual(len(self.query('?project=61')), len(self.query('?project=%s' % push['project'])))
+        self.assertEqual(self.query('?since=2016-12-16T18:13:28Z&until=2016-12-16T18:13:29Z'), [merged])
+
+    def test_filtered_events_are_not_recorded(self):
+        self.assertGitlabHookWorks("gitlab/issue/update_issue")
+        server.event_store.flush(5)
+        self.assertEqual(self.query(), [])
+
+    def test_retried_events_are_recorded_once(self):
+        self.server.httpd.add_response(status=500)
+        self.assertEqual(self.post("gitlab/issue/open_issue.json").status_code, 503)
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        server.event_store.flush(5)
+        self.assertEqual(len(self.query()), 1)
+
+    def test_pushes_are_dated_when_received(self):
+        start = time.time()
+        self.assertGitlabHookWorks("gitlab/push/commit_master_branch")
+        server.event_store.flush(5)
+        push, = self.query('?kind=push&since=%f' % start)
+        self.assertEqual(push['time'], push['received_at'])
+
+    def test_retention(self):
+        store = eventstore.EventStore(os.path.join(self.directory, 'retention.db'), retention=3600, batch_size=2)
+        event = event_formatter.as_event(json.loads(file_content("gitlab/issue/open_issue.json")))
+        store.start()
+        for __ in range(5):
+            store.record(event)
+        store.stop()
+        self.assertEqual(store.stats()['recorded'], 5)
+        # retention counts from the recording, not from the event in 2016
+        self.assertEqual(len(store.query()), 5)
+        store.prune(time.time() + 3601)
+        self.assertEqual(store.query(), [])
+        self.assertEqual(store.stats()['pruned'], 5)
+
+    def test_full_queue_drops_events(self):
+        store = eventstore.EventStore(os.path.join(self.directory, 'full.db'), max_pending=2)
+        event = event_formatter.as_event(json.loads(file_content("gitlab/issue/open_issue.json")))
+        self.assertEqual([store.record(event) for __ in range(3)], [True, True, False])
+        self.assertEqual(store.stats()['dropped'], 1)
+
+
+class SoakTest(unittest.TestCase):
+
+    def samples(self, rss, objects, p99, errors=0):
+        return [
+            {'elapsed': index * 10.0, 'requests': (index + 1) * 100, 'errors': errors, 'rss': rss_mb * 1048576, 'objects': count, 'p99': latency}
+            for index, (rss_mb, count, latency) in enumerate(zip(rss, objects, p99))
+        ]
+
+    def check(self, samples):
+        return soak.check(samples, warmup=10, max_rss_growth=50, max_object_growth=0.2, max_p99_drift=2, p99_floor=20, max_error_rate=0.01)
+
+    def test_check(self):
+        self.assertEqual(self.check(self.samples([10, 40, 45, 44], [5000, 30000, 31000, 30500], [80, 10, 15, 12])), [])
+        self.assertEqual(len(self.check(self.samples([10, 40, 70, 100], [5000, 30000, 40000, 50000], [80, 10, 15, 12]))), 2)
+        self.assertIn('p99 latency reached 30.0 ms', self.check(self.samples([40] * 4, [30000] * 4, [5, 10, 30, 12]))[0])
+        self.assertEqual(len(self.check(self.samples([40] * 2, [30000] * 2, [5, 10]))), 1)
+        self.assertEqual(self.check(self.samples([40] * 4, [30000] * 4, [5] * 4, errors=4)), [])
+        self.assertEqual(self.check(self.samples([40] * 4, [30000] * 4, [5] * 4, errors=5)), ['5 of 400 webhooks failed'])
+
+    def test_short_run(self):
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        # away from the checkout, as the server must not depend on the working directory
+        os.chdir(directory)
+        try:
+            report = os.path.join(directory, 'soak.json')
+            # over half a second the p99 latency is that of the slowest of a few dozen webhooks,
+            # too noisy on a loaded machine to be checked
+            self.assertEqual(soak.main(['--duration', '2', '--interval', '0.5', '--p99-floor', '1000', '--report', report, '--', '--push']), 0)
+            with open(report) as fp:
+                data = json.load(fp)
+                samples = data['samples']
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+        self.assertEqual(len(samples), 4)
+        self.assertEqual(data['errors'], 0)
+        self.assertTrue(data['server_output'])
+        self.assertGreater(samples[-1]['requests'], 0)
+        self.assertEqual(samples[-1]['errors'], 0)
+
+
+class LagTest(ServerTestMixin):
+
+    def setUp(self):
+        super(LagTest, self).setUp()
+        server.lag_tracker = lag.LagTracker()
+
+    def test_parse_timestamp(self):
+        expected = calendar.timegm((2016, 12, 16, 18, 13, 26))
+        self.assertEqual(lag.parse_timestamp("2016-12-16 18:13:26 UTC"), expected)
+        self.assertEqual(lag.parse_timestamp("2016-12-16T18:13:26+00:00"), expected)
+        self.assertEqual(lag.parse_timestamp("2016-12-16T19:13:26.5+01:00"), expected + 0.5)
+        self.assertEqual(lag.parse_timestamp("2016-12-16T18:13:26Z"), expected)
+        self.assertEqual(lag.parse_timestamp("2016-12-16 17:13:26 -0100"), expected)
+        self.assertIsNone(lag.parse_timestamp("yesterday"))
+        self.assertIsNone(lag.parse_timestamp(None))
+
+    def test_event_timestamps(self):
+        for name, timestamp in (
+            ("issue/reopen_issue", "2016-12-16 18:13:27 UTC"),
+            ("merge_request/merge_merge_request", "2016-12-16 18:13:28 UTC"),
+            ("build/failed_build", "2016-12-16 18:13:38 UTC"),
+            ("build/start_build_1", None),
+            ("pipeline/failed_pipeline", "2016-12-16 18:13:39 UTC"),
+            ("pipeline/running_pipeline", None),
+            # the commits of a push may have been authored long before
+            ("push/commit_master_branch", None),
+            ("tag_push/tag", None),
+        ):
+            data = json.loads(file_content("gitlab/%s.json" % name))
+            event = event_formatter.as_ci_event(data) if name.startswith(('build', 'pipeline')) else event_formatter.as_event(data)
+            self.assertEqual(event.timestamp, timestamp, name)
+
+    def test_tracker(self):
+        tracker = lag.LagTracker(max_projects=2, window=60)
+        for project, seconds, now in ((1, 0.2, 1000), (2, 40, 1010), (3, 7, 1030), (1, -3, 1030)):
+            tracker.record('push', project, seconds, now)
+        stats = tracker.stats(now=1030)
+        self.assertEqual(stats['max_lag'], 40)
+        self.assertEqual(sorted(stats['projects']), ['1', '2', 'other'])
+        self.assertEqual(stats['object_kinds']['push']['count'], 4)
+        self.assertEqual(stats['object_kinds']['push']['counts'][:2], [2, 0])
+        self.assertEqual(tracker.max_lag(now=1075), 7)
+        self.assertIsNone(tracker.max_lag(now=2000))
+
+    def test_delivered_messages(self):
+        server.app.config['ADMIN_TOKEN'] = 'secret'
+        try:
+            self.assertGitlabHookWorks("gitlab/issue/open_issue")
+            self.assertGitlabHookWorks("gitlab/issue/update_issue")
+            resp = self.app.get('/admin/lag', headers={'X-Admin-Token': 'secret'})
+        finally:
+            server.app.config['ADMIN_TOKEN'] = ''
+        stats = json.loads(resp.data.decode('utf-8'))
+        self.assertEqual(list(stats['object_kinds']), ['issue'])
+        self.assertEqual(stats['object_kinds']['issue']['counts'][-1], 1)
+        self.assertGreater(stats['max_lag'], 3600)
+        self.assertEqual(list(stats['projects']), ['61'])
+
+
+class ProfilingTest(ServerTestMixin):
+
+    def setUp(self):
+        super(ProfilingTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        server.profiler.configure(threshold_ms=0, directory=self.directory, keep=2)
+
+    def tearDown(self):
+        super(ProfilingTest, self).tearDown()
+        server.profiler.configure()
+        shutil.rmtree(self.directory)
+
+    def test_slow_requests_are_profiled(self):
+        for __ in range(3):
+            self.assertGitlabHookWorks("gitlab/issue/open_issue")
+
+        files = glob.glob(os.path.join(self.directory, '*.pstats'))
+        self.assertEqual(len(files), 2)
+        self.assertIn('-issue-', files[0])
+        pstats.Stats(files[0])
+
+    def test_disabled(self):
+        server.profiler.configure()
+        self.assertGitlabHookWorks("gitlab/issue/open_issue")
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class AdminTest(FlaskMixin):
+
+    def tearDown(self):
+        super(AdminTest, self).tearDown()
+        server.app.config['ADMIN_TOKEN'] = ''
+
+    def test_disabled_without_token(self):
+        server.app.config['ADMIN_TOKEN'] = ''
+        self.assertEqual(self.app.get('/admin/tracemalloc').status_code, 404)
+
+    def test_tracemalloc(self):
+        server.app.config['ADMIN_TOKEN'] = 'secret'
+        headers = {'X-Admin-Token': 'secret'}
+        self.assertEqual(self.app.get('/admin/tracemalloc', headers={'X-Admin-Token': 'wrong'}).status_code, 403)
+        self.assertEqual(self.app.get('/admin/tracemalloc', headers=headers).status_code, 409)
+        self.assertEqual(self.app.post('/admin/tracemalloc/start', headers=headers).status_code, 200)
+        try:
+            resp = self.app.get('/admin/tracemalloc', headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b'traced memory', resp.data)
+        finally:
+            self.app.post('/admin/tracemalloc/stop', headers=headers)
+
+    def test_memory(self):
+        server.app.config['ADMIN_TOKEN'] = 'secret'
+        stats = json.loads(self.app.get('/admin/memory', headers={'X-Admin-Token': 'secret'}).data.decode('utf-8'))
+        self.assertEqual(sorted(stats), ['objects', 'rss', 'threads'])
+        self.assertGreater(stats['objects'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()